@@ -15,6 +15,9 @@ logging.basicConfig()
 parser = argparse.ArgumentParser()
 parser.add_argument('hostname');
 parser.add_argument('port', type=int);
+parser.add_argument('--workers', type=int, help='number of worker processes')
+parser.add_argument('--reuseport', action='store_true',
+                    help='use SO_REUSEPORT to balance the workers')
 args = parser.parse_args()
 
 
@@ -25,7 +28,10 @@ def hello_app(environ, start_response):
 
 
 server = HttpServer(hello_app)
-server.listen((args.hostname, args.port))
+server.listen((args.hostname, args.port), workers=args.workers,
+              reuseport=args.reuseport)
+if server.transport is None:
+    raise SystemExit  # parent of the worker processes
 
 hub = get_hub()
 print('Press CTRL-C to exit')
@@ -12,5 +12,6 @@ from ._version import *
 from .error import *
 from .hub import *
 from .fiber import *
+from .executor import *
 
 from . import local, util, http, jsonrpc, dbus, pyuv, ssl
@@ -8,6 +8,7 @@
 
 import sys
 import inspect
+import threading
 
 
 PY3 = sys.version_info >= (3, 0, 0)
@@ -57,6 +58,25 @@ else:
 
     exec_('def reraise(tp, value, tb=None):\n  raise tp, value, tb\n')
 
+try:
+    memoryview = memoryview
+except NameError:
+    # Python 2.6. Slicing will copy but is otherwise equivalent.
+    def memoryview(obj):
+        return obj
+
+
+if hasattr(threading, 'main_thread'):
+    def is_main_thread():
+        """Return whether the current thread is the main thread."""
+        return threading.current_thread() is threading.main_thread()
+else:
+    # Python 2.x and 3.3 have no threading.main_thread(). The main thread is
+    # the only instance of the private _MainThread class there.
+    def is_main_thread():
+        """Return whether the current thread is the main thread."""
+        return isinstance(threading.current_thread(), threading._MainThread)
+
 
 def getqualname(obj):
     if hasattr(obj, '__qualname__'):
@@ -0,0 +1,242 @@
+#
+# This file is part of Gruvi. Gruvi is free software available under the
+# terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2012-2013 the Gruvi authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import sys
+import threading
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+from . import compat
+from .hub import switchpoint, get_hub
+from .fiber import Condition
+from .pyuv import pyuv_exc
+
+__all__ = ['run_in_executor', 'ThreadPool', 'ProcessPool']
+
+
+class _Work(object):
+    """A call that is run in another thread, and that captures its outcome."""
+
+    __slots__ = ('func', 'args', 'result', 'exc_info', 'done')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exc_info = None
+        self.done = False
+
+    def __call__(self):
+        try:
+            self.result = self.func(*self.args)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+        self.done = True
+
+    def get(self):
+        """Return the result, or re-raise the exception of the call."""
+        if self.exc_info is None:
+            return self.result
+        try:
+            compat.reraise(*self.exc_info)
+        finally:
+            self.exc_info = None
+
+
+@switchpoint
+def run_in_executor(func, *args):
+    """Run ``func(*args)`` in the libuv thread pool, and return its result.
+
+    Only the calling fiber is suspended while *func* runs. If *func* raises an
+    exception, it is re-raised in the calling fiber.
+
+    The size of the libuv thread pool is fixed, and shared with other users
+    such as :func:`gruvi.util.getaddrinfo`. Use a :class:`ThreadPool` if you
+    need to control the number of threads.
+    """
+    hub = get_hub()
+    work = _Work(func, args)
+    done = Condition()
+    errors = []
+    def on_done(error):
+        errors.append(error)
+        done.notify()
+    hub.loop.queue_work(work, on_done)
+    while not errors:
+        done.wait()
+    if errors[0]:
+        raise pyuv_exc(None, errors[0])
+    return work.get()
+
+
+def _call_in_process(func, args):
+    # Run a call in a multiprocessing.Pool process. That pool calls back on
+    # success only, so an exception is returned rather than raised.
+    try:
+        return True, func(*args)
+    except Exception as e:
+        return False, e
+
+
+class ThreadPool(object):
+    """A pool of *size* threads to run blocking functions in.
+
+    The threads are started on first use. The pool may be shared between
+    fibers in different hubs.
+    """
+
+    def __init__(self, size=4):
+        self._size = size
+        self._queue = queue.Queue()
+        self._threads = []
+        self._closed = False
+
+    @property
+    def size(self):
+        """The number of threads in the pool."""
+        return self._size
+
+    def _start_threads(self):
+        while len(self._threads) < self._size:
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            work, hub, notify = job
+            work()
+            hub.run_callback_threadsafe(notify)
+
+    @switchpoint
+    def run(self, func, *args):
+        """Run ``func(*args)`` in one of the threads, and return its result.
+
+        Only the calling fiber is suspended while *func* runs. If *func*
+        raises an exception, it is re-raised in the calling fiber.
+        """
+        if self._closed:
+            raise RuntimeError('pool is closed')
+        if len(self._threads) < self._size:
+            self._start_threads()
+        hub = get_hub()
+        work = _Work(func, args)
+        done = Condition()
+        self._queue.put((work, hub, done.notify))
+        hub._ref_async(1)
+        try:
+            while not work.done:
+                done.wait()
+        finally:
+            hub._ref_async(-1)
+        return work.get()
+
+    def close(self):
+        """Close the pool.
+
+        Calls that are already queued are run to completion. No new calls can
+        be made.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for thread in self._threads:
+            self._queue.put(None)
+        self._threads = []
+
+
+class ProcessPool(object):
+    """A pool of *size* processes to run blocking functions in.
+
+    This is useful for CPU bound functions that do not release the GIL. The
+    pool is a :class:`concurrent.futures.ProcessPoolExecutor`, or on Python
+    2.x a :class:`multiprocessing.Pool`. This means that the function, its
+    arguments and its result need to be picklable. If *size* is not
+    provided, the number of CPUs is used.
+    """
+
+    #: How often a call is checked for completion on Python 2.x. This is a
+    #: fallback for calls that fail to pickle, as :class:`multiprocessing.Pool`
+    #: does not call back on those.
+    poll_interval = 1
+
+    def __init__(self, size=None):
+        if futures is not None:
+            self._executor = futures.ProcessPoolExecutor(size)
+            self._pool = None
+        else:
+            self._executor = None
+            self._pool = multiprocessing.Pool(size)
+        self._closed = False
+
+    @switchpoint
+    def run(self, func, *args):
+        """Run ``func(*args)`` in one of the processes, and return its result.
+
+        Only the calling fiber is suspended while *func* runs. If *func*
+        raises an exception, it is re-raised in the calling fiber. So are
+        errors to pickle the call or its result, and on Python 3 the death
+        of a worker process.
+        """
+        if self._closed:
+            raise RuntimeError('pool is closed')
+        hub = get_hub()
+        done = Condition()
+        def on_done(result):
+            hub.run_callback_threadsafe(done.notify)
+        if self._executor is None:
+            result = self._pool.apply_async(_call_in_process, (func, args),
+                                            callback=on_done)
+            hub._ref_async(1)
+            try:
+                while not result.ready():
+                    done.wait(self.poll_interval)
+            finally:
+                hub._ref_async(-1)
+            ok, value = result.get()
+            if not ok:
+                raise value
+            return value
+        future = self._executor.submit(func, *args)
+        hub._ref_async(1)
+        try:
+            future.add_done_callback(on_done)
+            while not future.done():
+                done.wait()
+        finally:
+            hub._ref_async(-1)
+        return future.result()
+
+    def close(self):
+        """Close the pool.
+
+        Calls that are already queued are run to completion, after which the
+        processes exit. No new calls can be made.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        else:
+            self._pool.close()
@@ -14,7 +14,7 @@ import fibers
 from . import hub, logging, util
 from .hub import switchpoint
 
-__all__ = ['Condition', 'ConditionSet', 'Queue', 'Fiber']
+__all__ = ['Condition', 'ConditionSet', 'Queue', 'Fiber', 'FiberPool']
 
 
 class Condition(object):
@@ -36,8 +36,11 @@ class Condition(object):
         del self._waiters[:]
 
     def wait(self, timeout=None):
-        self._waiters.append(self._hub.switch_back())
+        switch_back = self._hub.switch_back()
+        self._waiters.append(switch_back)
         value = self._hub.switch(timeout)
+        if not value and switch_back in self._waiters:
+            self._waiters.remove(switch_back)  # timeout
         return value
 
 
@@ -60,9 +63,10 @@ class ConditionSet(object):
         timeout = kwargs.get('timeout')
         self._waiting = set(conditions)
         ret = self._condition.wait(timeout)
-        assert len(ret) == 1
-        if ret[0] is None:
+        if not ret:
+            self._waiting.clear()
             return  # timeout
+        assert len(ret) == 1
         condition, value = ret[0]
         assert condition in self._waiting
         self._waiting.clear()
@@ -166,3 +170,90 @@ class Fiber(fibers.Fiber):
         elif current.parent is None:
             raise RuntimeError('you may not join() the root fiber')
         self._done.wait(timeout)
+
+
+class FiberPool(object):
+    """A pool of reusable fibers.
+
+    Functions are run in the pool with :meth:`spawn`. At most *size* functions
+    run concurrently; functions that are spawned while all fibers are busy are
+    queued until a fiber becomes available. After its function returns, a
+    fiber is kept around for reuse if there are fewer than *max_idle* idle
+    fibers.
+
+    The pool keeps a few metrics that can be used for tuning its size. See
+    :attr:`hits`, :attr:`misses`, :attr:`queued` and :attr:`queue_delay`.
+    """
+
+    def __init__(self, size=1000, max_idle=100):
+        self._hub = hub.get_hub()
+        self._size = size
+        self._max_idle = max_idle
+        self._nfibers = 0
+        self._idle = []
+        self._jobs = collections.deque()
+        self._log = logging.get_logger(util.objref(self))
+        #: The number of functions that were run in an idle fiber.
+        self.hits = 0
+        #: The number of functions for which a new fiber was created.
+        self.misses = 0
+        #: The number of functions that had to wait for a fiber.
+        self.queued = 0
+        #: The total time in seconds that queued functions have waited.
+        self.queue_delay = 0.0
+
+    @property
+    def size(self):
+        """The maximum number of concurrently running functions."""
+        return self._size
+
+    @property
+    def max_idle(self):
+        """The maximum number of idle fibers that are kept."""
+        return self._max_idle
+
+    @property
+    def active(self):
+        """The number of fibers that are running a function."""
+        return self._nfibers - len(self._idle)
+
+    def spawn(self, func, *args):
+        """Run ``func(*args)`` in a fiber from the pool.
+
+        The function is started in a next iteration of the event loop.
+        """
+        if self._idle:
+            self.hits += 1
+            self._jobs.append((func, args, None))
+            self._idle.pop()()
+        elif self._nfibers < self._size:
+            self.misses += 1
+            self._jobs.append((func, args, None))
+            self._nfibers += 1
+            Fiber(self._worker).start()
+        else:
+            self.queued += 1
+            self._jobs.append((func, args, self._hub.loop.now()))
+
+    def _worker(self):
+        # Target of the pool's fibers. Jobs are shared by all fibers, so a
+        # fiber that is woken up may find that another fiber already took
+        # the job. In that case it just becomes idle again.
+        jobs = self._jobs
+        try:
+            while True:
+                while jobs:
+                    func, args, queued_at = jobs.popleft()
+                    if queued_at is not None:
+                        delay = self._hub.loop.now() - queued_at
+                        self.queue_delay += delay / 1000.0
+                    try:
+                        func(*args)
+                    except Exception:
+                        self._log.exception('uncaught exception in fiber')
+                if len(self._idle) >= self._max_idle:
+                    break
+                self._idle.append(self._hub.switch_back())
+                self._hub.switch()
+        finally:
+            self._nfibers -= 1
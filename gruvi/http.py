@@ -36,11 +36,17 @@ Some general notes:
 
 from __future__ import absolute_import, print_function
 
-import os.path
+import os
+import time
+import zlib
+import struct
 import collections
+import pyuv
+from email.utils import formatdate
 
 from . import hub, protocols, error, reader, http_ffi, logging, compat
 from .hub import switchpoint
+from .fiber import Condition
 from .util import objref, docfrom
 from ._version import __version__
 
@@ -49,8 +55,14 @@ try:
 except ImportError:
     from urlparse import urlsplit
 
+try:
+    from http.client import responses as _responses
+except ImportError:
+    from httplib import responses as _responses
+
 __all__ = ['HttpError', 'HttpClient', 'HttpServer', 'HttpResponse',
-           'geturlinfo']
+           'HttpHeaders', 'HttpFuture', 'HttpConnectionPool', 'HttpProxy',
+           'HttpResponseWriter', 'HttpRouter', 'geturlinfo']
 
 
 # The "Hop by Hop" headers as defined in RFC 2616. These may not be set by the
@@ -58,6 +70,16 @@ __all__ = ['HttpError', 'HttpClient', 'HttpServer', 'HttpResponse',
 hop_by_hop = frozenset(('Connection', 'Keep-Alive', 'Proxy-Authenticate',
                         'Proxy-Authorization', 'TE', 'Trailers',
                         'Transfer-Encoding', 'Upgrade'))
+_hop_by_hop_lower = frozenset(name.lower() for name in hop_by_hop)
+
+# Methods that may be pipelined, per RFC 2616 section 8.1.2.2.
+idempotent_methods = frozenset(('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS',
+                                'TRACE'))
+
+# Content types other than text/* that are worth compressing.
+compressible_types = frozenset(('application/json', 'application/javascript',
+                                'application/x-javascript', 'application/xml',
+                                'application/xhtml+xml', 'image/svg+xml'))
 
 
 def geturlinfo(url):
@@ -69,13 +91,15 @@ def geturlinfo(url):
     """
     parsed = urlsplit(url)
     try:
-        hort, port = parsed.netloc.split(':')
+        host, port = parsed.netloc.split(':')
         port = int(port)
     except ValueError:
         host = parsed.netloc
         port = 443 if parsed.scheme == 'https' else 80
     ssl = parsed.scheme == 'https'
-    path = (parsed.path + parsed.query) or '/'
+    path = parsed.path or '/'
+    if parsed.query:
+        path += '?' + parsed.query
     return (host, port, ssl, path)
 
 
@@ -91,6 +115,8 @@ def _s2b(s):
 
 def get_header(headers, name, default=None):
     """Return a header value from a header list."""
+    if isinstance(headers, HttpHeaders):
+        return headers.get(name, default)
     name = name.lower()
     for header in headers:
         if header[0].lower() == name:
@@ -98,6 +124,163 @@ def get_header(headers, name, default=None):
     return default
 
 
+# Pre-encoded header names and status lines. Applications use a small set of
+# these, so caching them saves an encode per header. The caches are bounded
+# because both can be chosen freely by the application.
+_header_names = {}
+_status_lines = {}
+_max_cache_size = 1000
+
+
+# Header names as received, and the lower-case name and WSGI environ key for
+# a header name. Bounded like the caches above.
+_parsed_names = {}
+_header_keys = {}
+
+
+def _header_key(name):
+    """Return a (lower-case name, WSGI environ key) tuple for header *name*."""
+    key = _header_keys.get(name)
+    if key is None:
+        lname = name.lower()
+        if lname == 'content-length':
+            envkey = 'CONTENT_LENGTH'
+        elif lname == 'content-type':
+            envkey = 'CONTENT_TYPE'
+        else:
+            envkey = 'HTTP_' + name.upper().replace('-', '_')
+        key = (lname, envkey)
+        if len(_header_keys) < _max_cache_size:
+            _header_keys[name] = key
+    return key
+
+
+def _parse_name(data):
+    """Return the header name in the bytearray *data* as a str.
+
+    Names are cached, so that the common ones are decoded only once.
+    """
+    raw = bytes(data)
+    name = _parsed_names.get(raw)
+    if name is None:
+        name = _ba2str(data)
+        if len(_parsed_names) < _max_cache_size:
+            _parsed_names[raw] = name
+    return name
+
+
+class HttpHeaders(list):
+    """A list of (name, value) header tuples, with case-insensitive lookups.
+
+    The lookup index is built on the first call to :meth:`get`, and is kept
+    up to date as headers are appended. Headers should not be changed in
+    another way after a lookup was done.
+    """
+
+    __slots__ = ('_index', '_nindexed')
+
+    def __init__(self, *args):
+        super(HttpHeaders, self).__init__(*args)
+        self._index = {}
+        self._nindexed = 0
+
+    def get(self, name, default=None):
+        """Return the value of the first header *name*, or *default* if there
+        is no such header. The match is case-insensitive."""
+        index = self._index
+        if self._nindexed < len(self):
+            for hname,value in self[self._nindexed:]:
+                index.setdefault(_header_key(hname)[0], value)
+            self._nindexed = len(self)
+        return index.get(_header_key(name)[0], default)
+
+
+def _encode_headers(headers, lines):
+    """Encode a list of (name, value) *headers* and append them to the list
+    *lines* as bytes."""
+    for name,value in headers:
+        prefix = _header_names.get(name)
+        if prefix is None:
+            prefix = _s2b(name) + b': '
+            if len(_header_names) < _max_cache_size:
+                _header_names[name] = prefix
+        if not isinstance(value, (compat.binary_type, compat.text_type)):
+            value = str(value)
+        lines.append(prefix + _s2b(value) + b'\r\n')
+
+
+def _status_line(version, status):
+    """Return the status line for a response as bytes."""
+    key = (version, status)
+    line = _status_lines.get(key)
+    if line is None:
+        line = _s2b('HTTP/{0[0]}.{0[1]} {1}\r\n'.format(version, status))
+        if len(_status_lines) < _max_cache_size:
+            _status_lines[key] = line
+    return line
+
+
+def _is_compressible(ctype):
+    """Return whether a body with content type *ctype* should be compressed."""
+    if not ctype:
+        return False
+    ctype = ctype.split(';', 1)[0].strip().lower()
+    return ctype.startswith('text/') or ctype in compressible_types \
+                or ctype.endswith('+json') or ctype.endswith('+xml')
+
+
+def _accepts_gzip(value):
+    """Return whether the Accept-Encoding header *value* allows gzip."""
+    if not value:
+        return False
+    for coding in value.split(','):
+        coding, _, params = coding.partition(';')
+        if coding.strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                return float(params[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+class _Decoder(object):
+    """A streaming decoder for the gzip and deflate content encodings.
+
+    Deflate data should have a zlib header, but some servers send raw deflate
+    data. The two are told apart by the first two bytes of the body.
+    """
+
+    def __init__(self, encoding):
+        if encoding == 'deflate':
+            self._decompressor = None
+            self._head = b''
+        else:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        if self._decompressor is None:
+            data = self._head + data
+            if len(data) < 2:
+                self._head = data
+                return b''
+            cmf, flg = bytearray(data[:2])
+            if cmf & 0x0f == zlib.DEFLATED and (cmf*256 + flg) % 31 == 0:
+                wbits = zlib.MAX_WBITS
+            else:
+                wbits = -zlib.MAX_WBITS
+            self._decompressor = zlib.decompressobj(wbits)
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        if self._decompressor is None:
+            return b''  # less than two bytes of deflate data
+        return self._decompressor.flush()
+
+
 def create_chunk(buf):
     """Create a chunk for the HTTP "chunked" transfer encoding."""
     chunk = bytearray()
@@ -109,32 +292,28 @@ def create_chunk(buf):
 
 def last_chunk(trailers):
     """Return the last chunk."""
-    chunk = bytearray()
-    chunk.extend(b'0\r\n')
-    for name,value in trailers:
-        chunk.extend(_s2b('{0}: {1}\r\n'.format(name, value)))
-    chunk.extend(b'\r\n')
-    return chunk
+    if not trailers:
+        return b'0\r\n\r\n'
+    lines = [b'0\r\n']
+    _encode_headers(trailers, lines)
+    lines.append(b'\r\n')
+    return b''.join(lines)
 
 
 def create_request(method, url, headers):
     """Create a HTTP request message (no body). Always HTTP/1.1."""
-    message = bytearray()
-    message.extend(_s2b('{0} {1} HTTP/1.1\r\n'.format(method, url)))
-    for name,value in headers:
-        message.extend(_s2b('{0}: {1}\r\n'.format(name, value)))
-    message.extend(b'\r\n')
-    return message
+    lines = [_s2b('{0} {1} HTTP/1.1\r\n'.format(method, url))]
+    _encode_headers(headers, lines)
+    lines.append(b'\r\n')
+    return b''.join(lines)
 
 
 def create_response(version, status, headers):
     """Create a HTTP response message (no body)."""
-    message = bytearray()
-    message.extend(_s2b('HTTP/{0[0]}.{0[1]} {1}\r\n'.format(version, status)))
-    for name,value in headers:
-        message.extend(_s2b('{0}: {1}\r\n'.format(name, value)))
-    message.extend(b'\r\n')
-    return message
+    lines = [_status_line(version, status)]
+    _encode_headers(headers, lines)
+    lines.append(b'\r\n')
+    return b''.join(lines)
 
 
 def _ba2str(ba):
@@ -153,6 +332,19 @@ def _cp2str(cd):
     return s
 
 
+# Pre-populate the header name caches with the common names.
+for _name in ('Host', 'User-Agent', 'Accept', 'Accept-Encoding',
+              'Accept-Language', 'Connection', 'Content-Length',
+              'Content-Type', 'Cookie', 'Date', 'Server', 'Cache-Control',
+              'Transfer-Encoding', 'Referer', 'If-Modified-Since',
+              'If-None-Match', 'Location', 'Set-Cookie', 'Last-Modified',
+              'ETag', 'Expect', 'Content-Encoding', 'Keep-Alive'):
+    for _variant in (_name, _name.lower()):
+        _variant = _parse_name(_variant.encode('ascii'))
+        _header_key(_variant)
+del _name, _variant
+
+
 class HttpError(error.Error):
     """Exception that is raised in case of HTTP protocol errors."""
 
@@ -169,8 +361,8 @@ class HttpMessage(object):
         self.is_upgrade = None
         self.should_keep_alive = None
         self.parsed_url = None
-        self.headers = []
-        self.trailers = []
+        self.headers = HttpHeaders()
+        self.trailers = HttpHeaders()
         self.body = reader.Reader()
 
     def __len__(self):
@@ -190,12 +382,7 @@ class HttpMessage(object):
         env['PATH_INFO'] = self.parsed_url[0]
         env['QUERY_STRING'] = self.parsed_url[1]
         for field,value in self.headers:
-            if field.title() == 'Content-Length':
-                env['CONTENT_LENGTH'] = value
-            elif field.title() == 'Content-Type':
-                env['CONTENT_TYPE'] = value
-            else:
-                env['HTTP_{0}'.format(field.upper().replace('-', '_'))] = value
+            env[_header_key(field)[1]] = value
         env['wsgi.input'] = self.body
         return env
 
@@ -205,6 +392,13 @@ class HttpResponse(object):
 
     def __init__(self, message):
         self._message = message
+        self._on_close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     @property
     def version(self):
@@ -235,44 +429,86 @@ class HttpResponse(object):
         is returned."""
         return get_header(self._message.headers, name, default)
 
+    def close(self):
+        """Close the response.
+
+        For a response from :meth:`HttpConnectionPool.request`, this returns
+        its connection to the pool. If the response body was not received
+        completely, the connection is closed instead. A response can also be
+        used as a context manager that closes it on exit.
+        """
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            on_close()
+
     @switchpoint
     @docfrom(reader.Reader.read)
     def read(self, size=None):
         return self._message.body.read(size)
 
+    @switchpoint
+    @docfrom(reader.Reader.readinto)
+    def readinto(self, b):
+        return self._message.body.readinto(b)
+
+    @switchpoint
+    @docfrom(reader.Reader.readinto1)
+    def readinto1(self, b):
+        return self._message.body.readinto1(b)
+
     @switchpoint
     @docfrom(reader.Reader.readline)
     def readline(self, limit=-1):
         return self._message.body.readline(limit)
 
+    @switchpoint
+    @docfrom(reader.Reader.readuntil)
+    def readuntil(self, delim, limit=-1):
+        return self._message.body.readuntil(delim, limit)
+
     @switchpoint
     @docfrom(reader.Reader.readlines)
     def readlines(self, hint=-1):
         return self._message.body.readlines(hint)
 
-    @property
     def __iter__(self):
-        return self._mesasge.body.__iter__
+        return iter(self._message.body)
 
 
 class HttpParser(protocols.Parser):
     """A HTTP parser."""
 
-    s_header_field, s_header_value = range(2)
-
     HTTP_REQUEST = http_ffi.lib.HTTP_REQUEST
     HTTP_RESPONSE = http_ffi.lib.HTTP_RESPONSE
     HTTP_BOTH = http_ffi.lib.HTTP_BOTH
 
-    def __init__(self, kind=None):
+    def __init__(self, kind=None, spool_threshold=None, decompress=False):
+        """The *kind* argument specifies the type of messages to parse. The
+        optional *spool_threshold* argument specifies the size above which
+        request bodies are spooled to a temporary file. Bodies without a
+        Content-Length are always spooled if it is set. See
+        :class:`gruvi.reader.SpooledReader`.
+
+        If *decompress* is true, response bodies with a gzip or deflate
+        Content-Encoding are decompressed. The Content-Encoding and
+        Content-Length headers, which describe the encoded body, are then
+        removed from the response."""
         super(HttpParser, self).__init__()
         if kind is None:
             kind = self.HTTP_BOTH
         self._kind = kind
-        self._parser = http_ffi.ffi.new('http_parser *')
-        http_ffi.lib.http_parser_init(self._parser, self._kind)
+        self._spool_threshold = spool_threshold
+        self._decompress = decompress
+        self._decoder = None
+        state = http_ffi.lib.gruvi_parser_new(self._kind)
+        if state == http_ffi.ffi.NULL:
+            raise MemoryError
+        self._state = http_ffi.ffi.gc(state, http_ffi.lib.gruvi_parser_free)
+        self._parser = http_ffi.ffi.cast('http_parser *', self._state)
         self._setup_callbacks()
         self._requests = collections.deque()
+        self._message = None
+        self._data = None
 
     @property
     def requests(self):
@@ -284,8 +520,11 @@ class HttpParser(protocols.Parser):
         self._requests.append(method)
 
     def feed(self, s):
-        nbytes = http_ffi.lib.http_parser_execute(self._parser, self._settings,
-                                                  s, len(s))
+        self._data = s
+        try:
+            nbytes = http_ffi.lib.gruvi_parser_execute(self._state, s, len(s))
+        finally:
+            self._data = None
         self.bytes_parsed = nbytes
         if nbytes != len(s):
             errno = http_ffi.lib.http_errno(self._parser)
@@ -298,57 +537,34 @@ class HttpParser(protocols.Parser):
         return http_ffi.lib.http_body_is_final(self._parser)
 
     def _setup_callbacks(self):
-        settings = http_ffi.ffi.new('http_parser_settings *')
-        callback_refs = {}  # prevent garbage collection of cffi callbacks
-        names = [ name for name in dir(self) if name.startswith('_on_') ]
-        for name in names:
-            cbtype = 'http_cb' if 'complete' in name or 'begin' in name \
-                            else 'http_data_cb'
-            cb = http_ffi.ffi.callback(cbtype, getattr(self, name))
-            callback_refs[name] = cb
-            setattr(settings, name[1:], cb)
-        self._settings = settings
-        self._callback_refs = callback_refs
-
-    def _reinit(self):
-        self._url_data = bytearray()
-        self._header_state = self.s_header_field
-        self._header_name = None
-        self._header_data = bytearray()
-        self._message = HttpMessage()
-        self._headers_complete = False
-
-    def _on_message_begin(self, parser):
-        self._reinit()
-        return 0
-
-    def _on_url(self, parser, at, length):
-        buf = http_ffi.ffi.buffer(at, length)
-        self._url_data.extend(buf)
-        return 0
-
-    def _on_header_field(self, parser, at, length):
-        buf = http_ffi.ffi.buffer(at, length)
-        if self._header_state == self.s_header_field:
-            self._header_data.extend(buf)
-        else:
-            header_value = _ba2str(self._header_data)
-            dest = self._message.trailers if self._headers_complete \
-                        else self._message.headers
-            dest.append((self._header_name, header_value))
-            self._header_data[:] = buf
-            self._header_state = self.s_header_field
-        return 0
-
-    def _on_header_value(self, parser, at, length):
-        buf = http_ffi.ffi.buffer(at, length)
-        if self._header_state == self.s_header_value:
-            self._header_data.extend(buf)
-        else:
-            self._header_name = _ba2str(self._header_data)
-            self._header_data[:] = buf
-            self._header_state = self.s_header_value
-        return 0
+        # The URL and header callbacks are handled in C, see http_ffi.
+        ffi = http_ffi.ffi
+        self._callback_refs = (
+            ffi.callback('http_cb', self._on_headers_complete),
+            ffi.callback('gruvi_body_cb', self._on_body),
+            ffi.callback('http_cb', self._on_message_complete))
+        state = self._state
+        state.on_headers_complete, state.on_body, \
+                state.on_message_complete = self._callback_refs
+
+    def _get_headers(self, headers):
+        """Append the headers collected by the C parser to *headers*. Return
+        the data they were collected in, which starts with the URL."""
+        state = self._state
+        if not state.arena_len:
+            return b''
+        arena = http_ffi.ffi.buffer(state.arena, state.arena_len)[:]
+        nheaders = state.nheaders
+        if not nheaders:
+            return arena
+        offsets = struct.unpack('{0}I'.format(4*nheaders),
+                        http_ffi.ffi.buffer(state.headers, 16*nheaders)[:])
+        for i in range(0, 4*nheaders, 4):
+            name_off, name_len, value_off, value_len = offsets[i:i+4]
+            name = _parse_name(arena[name_off:name_off+name_len])
+            value = _ba2str(arena[value_off:value_off+value_len])
+            headers.append((name, value))
+        return arena
 
     def _parse_url(self, url):
         msg = self._message
@@ -360,7 +576,7 @@ class HttpParser(protocols.Parser):
             raise ValueError('url parse error')
         parsed_url = []
         for field in (http_ffi.lib.UF_PATH, http_ffi.lib.UF_QUERY):
-            if result.field_set & field:
+            if result.field_set & (1 << field):
                 data = result.field_data[field]
                 component = msg.url[data.off:data.off+data.len]
             else:
@@ -369,42 +585,70 @@ class HttpParser(protocols.Parser):
         return parsed_url
 
     def _on_headers_complete(self, parser):
-        if self._header_state == self.s_header_value:
-            header_value = _ba2str(self._header_data)
-            self._message.headers.append((self._header_name, header_value))
-            self._header_state = self.s_header_field
-            del self._header_data[:]
-        msg = self._message
+        self._message = msg = HttpMessage()
+        arena = self._get_headers(msg.headers)
         msg.message_type = http_ffi.lib.http_message_type(parser)
         msg.version = (parser.http_major, parser.http_minor)
         if msg.message_type == self.HTTP_REQUEST:
             msg.method = _cp2str(http_ffi.lib.http_method_str(parser.method))
-            msg.url = _ba2str(self._url_data)
+            url = arena[:self._state.url_len]
+            msg.url = _ba2str(url)
             try:
-                msg.parsed_url = self._parse_url(self._url_data)
+                msg.parsed_url = self._parse_url(url)
             except ValueError:
                 return 2
             msg.is_upgrade = http_ffi.lib.http_is_upgrade(parser)
+            if self._spool_threshold is not None \
+                        and self._should_spool(parser):
+                msg.body = reader.SpooledReader()
         else:
             msg.status_code = parser.status_code
+            if self._decompress:
+                encoding = msg.headers.get('Content-Encoding', '').lower()
+                if encoding in ('gzip', 'x-gzip', 'deflate'):
+                    self._decoder = _Decoder(encoding)
+                    encoded = ('content-encoding', 'content-length')
+                    msg.headers = HttpHeaders(h for h in msg.headers
+                                              if h[0].lower() not in encoded)
         msg.should_keep_alive = http_ffi.lib.http_should_keep_alive(parser)
         self._messages.append(msg)
-        self._headers_complete = True
+        status = msg.status_code
+        if msg.message_type == self.HTTP_RESPONSE \
+                    and 100 <= status < 200 and status != 101:
+            return 0  # interim response, the final one is still to come
         request_method = self._requests and self._requests.popleft()
         return 1 if request_method == 'HEAD' else 0
 
-    def _on_body(self, parser, at, length):
-        buf = http_ffi.ffi.buffer(at, length)[:]  # -> bytes
-        self._message.body._feed(buf)
+    def _should_spool(self, parser):
+        if http_ffi.lib.http_is_chunked(parser):
+            return True
+        # Newer http-parser versions use ULLONG_MAX for "no Content-Length"
+        clen = parser.content_length
+        return self._spool_threshold < clen < 0xffffffffffffffff
+
+    def _on_body(self, parser, offset, length):
+        data = self._data[offset:offset+length]
+        if self._decoder is not None:
+            try:
+                data = self._decoder.decompress(data)
+            except zlib.error:
+                return 1  # stops the parser with a callback error
+            if not data:
+                return 0  # an empty feed would be EOF
+        self._message.body._feed(data)
         return 0
 
     def _on_message_complete(self, parser):
-        if self._header_state == self.s_header_value:
-            # last trailer in a chunked messages
-            header_value = _ba2str(self._header_data)
-            dest = self._message.trailers if self._headers_complete \
-                        else self._message.headers
-            dest.append((self._header_name, header_value))
+        # Trailers of a chunked message.
+        self._get_headers(self._message.trailers)
+        if self._decoder is not None:
+            try:
+                data = self._decoder.flush()
+            except zlib.error:
+                return 1
+            self._decoder = None
+            if data:
+                self._message.body._feed(data)
         self._message.body._feed(b'')
         return 0
 
@@ -429,19 +673,102 @@ class ErrorStream(object):
             self.write(line)
 
 
+class FileWrapper(object):
+    """Passed to the WSGI application as environ['wsgi.file_wrapper'].
+
+    When a WSGI application returns a file wrapped in this class, the server
+    sends it with :func:`os.sendfile` if possible. The file is sent from its
+    current position until EOF, or up to the Content-Length if that header
+    was provided. Otherwise, the wrapper is an iterable of *blksize* blocks.
+    """
+
+    def __init__(self, file, blksize=8192):
+        self.file = file
+        self.blksize = blksize
+        if hasattr(file, 'close'):
+            self.close = file.close
+
+    def fileno(self):
+        """Return the file descriptor of the file, or None."""
+        try:
+            return self.file.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+
+    def __iter__(self):
+        while True:
+            data = self.file.read(self.blksize)
+            if not data:
+                break
+            yield data
+
+
+class _ContinueWaiter(object):
+    """Wait for the "100 Continue" or final response to a request with an
+    ``Expect: 100-continue`` header."""
+
+    __slots__ = ('_condition', '_response', '_earlier')
+
+    def __init__(self, earlier):
+        self._condition = Condition()
+        self._response = None
+        # The number of final responses that are due for earlier requests.
+        self._earlier = earlier
+
+    def add_response(self, message):
+        """Called for every response header that is received."""
+        status = message.status_code
+        if self._response is not None or 100 < status < 200 and status != 101:
+            return
+        if self._earlier:
+            if status != 100:
+                self._earlier -= 1
+            return
+        self._response = message
+        self._condition.notify()
+
+    @switchpoint
+    def wait(self, timeout):
+        """Return the response, or None if none arrived within *timeout*."""
+        if self._response is None:
+            self._condition.wait(timeout)
+        return self._response
+
+
 class HttpClient(protocols.RequestResponseProtocol):
     """An HTTP/1.1 client."""
 
     _exception = HttpError
     user_agent = 'gruvi.http/{0}'.format(__version__)
 
+    #: The maximum number of outstanding requests that
+    #: :meth:`request_async` pipelines on the connection.
+    max_pipeline_depth = 10
+
+    #: The size of the chunks in which a file-like request body is read.
+    chunk_size = 64*1024
+
+    #: The time to wait for a "100 Continue" response before a request body
+    #: is sent anyway.
+    continue_timeout = 1
+
+    #: Ask for gzip or deflate compressed responses, and decompress them. The
+    #: Content-Encoding and Content-Length headers are removed from
+    #: decompressed responses.
+    decompress = False
+
     def __init__(self, timeout=None):
         """The optional *timeout* argument can be used to specify a timeout for
         the various network operations used within the client."""
         def parser_factory():
-            return HttpParser(HttpParser.HTTP_RESPONSE)
+            return HttpParser(HttpParser.HTTP_RESPONSE,
+                              decompress=self.decompress)
         super(HttpClient, self).__init__(parser_factory, timeout=timeout)
         self._default_host = None
+        self._pipeline_pending = collections.deque()
+        self._pipeline_inflight = collections.deque()
+        self._pipeline_sending = False
+        self._pipeline_receiving = False
 
     transport = protocols.Protocol.transport  # Have Sphinx document it
 
@@ -457,8 +784,13 @@ class HttpClient(protocols.RequestResponseProtocol):
         super(HttpClient, self)._init_transport(transport)
         if hasattr(transport, 'nodelay'):
             transport.nodelay(True)
+        transport._continue = None
 
     def _dispatch_fast_path(self, transport, message):
+        if transport._continue is not None:
+            transport._continue.add_response(message)
+        if 100 <= message.status_code < 200 and message.status_code != 101:
+            return True  # interim response
         transport._queue.put(message)
         def on_size_change(oldsize, newsize):
             transport._queue._adjust_size(newsize-oldsize)
@@ -482,6 +814,14 @@ class HttpClient(protocols.RequestResponseProtocol):
         object, or an iterable producing ``bytes`` or ``str`` instances. See
         the notes at the top about the use of strings in HTTP bodies.
 
+        A file-like object is read in chunks of :attr:`chunk_size` bytes, and
+        both file-like objects and iterables are sent with the "chunked"
+        transfer encoding unless a "Content-Length" header is passed in.
+        Either way, the body is streamed with flow control, so it does not
+        need to fit in memory. If you pass an ``Expect: 100-continue`` header
+        with a non-empty body, the body is only sent after the server agrees,
+        or after :attr:`continue_timeout` seconds.
+
         This method sends the request and waits for it to be complete sent out.
         It does now however wait for the response. The response can be obtained
         using :meth:`getresponse`.
@@ -493,8 +833,15 @@ class HttpClient(protocols.RequestResponseProtocol):
         """
         if self._transport is None or self._transport.closed:
             raise RuntimeError('not connected')
-        if headers is None:
-            headers = []
+        headers = self._check_request(headers, body)
+        self._send_request(self._transport, method, url, headers, body)
+        self._flush(self._transport)
+
+    def _check_request(self, headers, body):
+        # Validate a request and return its headers with the defaults and the
+        # framing headers added. The caller's list is not modified, so that
+        # it can be reused for another request.
+        headers = list(headers) if headers else []
         for name,value in headers:
             if name in hop_by_hop:
                 raise ValueError('header {0} is hop-by-hop'.format(name))
@@ -504,28 +851,90 @@ class HttpClient(protocols.RequestResponseProtocol):
         host = get_header(headers, 'Host')
         if host is None and self._default_host:
             headers.append(('Host', self._default_host))
+        if self.decompress and get_header(headers, 'Accept-Encoding') is None:
+            headers.append(('Accept-Encoding', 'gzip, deflate'))
         if body is None:
-            body = b''
-        if not isinstance(body, (compat.binary_type, compat.text_type)) \
-                    and not hasattr(body, 'read') \
-                    and not hasattr(body, '__iter__'):
+            return headers
+        clen = get_header(headers, 'Content-Length')
+        if isinstance(body, (compat.binary_type, compat.text_type)):
+            if clen is None:
+                headers.append(('Content-Length', str(len(body))))
+        elif hasattr(body, 'read') or hasattr(body, '__iter__'):
+            if clen is None:
+                headers.append(('Transfer-Encoding', 'chunked'))
+        else:
             raise TypeError('body: expecting a bytes or str instance, ' \
                             'a file-like object, or an iterable')
+        return headers
+
+    @switchpoint
+    def _send_request(self, transport, method, url, headers, body):
+        # Write a request that passed _check_request(). The transport is not
+        # flushed, so that pipelined requests can share a flush. The request
+        # is pushed to the parser first, as a response may arrive before the
+        # body is written.
+        transport._parser.push_request(method)
         header = create_request(method, url, headers)
-        self._transport.write(header)
-        if hasattr(body, 'write'):
+        if body is None:
+            self._write(transport, header)
+            return
+        if isinstance(body, compat.text_type):
+            body = body.encode('iso-8859-1')
+        expect = get_header(headers, 'Expect', '').lower() == '100-continue'
+        if isinstance(body, compat.binary_type) and not (expect and body):
+            self._writelines(transport, [header, body])
+            return
+        if expect:
+            # Watch for the response before the header is written, so that
+            # an early response is not missed.
+            earlier = len(transport._parser.requests) - 1
+            transport._continue = _ContinueWaiter(earlier)
+        try:
+            self._write(transport, header)
+            if expect and not self._wait_continue(transport):
+                return
+        finally:
+            transport._continue = None
+        chunked = get_header(headers, 'Transfer-Encoding') == 'chunked'
+        if isinstance(body, compat.binary_type):
+            self._write(transport, body)
+        elif hasattr(body, 'read'):
             while True:
-                chunk = body.read(chunksize)
+                chunk = body.read(self.chunk_size)
                 if not chunk:
                     break
-                self._write(self._transport, chunk)
-        elif hasattr(body, '__iter__'):
+                self._write_body_chunk(transport, chunk, chunked)
+        else:
             for chunk in body:
-                self._write(self._transport, chunk)
+                if chunk:
+                    self._write_body_chunk(transport, chunk, chunked)
+        if chunked:
+            self._write(transport, last_chunk(None))
+
+    @switchpoint
+    def _write_body_chunk(self, transport, chunk, chunked):
+        if isinstance(chunk, compat.text_type):
+            chunk = chunk.encode('iso-8859-1')
+        if chunked:
+            self._writelines(transport, [_s2b('{0:X}\r\n'.format(len(chunk))),
+                                         chunk, b'\r\n'])
         else:
-            self._write(self._transport, body)
-        self._flush(self._transport)
-        self._transport._parser.push_request(method)
+            self._write(transport, chunk)
+
+    @switchpoint
+    def _wait_continue(self, transport):
+        # Flush the request header and wait for "100 Continue". Return
+        # whether the body should be sent. It is also sent if the server does
+        # not respond in time, as older servers do not know about 100-continue.
+        waiter = transport._continue
+        self._flush(transport)
+        response = waiter.wait(self.continue_timeout)
+        if response is None or response.status_code == 100:
+            return True
+        # A final response: the server does not want the body. As the request
+        # was not completed, the connection cannot be reused.
+        response.should_keep_alive = False
+        return False
 
     @switchpoint
     def getresponse(self):
@@ -543,9 +952,422 @@ class HttpClient(protocols.RequestResponseProtocol):
         if not self._transport._parser.requests and not self._transport._queue:
             raise RuntimeError('there are no outstanding requests')
         message = self._transport._queue.get()
+        if isinstance(message, Exception):
+            raise message
         response = HttpResponse(message)
         return response
 
+    def _close_transport(self, transport, error=None):
+        # Wake up the fiber that waits for a response that will not come.
+        parser = getattr(transport, '_parser', None)
+        if parser is not None and parser.requests:
+            if error is None:
+                error = HttpError(protocols.errno.FRAMING_ERROR,
+                                  'connection closed')
+            transport._queue.put(error)
+        super(HttpClient, self)._close_transport(transport, error)
+
+    @switchpoint
+    def request_async(self, method, url, headers=None, body=None):
+        """Make a new HTTP request, and return a :class:`HttpFuture` for its
+        response. The arguments are the same as for :meth:`request`.
+
+        Requests made with this method are pipelined automatically. Up to
+        :attr:`max_pipeline_depth` requests are outstanding on the connection
+        at any time. Only idempotent requests are pipelined: a request with
+        another method, for example ``'POST'``, is sent only after all earlier
+        responses have been received, and later requests wait for its
+        response.
+
+        The request may not be sent yet when this method returns. Responses
+        are received in a separate fiber, and delivered to the futures in the
+        order of the requests. Do not mix this method with :meth:`request`
+        and :meth:`getresponse` on the same connection.
+        """
+        if self._transport is None or self._transport.closed:
+            raise RuntimeError('not connected')
+        headers = self._check_request(headers, body)
+        future = HttpFuture((method, url, headers, body))
+        self._pipeline_pending.append(future)
+        self._send_pending(self._transport)
+        return future
+
+    @switchpoint
+    def fetch_many(self, requests):
+        """Make a pipelined request for each element in *requests*, and
+        return a list with the responses.
+
+        The elements in *requests* are tuples containing the arguments for
+        :meth:`request_async`. The requests are written to the connection
+        together as far as the pipeline allows. The response bodies are
+        buffered in memory until they are read.
+        """
+        if self._transport is None or self._transport.closed:
+            raise RuntimeError('not connected')
+        futures = []
+        for request in requests:
+            method, url = request[:2]
+            headers = request[2] if len(request) > 2 else None
+            body = request[3] if len(request) > 3 else None
+            headers = self._check_request(headers, body)
+            futures.append(HttpFuture((method, url, headers, body)))
+        self._pipeline_pending.extend(futures)
+        self._send_pending(self._transport)
+        return [future.result() for future in futures]
+
+    @switchpoint
+    def _send_pending(self, transport):
+        # Send as many queued requests as the pipeline allows, and flush them
+        # in one go. Only one fiber sends at a time so that requests do not
+        # interleave. It picks up requests that are queued while it writes.
+        if self._pipeline_sending:
+            return
+        pending, inflight = self._pipeline_pending, self._pipeline_inflight
+        self._pipeline_sending = True
+        try:
+            while True:
+                nsent = 0
+                while pending and len(inflight) < self.max_pipeline_depth:
+                    if inflight:
+                        last = inflight[-1]._request[0]
+                        method = pending[0]._request[0]
+                        if last not in idempotent_methods or \
+                                    method not in idempotent_methods:
+                            break
+                    future = pending.popleft()
+                    inflight.append(future)
+                    self._send_request(transport, *future._request)
+                    nsent += 1
+                if not nsent:
+                    break
+                self._flush(transport)
+        except Exception as e:
+            self._fail_pipeline(e)
+            raise
+        finally:
+            self._pipeline_sending = False
+        if inflight and not self._pipeline_receiving:
+            self._pipeline_receiving = True
+            self._spawn(self._receive_responses, transport)
+
+    def _receive_responses(self, transport):
+        # Deliver responses to the futures of the pipelined requests, in
+        # order. This runs in its own fiber while requests are outstanding.
+        inflight = self._pipeline_inflight
+        try:
+            while inflight:
+                message = transport._queue.get()
+                if isinstance(message, Exception):
+                    raise message
+                future = inflight.popleft()
+                future._set_result(HttpResponse(message))
+                if self._pipeline_pending:
+                    self._send_pending(transport)
+        except Exception as e:
+            self._fail_pipeline(e)
+        finally:
+            self._pipeline_receiving = False
+
+    def _fail_pipeline(self, error):
+        futures = list(self._pipeline_inflight) + list(self._pipeline_pending)
+        self._pipeline_inflight.clear()
+        self._pipeline_pending.clear()
+        for future in futures:
+            future._set_result(None, error)
+
+
+class HttpFuture(object):
+    """The future response of a request made with
+    :meth:`HttpClient.request_async`."""
+
+    def __init__(self, request):
+        self._request = request
+        self._response = None
+        self._error = None
+        self._done = False
+        self._condition = Condition()
+
+    def done(self):
+        """Return whether the response (or an error) is available."""
+        return self._done
+
+    def _set_result(self, response, error=None):
+        self._response = response
+        self._error = error
+        self._done = True
+        self._condition.notify(True)
+
+    @switchpoint
+    def result(self, timeout=None):
+        """Wait for the response header and return a :class:`HttpResponse`.
+
+        If the request failed, the exception is raised. A :class:`HttpError`
+        is raised if the response is not available within *timeout* seconds.
+        """
+        if not self._done and not self._condition.wait(timeout):
+            raise HttpError(protocols.errno.TIMEOUT,
+                            'timeout waiting for response')
+        if self._error is not None:
+            raise self._error
+        return self._response
+
+
+class HttpConnectionPool(object):
+    """A pool of keep-alive HTTP client connections.
+
+    The pool keeps idle connections per (host, port, ssl) tuple, and hands
+    them out to fibers that make requests. A connection is returned to the
+    pool as soon as its response has been received completely, and is closed
+    instead if the server did not keep it alive.
+    """
+
+    def __init__(self, max_connections_per_host=10, max_idle_time=60,
+                 timeout=None):
+        """The *max_connections_per_host* argument specifies the maximum
+        number of connections, idle or not, per (host, port, ssl) tuple.
+        Fibers that need a connection beyond that will wait until one is
+        returned to the pool.
+
+        Connections that are idle for more than *max_idle_time* seconds are
+        closed. The optional *timeout* argument is passed to the
+        :class:`HttpClient` instances, and also limits the time to wait for a
+        connection to become available.
+        """
+        self._hub = hub.get_hub()
+        self._max_connections_per_host = max_connections_per_host
+        self._max_idle_time = max_idle_time
+        self._timeout = timeout
+        self._idle = {}  # key -> [(client, idle_since)]
+        self._nconnections = {}  # key -> number of connections
+        self._available = Condition()
+        self._eviction = None
+        self._log = logging.get_logger(objref(self))
+        #: The number of requests that reused an idle connection.
+        self.hits = 0
+        #: The number of requests that needed a new connection.
+        self.misses = 0
+
+    @property
+    def max_connections_per_host(self):
+        """The maximum number of connections per host."""
+        return self._max_connections_per_host
+
+    @property
+    def max_idle_time(self):
+        """The time after which idle connections are closed."""
+        return self._max_idle_time
+
+    @switchpoint
+    def get_connection(self, host, port, ssl=False):
+        """Return a connected :class:`HttpClient` for (*host*, *port*, *ssl*).
+
+        An idle connection is used if one is available. Otherwise a new one is
+        made, if the connection limit allows it. If not, this method waits
+        until a connection is returned to the pool.
+
+        The connection must be given back with :meth:`release_connection`.
+        """
+        key = (host, port, ssl)
+        while True:
+            idle = self._idle.get(key)
+            while idle:
+                client, idle_since = idle.pop()
+                if not client.transport.closed:
+                    self.hits += 1
+                    return client
+                self._nconnections[key] -= 1
+            nconnections = self._nconnections.get(key, 0)
+            if nconnections < self._max_connections_per_host:
+                break
+            if not self._available.wait(self._timeout):
+                raise HttpError(protocols.errno.TIMEOUT,
+                                'timeout waiting for a connection')
+        self._nconnections[key] = nconnections + 1
+        self.misses += 1
+        client = HttpClient(self._timeout)
+        try:
+            client.connect((host, port), ssl)
+        except Exception:
+            self._nconnections[key] -= 1
+            self._available.notify(key)
+            raise
+        client._pool_key = key
+        return client
+
+    def release_connection(self, client, reuse=True):
+        """Return the connection *client* to the pool.
+
+        If *reuse* is false, or if the connection was closed, it is closed and
+        removed from the pool instead.
+        """
+        key = client._pool_key
+        transport = client.transport
+        if reuse and not transport.closed:
+            idle = self._idle.setdefault(key, [])
+            idle.append((client, self._hub.loop.now()))
+            if self._eviction is None:
+                self._eviction = self._hub.call_later(self._max_idle_time,
+                                                      self._evict_idle)
+        else:
+            if not transport.closed:
+                transport.close()
+            self._nconnections[key] -= 1
+        self._available.notify(key)
+
+    def _evict_idle(self):
+        # Close connections that have been idle for too long. This runs as a
+        # hub callback, so it closes the transports directly.
+        self._eviction = None
+        deadline = self._hub.loop.now() - int(self._max_idle_time * 1000)
+        pending = False
+        for key, idle in self._idle.items():
+            keep = []
+            for client, idle_since in idle:
+                if idle_since > deadline and not client.transport.closed:
+                    keep.append((client, idle_since))
+                    continue
+                if not client.transport.closed:
+                    client.transport.close()
+                self._nconnections[key] -= 1
+            idle[:] = keep
+            pending = pending or bool(keep)
+        if pending:
+            self._eviction = self._hub.call_later(self._max_idle_time,
+                                                  self._evict_idle)
+
+    @switchpoint
+    def request(self, method, url, headers=None, body=None):
+        """Make an HTTP request to the absolute URL *url*, and return the
+        :class:`HttpResponse`.
+
+        The connection is taken from the pool, and is released when the
+        entire response body has been received, or when the response is
+        closed with :meth:`HttpResponse.close`. Close responses whose body is
+        not read, otherwise their connection is not returned to the pool. See
+        :meth:`HttpClient.request` for the other arguments.
+        """
+        host, port, ssl, path = geturlinfo(url)
+        client = self.get_connection(host, port, ssl)
+        try:
+            client.request(method, path, headers, body)
+            response = client.getresponse()
+        except Exception:
+            self.release_connection(client, reuse=False)
+            raise
+        message = response._message
+        def release():
+            # Called once, at EOF or by response.close(). A connection with
+            # an incomplete response cannot be reused.
+            message.body._on_eof = response._on_close = None
+            reuse = message.body._eof and message.should_keep_alive
+            self.release_connection(client, reuse)
+        if message.body._eof:
+            release()
+        else:
+            message.body._on_eof = response._on_close = release
+        return response
+
+    def close(self):
+        """Close all idle connections."""
+        for key, idle in self._idle.items():
+            for client, idle_since in idle:
+                if not client.transport.closed:
+                    client.transport.close()
+                self._nconnections[key] -= 1
+            del idle[:]
+        if self._eviction is not None:
+            self._eviction.cancel()
+            self._eviction = None
+
+
+class _ServerResponse(object):
+    """The state of a single response on a server connection."""
+
+    __slots__ = ('version', 'status', 'headers', 'trailers', 'headers_sent',
+                 'chunked', 'keepalive', 'buffer', 'done', 'error', 'head',
+                 'accept_gzip', 'compress', 'compressor')
+
+    def __init__(self, version, keepalive):
+        self.version = version
+        self.status = None
+        self.headers = []
+        self.trailers = []
+        self.headers_sent = False
+        self.chunked = None
+        self.keepalive = keepalive
+        self.buffer = []
+        self.done = False
+        self.error = None
+        self.head = False
+        self.accept_gzip = False
+        self.compress = None
+        self.compressor = None
+
+
+class HttpResponseWriter(object):
+    """The response writer that is passed to a native :class:`HttpServer`
+    handler."""
+
+    __slots__ = ('_server', '_transport', '_response')
+
+    def __init__(self, server, transport, response):
+        self._server = server
+        self._transport = transport
+        self._response = response
+
+    @property
+    def headers_sent(self):
+        """Whether the response header has been sent."""
+        return self._response.headers_sent
+
+    @property
+    def done(self):
+        """Whether the response is complete."""
+        return self._response.done
+
+    def start(self, status, headers=()):
+        """Start the response.
+
+        The *status* argument is an integer status code, or a WSGI style
+        status string such as ``'200 OK'``. The *headers* argument is a list
+        of (name, value) pairs. Like with WSGI, hop-by-hop headers are not
+        allowed. The header is sent together with the first body data.
+        """
+        if not isinstance(status, compat.string_types):
+            reason = _responses.get(status, 'Unknown')
+            status = '{0} {1}'.format(status, reason)
+        self._server._start_response(self._transport, self._response, status,
+                                     list(headers))
+
+    @switchpoint
+    def write(self, data):
+        """Write *data* to the response body."""
+        response = self._response
+        if response.done:
+            raise RuntimeError('response already finished')
+        if response.status is None:
+            raise RuntimeError('response not started')
+        self._server._write_response(self._transport, response, [data])
+
+    @switchpoint
+    def finish(self, data=None):
+        """Finish the response, optionally writing *data* first.
+
+        If the response was not started yet and *data* is provided, a
+        Content-Length header is added, so that the response does not need
+        chunked encoding.
+        """
+        response = self._response
+        if response.done:
+            raise RuntimeError('response already finished')
+        if response.status is None:
+            raise RuntimeError('response not started')
+        if data and not response.headers_sent \
+                    and get_header(response.headers, 'Content-Length') is None:
+            response.headers.append(('Content-Length', str(len(data))))
+        chunks = [data] if data else []
+        self._server._write_response(self._transport, response, chunks, True)
+
 
 class HttpServer(protocols.RequestResponseProtocol):
     """An HTTP 1/1. server."""
@@ -553,11 +1375,32 @@ class HttpServer(protocols.RequestResponseProtocol):
     _exception = HttpError
     server_id = 'gruvi.http/{0}'.format(__version__)
 
-    def __init__(self, wsgi_handler, server_name=None, timeout=None):
+    #: Handle pipelined requests on a connection concurrently, each in its own
+    #: fiber. The responses are still sent in the order of the requests. The
+    #: output of a response that is produced before the responses in front of
+    #: it are complete, is buffered in memory.
+    concurrent_pipelining = False
+
+    #: The maximum number of pipelined requests on a connection that are
+    #: handled concurrently. When it is reached, no more requests are read
+    #: from the connection until the oldest response is complete.
+    max_pipeline_size = 16
+
+    #: The zlib compression level for compressed responses.
+    compress_level = 6
+
+    def __init__(self, wsgi_handler, server_name=None, timeout=None,
+                 spool_threshold=None, compress_threshold=None, native=False):
         """The constructor takes the following arugments.  The *wsgi_handler*
         argument must be a WSGI callable. See `PEP 333
         <http://www.python.org/dev/peps/pep-0333/>`_.
 
+        If *native* is true, *wsgi_handler* is instead called as
+        ``handler(request, response)``, where *request* is the parsed
+        :class:`HttpMessage` and *response* a :class:`HttpResponseWriter`.
+        This avoids the construction of a WSGI environ for each request. The
+        response is finished automatically when the handler returns.
+
         The optional *server_name* argument can be used to specify a server
         name. This might be needed by the WSGI application to construct
         absolute URLs. If not provided, then the host portion of the address
@@ -565,12 +1408,31 @@ class HttpServer(protocols.RequestResponseProtocol):
 
         The optional *timeout* argument can be used to specify a timeout for
         the various network operations used within the server.
+
+        The optional *spool_threshold* argument enables spooling of request
+        bodies that are larger than this many bytes, or that use chunked
+        encoding, to a temporary file. The entire body is received before
+        ``wsgi.input`` returns any data, and ``wsgi.input`` is then a seekable,
+        memory mapped file. This keeps memory usage low for large uploads.
+        Note that the file is written from the event loop, see
+        :class:`gruvi.reader.SpooledReader`.
+
+        The optional *compress_threshold* argument enables gzip compression
+        of responses for clients that accept it. A response is compressed if
+        it has a text or other compressible content type, no Content-Encoding,
+        and a Content-Length of at least this many bytes. Responses without a
+        Content-Length are streamed, and are always compressed.
         """
         def parser_factory():
-            return HttpParser(HttpParser.HTTP_REQUEST)
+            return HttpParser(HttpParser.HTTP_REQUEST, spool_threshold)
         super(HttpServer, self).__init__(parser_factory, timeout)
+        self._compress_threshold = compress_threshold
         self._wsgi_handler = wsgi_handler
+        self._native = native
         self._server_name = server_name
+        self._server_line = (None, None)
+        self._date_line = None
+        self._date_timer = None
 
     transport = protocols.Protocol.transport  # Have Sphinx document it
 
@@ -585,20 +1447,27 @@ class HttpServer(protocols.RequestResponseProtocol):
     def listen(self, address, ssl=False, **transport_args):
         self._listen(address, ssl, **transport_args)
 
+    @docfrom(protocols.Protocol._add_worker)
+    def add_worker(self, protocol):
+        self._add_worker(protocol)
+
+    @switchpoint
+    @docfrom(protocols.Protocol.close)
+    def close(self):
+        if self._date_timer is not None:
+            if not self._date_timer.closed:
+                self._date_timer.close()
+            self._date_timer = None
+        super(HttpServer, self).close()
+
     def _init_transport(self, transport):
         super(HttpServer, self)._init_transport(transport)
         if hasattr(transport, 'nodelay'):
             transport.nodelay(True)
-        self._reinit_request(transport)
-
-    def _reinit_request(self, transport):
-        transport._version = None
-        transport._status = None
-        transport._headers = []
-        transport._trailers = []
-        transport._headers_sent = False
-        transport._chunked = None
-        transport._keepalive = None
+        transport._responses = collections.deque()
+        transport._response_done = Condition()
+        transport._flushing = False
+        transport._close_when_done = False
 
     def _dispatch_fast_path(self, transport, message):
         def on_size_change(oldsize, newsize):
@@ -607,13 +1476,25 @@ class HttpServer(protocols.RequestResponseProtocol):
         return False
 
     def _close_transport(self, transport, error=None):
-        if not transport.closed and not transport._headers_sent and error:
-            transport._status = '500 Internal Server Error'
-            transport._headers = [('Content-Type', 'text/plain')]
-            transport._chunked = False
-            transport._keepalive = False
-            self._write(transport, 'Internal Server Error ({0})'
-                                        .format(error.args[0]))
+        responses = getattr(transport, '_responses', None)
+        if not transport.closed and responses:
+            if not error:
+                # EOF while requests are still being handled. Close the
+                # connection once their responses are written.
+                transport._close_when_done = True
+                return
+            response = responses[0]
+            if not response.headers_sent:
+                body = 'Internal Server Error ({0})'.format(error.args[0])
+                body = body.encode('iso-8859-1')
+                response.status = '500 Internal Server Error'
+                response.compress = False
+                response.headers = [('Content-Type', 'text/plain'),
+                                    ('Content-Length', str(len(body)))]
+                response.keepalive = False
+                transport.write(self._create_header(response) + body)
+            responses.clear()
+            transport._response_done.notify()
         super(HttpServer, self)._close_transport(transport)
 
     def _get_environ(self, transport, message):
@@ -626,88 +1507,611 @@ class HttpServer(protocols.RequestResponseProtocol):
         env['wsgi.multithread'] = True
         env['wsgi.multiprocess'] = True
         env['wsgi.run_once'] = False
+        env['wsgi.file_wrapper'] = FileWrapper
         return env
 
-    def _send_headers(self, transport):
-        clen = get_header(transport._headers, 'Content-Length')
-        transport._chunked = clen is None and transport._version == (1, 1)
-        if transport._chunked:
-            transport._headers.append(('Transfer-Encoding', 'chunked'))
-        if not clen and transport._version == (1, 0):
-            transport._keepalive = False
-        if transport._version == (1, 1) and not transport._keepalive:
-            transport._headers.append(('Connection', 'close'))
-        elif transport._version == (1, 0) and transport._keepalive:
-            transport._headers.append(('Connection', 'keep-alive'))
-        server = get_header(transport._headers, 'Server')
-        if server is None:
-            transport._headers.append(('Server', self.server_id))
-        header = create_response(transport._version, transport._status,
-                                 transport._headers)
-        transport.write(header)
-        transport._headers_sent = True
+    def _create_header(self, response):
+        # Scan the application's headers once for the ones that the server
+        # needs to know about, and add the others as pre-encoded bytes.
+        clen = None
+        server = date = False
+        for name,value in response.headers:
+            lname = name.lower()
+            if lname == 'content-length':
+                clen = value
+            elif lname == 'server':
+                server = True
+            elif lname == 'date':
+                date = True
+        lines = [_status_line(response.version, response.status)]
+        if self._should_compress(response):
+            response.compressor = zlib.compressobj(self.compress_level,
+                                        zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            _encode_headers([h for h in response.headers
+                             if h[0].lower() != 'content-length'], lines)
+            lines.append(b'Content-Encoding: gzip\r\n')
+            lines.append(b'Vary: Accept-Encoding\r\n')
+            clen = None
+        else:
+            _encode_headers(response.headers, lines)
+        response.chunked = clen is None and response.version == (1, 1)
+        if response.chunked:
+            lines.append(b'Transfer-Encoding: chunked\r\n')
+        if not clen and response.version == (1, 0):
+            response.keepalive = False
+        if response.version == (1, 1) and not response.keepalive:
+            lines.append(b'Connection: close\r\n')
+        elif response.version == (1, 0) and response.keepalive:
+            lines.append(b'Connection: keep-alive\r\n')
+        if not server:
+            if self._server_line[0] != self.server_id:
+                line = _s2b('Server: {0}\r\n'.format(self.server_id))
+                self._server_line = (self.server_id, line)
+            lines.append(self._server_line[1])
+        if not date:
+            if self._date_timer is None or self._date_timer.closed:
+                # The timer may have been closed by a loop.walk()
+                self._start_date_timer()
+            lines.append(self._date_line)
+        lines.append(b'\r\n')
+        response.headers_sent = True
+        return b''.join(lines)
+
+    def _should_compress(self, response):
+        # Decide once whether the body of *response* is gzip compressed.
+        if response.compress is not None:
+            return response.compress
+        response.compress = False
+        if not response.accept_gzip or response.status[:3] in ('204', '304'):
+            return False
+        ctype = clen = None
+        for name,value in response.headers:
+            lname = name.lower()
+            if lname == 'content-encoding':
+                return False
+            elif lname == 'content-type':
+                ctype = value
+            elif lname == 'content-length':
+                clen = value
+        try:
+            if clen is not None and int(clen) < self._compress_threshold:
+                return False
+        except ValueError:
+            return False
+        response.compress = _is_compressible(ctype)
+        return response.compress
+
+    def _start_date_timer(self):
+        # The Date header has a resolution of one second. Format it once per
+        # second from a timer rather than once per response. The timer does
+        # not keep the loop alive.
+        self._update_date_line()
+        self._date_timer = pyuv.Timer(self._hub.loop)
+        self._date_timer.start(self._update_date_line, 1, 1)
+        self._date_timer.ref = False
+
+    def _update_date_line(self, timer=None):
+        date = formatdate(time.time(), usegmt=True)
+        self._date_line = _s2b('Date: {0}\r\n'.format(date))
+
+    def _is_writer(self, transport, response):
+        # Only the response at the head of the queue may write directly to
+        # the transport, and only if no buffered output is being written.
+        responses = transport._responses
+        return bool(responses) and responses[0] is response \
+                    and not transport._flushing
 
     @switchpoint
-    def _write(self, transport, data, last=False):
-        if isinstance(data, compat.text_type):
-            data = data.encode('iso-8859-1')
-        elif not isinstance(data, compat.binary_type):
-            raise TypeError('data: expecting bytes or str instance')
-        if not data and not last:
+    def _write_response(self, transport, response, chunks, last=False):
+        # Frame the body chunks in *chunks* for *response*, and write them
+        # together with the header (if not yet sent) in a single write.
+        body = []
+        for data in chunks:
+            if isinstance(data, compat.text_type):
+                data = data.encode('iso-8859-1')
+            elif not isinstance(data, compat.binary_type):
+                raise TypeError('data: expecting bytes or str instance')
+            if data:
+                body.append(data)
+        if not body and not last:
             return
         if transport._error:
             raise transport._error
-        if not transport._headers_sent:
-            self._send_headers(transport)
-        if transport._chunked:
-            if data:
-                data = create_chunk(data)
+        lines = []
+        if not response.headers_sent:
+            lines.append(self._create_header(response))
+        if response.compressor is not None:
+            # A sync flush makes zlib emit all the data it has, so that a
+            # streamed response doesn't stay buffered in the compressor.
+            body = [response.compressor.compress(data) for data in body]
+            if last:
+                body.append(response.compressor.flush())
+            elif body:
+                body.append(response.compressor.flush(zlib.Z_SYNC_FLUSH))
+            body = [data for data in body if data]
+            if not lines and not body and not last:
+                return
+        if response.head:
+            pass  # the body of a HEAD response is not sent
+        elif response.chunked:
+            for data in body:
+                lines.append(_s2b('{0:X}\r\n'.format(len(data))))
+                lines.append(data)
+                lines.append(b'\r\n')
+            if last:
+                lines.append(last_chunk(response.trailers))
+        else:
+            lines.extend(body)
+        if last:
+            response.done = True
+        if self._is_writer(transport, response):
+            self._writelines(transport, lines)
             if last:
-                data += last_chunk(transport._trailers)
-        super(HttpServer, self)._write(transport, data)
+                self._finish_responses(transport)
+        else:
+            response.buffer.extend(lines)
+
+    @switchpoint
+    def _finish_responses(self, transport):
+        """Retire finished responses at the head of the queue, and write out
+        the buffered output of the responses that follow them."""
+        responses = transport._responses
+        transport._flushing = True
+        try:
+            while responses and not transport.closed:
+                response = responses[0]
+                while response.buffer:
+                    lines, response.buffer = response.buffer, []
+                    self._writelines(transport, lines)
+                if response.error:
+                    self._close_transport(transport, response.error)
+                    break
+                if not response.done:
+                    break
+                responses.popleft()
+                transport._response_done.notify()
+                transport._log.info('response: {0}', response.status)
+                if not response.keepalive:
+                    self._flush(transport)
+                    responses.clear()
+                    self._close_transport(transport)
+                    break
+                transport._log.debug('keeping connection alive')
+            else:
+                if transport._close_when_done and not transport.closed:
+                    self._flush(transport)
+                    self._close_transport(transport)
+        finally:
+            transport._flushing = False
 
-    def _start_response(self, transport, status, headers, exc_info=None):
+    @switchpoint
+    def _send_file_wrapper(self, transport, response, wrapper):
+        # Send the body of a response from a FileWrapper with sendfile().
+        fd = wrapper.fileno()
+        offset = wrapper.file.tell()
+        size = max(0, os.fstat(fd).st_size - offset)
+        clen = get_header(response.headers, 'Content-Length')
+        if clen is not None:
+            # A short body would leave the connection out of sync. Raising
+            # here closes it instead.
+            if int(clen) > size:
+                raise RuntimeError('file is shorter than Content-Length')
+            size = int(clen)
+        lines = []
+        if not response.headers_sent:
+            lines.append(self._create_header(response))
+        if response.chunked and size:
+            lines.append(_s2b('{0:X}\r\n'.format(size)))
+        self._writelines(transport, lines)
+        sent = self._sendfile(transport, fd, offset, size)
+        if sent != size:
+            raise RuntimeError('file was truncated')
+        wrapper.file.seek(offset + sent)
+        if response.chunked and size:
+            self._write(transport, b'\r\n')
+        self._write_response(transport, response, [], last=True)
+
+    def _start_response(self, transport, response, status, headers,
+                        exc_info=None):
         if exc_info:
             try:
-                if transport._headers_sent:
+                if response.headers_sent:
                     compat.reraise(*exc_info)
             finally:
                 exc_info = None
-        elif transport._status is not None:
+        elif response.status is not None:
             raise RuntimeError('response already started')
         for name,value in headers:
             if name in hop_by_hop:
                 raise ValueError('header {0} is hop-by-hop'.format(name))
-        transport._status = status
-        transport._headers = headers
+        response.status = status
+        response.headers = headers
         def write(data):
-            return self._write(transport, data, last=False)
+            return self._write_response(transport, response, [data])
         return write
 
     def _dispatch_message(self, transport, message):
+        if transport.closed:
+            return
         transport._log.info('request: {0} {1}', message.method, message.url)
-        transport._version = message.version
-        transport._keepalive = message.should_keep_alive
+        response = _ServerResponse(message.version, message.should_keep_alive)
+        response.head = message.method == 'HEAD'
+        transport._responses.append(response)
+        if self._compress_threshold is not None and message.method != 'HEAD':
+            encodings = message.headers.get('Accept-Encoding')
+            response.accept_gzip = _accepts_gzip(encodings)
+        expect = message.headers.get('Expect', '').lower()
+        if expect == '100-continue' and message.version == (1, 1) \
+                    and len(transport._responses) == 1:
+            # Tell the client to send the body. If earlier responses are
+            # still pending, the client sends it after its timeout instead.
+            self._write(transport, b'HTTP/1.1 100 Continue\r\n\r\n')
+        if self.concurrent_pipelining:
+            self._spawn(self._handle_request, transport, response, message)
+            if len(transport._responses) >= self.max_pipeline_size:
+                self._wait_pipeline(transport, message)
+        else:
+            self._handle_request(transport, response, message)
+            self._flush(transport)
+
+    @switchpoint
+    def _wait_pipeline(self, transport, message):
+        # Wait until fewer than max_pipeline_size requests are in flight.
+        # Reading is stopped meanwhile, so that no more requests are parsed.
+        # The exception is when the body of *message* is still incomplete, as
+        # its handler needs it to finish.
+        paused = message.body._eof
+        if paused:
+            transport.stop_read()
+        responses = transport._responses
+        while len(responses) >= self.max_pipeline_size \
+                    and not transport.closed:
+            transport._response_done.wait()
+        if not paused or transport.closed:
+            return
+        # Reading may also be stopped by the flow control of the queue.
+        if self.max_buffer_size is None \
+                    or transport._queue.qsize() < self.max_buffer_size:
+            transport.start_read(self._on_transport_readable)
+
+    def _handle_request(self, transport, response, message):
+        try:
+            self._respond(transport, response, message)
+        except Exception as e:
+            if not self.concurrent_pipelining:
+                raise  # handled by the dispatcher
+            # The error is handled when the response reaches the head of the
+            # queue, so that the responses before it are still sent.
+            transport._log.exception('exception in handler')
+            response.error = self._exception(protocols.errno.HANDLER_ERROR,
+                                             str(e))
+            if self._is_writer(transport, response):
+                self._finish_responses(transport)
+        finally:
+            if isinstance(message.body, reader.SpooledReader):
+                message.body.close()
+
+    def _respond(self, transport, response, message):
+        # Produce the response to *message* by calling the WSGI application,
+        # or the native handler.
+        if self._native:
+            writer = HttpResponseWriter(self, transport, response)
+            self._wsgi_handler(message, writer)
+            if not response.done:
+                writer.finish()
+            return
         environ = self._get_environ(transport, message)
         def start_response(status, headers, exc_info=None):
-            return self._start_response(transport, status, headers, exc_info)
+            return self._start_response(transport, response, status, headers,
+                                        exc_info)
         result = self._wsgi_handler(environ, start_response)
         try:
-            if not transport._status:
+            if not response.status:
                 raise RuntimeError('start_response() not called')
-            for chunk in result:
-                if transport.closed:
-                    break
-                if chunk:
-                    self._write(transport, chunk)
-            self._write(transport, b'', last=True)
-            self._flush(transport)
+            if isinstance(result, FileWrapper) \
+                    and result.fileno() is not None \
+                    and self._is_writer(transport, response) \
+                    and not self._should_compress(response) \
+                    and not response.head:
+                self._send_file_wrapper(transport, response, result)
+            elif isinstance(result, (list, tuple)):
+                # The entire body is available: write it in one go.
+                self._write_response(transport, response, result, True)
+            else:
+                for chunk in result:
+                    if transport.closed:
+                        break
+                    if chunk:
+                        self._write_response(transport, response, [chunk])
+                self._write_response(transport, response, [], last=True)
         finally:
             if hasattr(result, 'close'):
                 result.close()
-        transport._log.info('response: {0}', transport._status)
-        if transport._keepalive:
-            transport._log.debug('keeping connection alive')
-            self._reinit_request(transport)
+
+
+class HttpProxy(HttpServer):
+    """A reverse HTTP proxy.
+
+    The proxy forwards requests to one of a list of backend servers, and
+    sends back their responses. Request and response bodies are streamed in
+    both directions with flow control, so messages do not need to fit in
+    memory. Connections to the backends are kept alive in a
+    :class:`HttpConnectionPool`.
+    """
+
+    #: The size of the chunks in which response bodies are forwarded.
+    chunk_size = 64*1024
+
+    def __init__(self, backends, balance='round-robin', server_name=None,
+                 timeout=None, max_connections_per_backend=10):
+        """The *backends* argument is a list of ``(host, port)`` or ``(host,
+        port, ssl)`` tuples.
+
+        The *balance* argument specifies how a backend is selected for a
+        request. It can be ``'round-robin'``, or ``'least-connections'`` to
+        select the backend with the fewest requests in progress.
+
+        The *server_name* and *timeout* arguments are passed to
+        :class:`HttpServer`. The *max_connections_per_backend* argument
+        limits the number of connections to each backend.
+        """
+        if balance not in ('round-robin', 'least-connections'):
+            raise ValueError('unknown balance method: {0}'.format(balance))
+        if not backends:
+            raise ValueError('at least one backend is required')
+        super(HttpProxy, self).__init__(None, server_name, timeout)
+        self._backends = [tuple(backend) + (False,) * (3 - len(backend))
+                          for backend in backends]
+        self._balance = balance
+        self._next_backend = 0
+        self._active = [0] * len(self._backends)
+        self._pool = HttpConnectionPool(max_connections_per_backend,
+                                        timeout=timeout)
+
+    @switchpoint
+    @docfrom(protocols.Protocol.close)
+    def close(self):
+        self._pool.close()
+        super(HttpProxy, self).close()
+
+    @property
+    def pool(self):
+        """The :class:`HttpConnectionPool` with the backend connections."""
+        return self._pool
+
+    def _select_backend(self):
+        # Return the index of the backend for the next request.
+        if self._balance == 'least-connections':
+            return self._active.index(min(self._active))
+        index = self._next_backend
+        self._next_backend = (index + 1) % len(self._backends)
+        return index
+
+    def _forward_headers(self, headers):
+        # Return *headers* without the hop-by-hop headers, including those
+        # named in the Connection header.
+        connection = headers.get('Connection', '')
+        drop = set(name.strip().lower() for name in connection.split(','))
+        drop.update(_hop_by_hop_lower)
+        return [(name, value) for name,value in headers
+                if name.lower() not in drop]
+
+    def _respond(self, transport, response, message):
+        headers = self._forward_headers(message.headers)
+        try:
+            peer = transport.getpeername()[0]
+        except (AttributeError, pyuv.error.UVError):
+            peer = None  # not a TCP transport
+        if peer:
+            forwarded = message.headers.get('X-Forwarded-For')
+            peer = '{0}, {1}'.format(forwarded, peer) if forwarded else peer
+            headers = [h for h in headers
+                       if h[0].lower() != 'x-forwarded-for']
+            headers.append(('X-Forwarded-For', peer))
+        # Stream the request body. A body without a Content-Length is
+        # forwarded with chunked encoding.
+        if message.headers.get('Content-Length', '0') != '0' \
+                    or message.headers.get('Transfer-Encoding'):
+            body = message.body
+        else:
+            body = None
+        index = self._select_backend()
+        host, port, ssl = self._backends[index]
+        self._active[index] += 1
+        try:
+            self._forward(transport, response, message, headers, body,
+                          host, port, ssl)
+        finally:
+            self._active[index] -= 1
+
+    def _bad_gateway(self, transport, response):
+        response.status = '502 Bad Gateway'
+        response.headers = [('Content-Type', 'text/plain'),
+                            ('Content-Length', '11')]
+        self._write_response(transport, response, [b'Bad Gateway'], True)
+
+    def _forward(self, transport, response, message, headers, body, host,
+                 port, ssl):
+        try:
+            client = self._pool.get_connection(host, port, ssl)
+        except error.Error as e:
+            transport._log.error('cannot connect to backend: {0!s}', e)
+            self._bad_gateway(transport, response)
+            return
+        reuse = False
+        try:
+            try:
+                client.request(message.method, message.url, headers, body)
+                backend = client.getresponse()
+            except error.Error as e:
+                transport._log.error('backend request failed: {0!s}', e)
+                self._bad_gateway(transport, response)
+                return
+            reason = _responses.get(backend.status, 'Unknown')
+            response.status = '{0} {1}'.format(backend.status, reason)
+            response.headers = self._forward_headers(backend.headers)
+            while True:
+                chunk = backend.read(self.chunk_size)
+                if not chunk:
+                    break
+                self._write_response(transport, response, [chunk])
+            response.trailers = backend.trailers
+            self._write_response(transport, response, [], last=True)
+            reuse = backend._message.should_keep_alive
+        finally:
+            self._pool.release_connection(client, reuse)
+
+
+class _RouteNode(object):
+    """A node in the path trie of a :class:`HttpRouter`."""
+
+    __slots__ = ('children', 'param', 'param_name', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        self.param = None
+        self.param_name = None
+        self.handlers = {}
+
+
+class HttpRouter(object):
+    """Dispatch requests to handlers based on their method and path.
+
+    Routes are added with :meth:`add_route`. The path templates are compiled
+    into a trie with one level per path segment. Finding the handler for a
+    request takes time proportional to the number of segments in its path,
+    independent of the number of routes.
+
+    A router is a WSGI application. If *native* is true, it is instead a
+    native handler for an :class:`HttpServer` that was created with
+    ``native=True``.
+    """
+
+    def __init__(self, native=False):
+        self._root = _RouteNode()
+        self._native = native
+
+    def add_route(self, method, template, handler):
+        """Add a route.
+
+        The *method* argument is a HTTP method, or ``None`` to match any
+        method. A ``GET`` route also matches ``HEAD`` requests, unless a
+        separate ``HEAD`` route exists.
+
+        The *template* argument is a path such as ``'/users/{id}'``. A
+        segment of the form ``{name}`` matches any non-empty path segment,
+        which is passed to the handler as the argument *name*. Literal
+        segments take precedence over parameters.
+
+        A WSGI *handler* is called as ``handler(environ, start_response)``,
+        with the arguments in ``environ['wsgiorg.routing_args']``. A native
+        handler is called as ``handler(request, response, **args)``.
+        """
+        if not template.startswith('/'):
+            raise ValueError('template must start with "/": {0}'
+                                .format(template))
+        node = self._root
+        for segment in template.split('/')[1:]:
+            if segment.startswith('{') and segment.endswith('}'):
+                name = segment[1:-1]
+                if not name:
+                    raise ValueError('empty parameter name: {0}'
+                                        .format(template))
+                if node.param is None:
+                    node.param = _RouteNode()
+                    node.param_name = name
+                elif node.param_name != name:
+                    raise ValueError('conflicting parameter names: {0} and {1}'
+                                        .format(node.param_name, name))
+                node = node.param
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _RouteNode()
+                node = child
+        if method in node.handlers:
+            raise ValueError('duplicate route: {0} {1}'
+                                .format(method, template))
+        node.handlers[method] = handler
+
+    def _handler(self, handlers, method):
+        handler = handlers.get(method)
+        if handler is None and method == 'HEAD':
+            handler = handlers.get('GET')
+        if handler is None:
+            handler = handlers.get(None)
+        return handler
+
+    def _find(self, node, segments, index, method, args, allowed):
+        # Return the handler for segments[index:]. Literal segments are tried
+        # first, with backtracking to parameters. The methods of paths that
+        # match but have no handler for *method* are added to *allowed*.
+        if index == len(segments):
+            handler = self._handler(node.handlers, method)
+            if handler is None:
+                allowed.update(node.handlers)
+            return handler
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            handler = self._find(child, segments, index+1, method, args,
+                                 allowed)
+            if handler is not None:
+                return handler
+        if node.param is not None and segment:
+            handler = self._find(node.param, segments, index+1, method, args,
+                                 allowed)
+            if handler is not None:
+                args[node.param_name] = segment
+                return handler
+
+    def match(self, method, path):
+        """Match a request for *method* and *path*.
+
+        The return value is a ``(handler, args, allowed)`` tuple. If no route
+        matches, *handler* is ``None``, and *allowed* is a sorted list of the
+        methods that would match *path*, if any.
+        """
+        args = {}
+        allowed = set()
+        handler = None
+        if path.startswith('/'):
+            handler = self._find(self._root, path.split('/')[1:], 0, method,
+                                 args, allowed)
+        if handler is None:
+            if 'GET' in allowed:
+                allowed.add('HEAD')  # GET routes also serve HEAD
+            return None, args, sorted(allowed)
+        return handler, args, None
+
+    def _error(self, allowed):
+        # Return the status, headers and body for a failed match.
+        if allowed:
+            status, body = '405 Method Not Allowed', b'Method Not Allowed'
+            headers = [('Allow', ', '.join(allowed))]
         else:
-            self._close_transport(transport)
+            status, body = '404 Not Found', b'Not Found'
+            headers = []
+        headers += [('Content-Type', 'text/plain'),
+                    ('Content-Length', str(len(body)))]
+        return status, headers, body
+
+    def __call__(self, request, response):
+        if self._native:
+            handler, args, allowed = self.match(request.method,
+                                                request.parsed_url[0])
+            if handler is not None:
+                return handler(request, response, **args)
+            status, headers, body = self._error(allowed)
+            response.start(status, headers)
+            response.finish(body)
+            return
+        environ, start_response = request, response
+        handler, args, allowed = self.match(environ['REQUEST_METHOD'],
+                                            environ['PATH_INFO'])
+        if handler is not None:
+            environ['wsgiorg.routing_args'] = ((), args)
+            return handler(environ, start_response)
+        status, headers, body = self._error(allowed)
+        start_response(status, headers)
+        return [body]
@@ -31,6 +31,7 @@ ffi.cdef("""
       unsigned short http_minor;
       unsigned short status_code;
       unsigned char method;
+      uint64_t content_length;
       void *data;
       ...;
     };
@@ -76,6 +77,34 @@ ffi.cdef("""
     unsigned char http_message_type(http_parser *parser);
     unsigned char http_errno(http_parser *parser);
     unsigned char http_is_upgrade(http_parser *parser);
+    unsigned char http_is_chunked(http_parser *parser);
+
+    /* A parser that collects the URL and headers in C. See below. */
+    typedef int (*gruvi_body_cb) (http_parser*, size_t offset, size_t length);
+
+    struct gruvi_header {
+      uint32_t name_off;
+      uint32_t name_len;
+      uint32_t value_off;
+      uint32_t value_len;
+    };
+
+    struct gruvi_http_parser {
+      char *arena;
+      size_t arena_len;
+      size_t url_len;
+      struct gruvi_header *headers;
+      size_t nheaders;
+      http_cb on_headers_complete;
+      gruvi_body_cb on_body;
+      http_cb on_message_complete;
+      ...;
+    };
+
+    struct gruvi_http_parser *gruvi_parser_new(enum http_parser_type type);
+    void gruvi_parser_free(struct gruvi_http_parser *parser);
+    size_t gruvi_parser_execute(struct gruvi_http_parser *parser,
+                                const char *data, size_t len);
 
 """)
 
@@ -85,11 +114,172 @@ topdir, _ = os.path.split(parent)
 
 lib = ffi.verify("""
     #include <stdlib.h>
+    #include <string.h>
     #include "src/http_parser.h"
     #include "src/http_parser.c"
 
     unsigned char http_message_type(http_parser *p) { return p->type; }
     unsigned char http_errno(http_parser *p) { return p->http_errno; }
     unsigned char http_is_upgrade(http_parser *p) { return p->upgrade; }
+    unsigned char http_is_chunked(http_parser *p)
+            { return (p->flags & F_CHUNKED) != 0; }
+
+    /* The http-parser callbacks for the URL and the headers are handled in C.
+     * The data is collected in an arena, and the offsets of the header names
+     * and values in an array. Python is called only once when the headers are
+     * complete, once per body chunk with its offset into the buffer passed
+     * to gruvi_parser_execute(), and once when the message is complete (to
+     * pick up the trailers, if any). The arena is cleared after the
+     * headers_complete and message_complete callbacks. */
+
+    typedef int (*gruvi_body_cb) (http_parser*, size_t offset, size_t length);
+
+    struct gruvi_header {
+        uint32_t name_off;
+        uint32_t name_len;
+        uint32_t value_off;
+        uint32_t value_len;
+    };
+
+    struct gruvi_http_parser {
+        http_parser parser;  /* must be first */
+        const char *data;
+        char *arena;
+        size_t arena_len;
+        size_t arena_size;
+        size_t url_len;
+        struct gruvi_header *headers;
+        size_t nheaders;
+        size_t headers_size;
+        int in_value;
+        http_cb on_headers_complete;
+        gruvi_body_cb on_body;
+        http_cb on_message_complete;
+    };
+
+    static void gruvi_clear(struct gruvi_http_parser *p)
+    {
+        p->arena_len = p->url_len = p->nheaders = 0;
+        p->in_value = 0;
+    }
+
+    static int gruvi_append(struct gruvi_http_parser *p, const char *at,
+                            size_t length)
+    {
+        char *arena;
+        size_t size;
+        if (p->arena_len + length > p->arena_size) {
+            size = p->arena_size ? p->arena_size : 1024;
+            while (size < p->arena_len + length)
+                size *= 2;
+            if ((arena = realloc(p->arena, size)) == NULL)
+                return 1;
+            p->arena = arena;
+            p->arena_size = size;
+        }
+        memcpy(p->arena + p->arena_len, at, length);
+        p->arena_len += length;
+        return 0;
+    }
+
+    static int gruvi_on_message_begin(http_parser *hp)
+    {
+        gruvi_clear((struct gruvi_http_parser *) hp);
+        return 0;
+    }
+
+    static int gruvi_on_url(http_parser *hp, const char *at, size_t length)
+    {
+        struct gruvi_http_parser *p = (struct gruvi_http_parser *) hp;
+        p->url_len += length;
+        return gruvi_append(p, at, length);
+    }
+
+    static int gruvi_on_header_field(http_parser *hp, const char *at,
+                                     size_t length)
+    {
+        struct gruvi_http_parser *p = (struct gruvi_http_parser *) hp;
+        struct gruvi_header *headers;
+        size_t size;
+        if (p->in_value || p->nheaders == 0) {
+            if (p->nheaders == p->headers_size) {
+                size = p->headers_size ? 2 * p->headers_size : 16;
+                headers = realloc(p->headers, size * sizeof(*headers));
+                if (headers == NULL)
+                    return 1;
+                p->headers = headers;
+                p->headers_size = size;
+            }
+            headers = &p->headers[p->nheaders++];
+            headers->name_off = p->arena_len;
+            headers->name_len = headers->value_off = headers->value_len = 0;
+            p->in_value = 0;
+        }
+        p->headers[p->nheaders-1].name_len += length;
+        return gruvi_append(p, at, length);
+    }
+
+    static int gruvi_on_header_value(http_parser *hp, const char *at,
+                                     size_t length)
+    {
+        struct gruvi_http_parser *p = (struct gruvi_http_parser *) hp;
+        struct gruvi_header *header = &p->headers[p->nheaders-1];
+        if (!p->in_value) {
+            header->value_off = p->arena_len;
+            p->in_value = 1;
+        }
+        header->value_len += length;
+        return gruvi_append(p, at, length);
+    }
+
+    static int gruvi_on_headers_complete(http_parser *hp)
+    {
+        struct gruvi_http_parser *p = (struct gruvi_http_parser *) hp;
+        int ret = p->on_headers_complete(hp);
+        gruvi_clear(p);
+        return ret;
+    }
+
+    static int gruvi_on_body(http_parser *hp, const char *at, size_t length)
+    {
+        struct gruvi_http_parser *p = (struct gruvi_http_parser *) hp;
+        return p->on_body(hp, at - p->data, length);
+    }
+
+    static int gruvi_on_message_complete(http_parser *hp)
+    {
+        struct gruvi_http_parser *p = (struct gruvi_http_parser *) hp;
+        int ret = p->on_message_complete(hp);
+        gruvi_clear(p);
+        return ret;
+    }
+
+    static http_parser_settings gruvi_settings = {
+        gruvi_on_message_begin, gruvi_on_url, NULL, gruvi_on_header_field,
+        gruvi_on_header_value, gruvi_on_headers_complete, gruvi_on_body,
+        gruvi_on_message_complete
+    };
+
+    struct gruvi_http_parser *gruvi_parser_new(enum http_parser_type type)
+    {
+        struct gruvi_http_parser *p = calloc(1, sizeof(*p));
+        if (p != NULL)
+            http_parser_init(&p->parser, type);
+        return p;
+    }
+
+    void gruvi_parser_free(struct gruvi_http_parser *p)
+    {
+        free(p->arena);
+        free(p->headers);
+        free(p);
+    }
+
+    size_t gruvi_parser_execute(struct gruvi_http_parser *p,
+                                const char *data, size_t len)
+    {
+        p->data = data;
+        return http_parser_execute(&p->parser, &gruvi_settings, data, len);
+    }
 
     """, modulename='http_cffi', include_dirs=[topdir])
@@ -8,19 +8,23 @@
 
 from __future__ import absolute_import, print_function
 
+import os
 import signal
+import heapq
 import collections
 import threading
 import inspect
 import textwrap
 import itertools
+import weakref
 
 import pyuv
 import fibers
 
 from . import compat
 
-__all__ = ['switchpoint', 'assert_no_switchpoints', 'get_hub', 'Hub']
+__all__ = ['switchpoint', 'set_checks', 'assert_no_switchpoints', 'get_hub',
+           'Hub']
 
 
 # The @switchpoint decorator dynamically compiles the wrapping code at import
@@ -30,14 +34,41 @@ __all__ = ['switchpoint', 'assert_no_switchpoints', 'get_hub', 'Hub']
 _switchpoint_template = textwrap.dedent("""\
     def {name}{signature}:
         '''{docstring}'''
-        hub = get_hub()
-        if getcurrent() is hub:
-            raise RuntimeError('cannot call switchpoint from the Hub')
-        if hub._atomic:
-            raise RuntimeError('switchpoint called from atomic section')
+        if _checks[0]:
+            try:
+                hub = _local.hub
+            except AttributeError:
+                hub = get_hub()
+            if hub._atomic or getcurrent() is hub:
+                _check_failed(hub)
         return _{name}{arglist}
 """)
 
+# Switchpoint checks can be disabled by setting $GRUVI_CHECKS to "0". This is a
+# one element list so that it can be shared with the switchpoint wrappers.
+_checks = [os.environ.get('GRUVI_CHECKS', '1') != '0']
+
+def set_checks(enabled):
+    """Enable or disable the switchpoint checks.
+
+    By default, every :func:`switchpoint` checks that it is not called from
+    the Hub or from an :class:`assert_no_switchpoints` block. When checks are
+    disabled, the existing switchpoints only test a single flag, and
+    switchpoints that are defined afterwards are not wrapped at all.
+
+    Gruvi itself defines its switchpoints at import time. To have those
+    unwrapped too, set the environment variable ``$GRUVI_CHECKS`` to ``0``
+    before importing Gruvi.
+    """
+    _checks[0] = bool(enabled)
+
+
+def _check_failed(hub):
+    if hub._atomic:
+        raise RuntimeError('switchpoint called from atomic section')
+    raise RuntimeError('cannot call switchpoint from the Hub')
+
+
 def switchpoint(func):
     """Mark *func* as a switchpoint.
 
@@ -51,6 +82,9 @@ def switchpoint(func):
     
     You only need to mark methods and functions that invoke :meth:`Hub.switch`
     directly, not via intermediate callables.
+
+    If checks are disabled (see :func:`set_checks`), *func* is returned
+    unwrapped.
     """
     name = func.__name__
     doc = func.__doc__ or ''
@@ -59,13 +93,17 @@ def switchpoint(func):
                   for line in doc.splitlines() if line and not line.isspace()]
         indent = indent[0] if len(indent) == 1 else min(indent[1:] or [0])
         doc += '\n\n' + ' ' * indent + '*This method is a switchpoint.*\n'
+    if not _checks[0]:
+        func.__doc__ = doc
+        return func
     argspec = inspect.getargspec(func)
     signature = inspect.formatargspec(*argspec)
     arglist = inspect.formatargspec(*argspec, formatvalue=lambda x: '')
     funcdef = _switchpoint_template.format(name=name, signature=signature,
                                            docstring=doc, arglist=arglist)
     namespace = {'get_hub': get_hub, 'getcurrent': fibers.current,
-                 '_{0}'.format(name): func}
+                 '_local': Hub._local, '_checks': _checks,
+                 '_check_failed': _check_failed, '_{0}'.format(name): func}
     compat.exec_(funcdef, namespace)
     return namespace[name]
 
@@ -82,7 +120,8 @@ class assert_no_switchpoints(object):
             do_something_else()
     
     If a switchpoint is called while the block is active, an ``AssertionError``
-    is raised (even if the switchpoint did not switch).
+    is raised (even if the switchpoint did not switch). No error is raised if
+    checks are disabled with :func:`set_checks`.
 
     This context manager should not be overused. Normally you should know which
     functions are switchpoints or may end up calling switchpoints. Or
@@ -106,6 +145,76 @@ def get_hub():
     return Hub.get()
 
 
+class Timeout(object):
+    """A timeout scheduled with :meth:`Hub.call_later`.
+
+    Timeouts are kept in a heap by the Hub, which uses a single pyuv timer to
+    wait for the earliest one. Cancelling a timeout is O(1): the entry is
+    only marked as cancelled, and is discarded when it reaches the top of the
+    heap (or when the heap is compacted).
+    """
+
+    __slots__ = ('_hub', '_deadline', '_seqno', '_callback', '_args')
+
+    def __init__(self, hub, deadline, seqno, callback, args):
+        self._hub = hub
+        self._deadline = deadline
+        self._seqno = seqno
+        self._callback = callback
+        self._args = args
+
+    def __lt__(self, other):
+        return (self._deadline, self._seqno) < (other._deadline, other._seqno)
+
+    @property
+    def deadline(self):
+        """The loop time (in milliseconds) at which the timeout expires."""
+        return self._deadline
+
+    @property
+    def active(self):
+        """Whether the timeout is still pending."""
+        return self._callback is not None
+
+    def cancel(self):
+        """Cancel the timeout. This is a no-op if the timeout has already
+        expired or was cancelled before."""
+        if self._callback is None:
+            return
+        self._callback = None
+        self._args = None
+        self._hub._timeout_cancelled()
+
+
+class SwitchBack(object):
+    """The switchback callback for a fiber, as returned by
+    :meth:`Hub.switch_back`.
+
+    Calling the instance queues a switch back to the fiber in the Hub. A
+    switchback is valid for a single wait only: once the fiber is resumed, by
+    whatever means, it is retired. A switch back that is queued by a retired
+    instance is stale (for example a timeout that fired in the same loop
+    iteration as the event that was waited for) and is ignored.
+    """
+
+    __slots__ = ('_hub', '_fiber', '_retired', '_resume')
+
+    def __init__(self, hub, fiber):
+        self._hub = hub
+        self._fiber = fiber
+        self._retired = False
+        self._resume = self._switch_back
+
+    def __call__(self, *args):
+        self._hub.run_callback(self._resume, args)
+
+    def _switch_back(self, args):
+        if self._retired:
+            return
+        self._retired = True
+        self._fiber.switch(args)
+
+
 class Hub(fibers.Fiber):
     """The central fiber scheduler.
 
@@ -119,7 +228,7 @@ class Hub(fibers.Fiber):
     until such a callback is fired, a non-root fiber will take the following
     steps:
 
-    1. It will retrieve a new "switchback callback" using :meth:`switch_back`.
+    1. It will retrieve its "switchback callback" using :meth:`switch_back`.
     2. It will register the switchback callback as the callback to the condition
        the fiber is interested in.
     3. It will call :meth:`switch` to switch to the Hub to allow other
@@ -132,13 +241,40 @@ class Hub(fibers.Fiber):
     # By default there is one hub per thread
     _local = threading.local()
 
+    # Compact the timeout heap when more than this fraction is cancelled.
+    _max_cancelled = 0.5
+
+    #: The maximum number of callbacks that are run in one iteration of the
+    #: event loop. Callbacks that are added while the callbacks are run, are
+    #: run in the same iteration, as long as the budget allows it.
+    callback_budget = 1000
+
     def __init__(self, _loop=None):
         if self.current().parent is not None:
             raise RuntimeError('Hub must be created in the root fiber')
         super(Hub, self).__init__(target=self.run)
-        self._loop = _loop or pyuv.Loop.default_loop()
+        if _loop is None:
+            # The default loop may only be used by one thread.
+            if compat.is_main_thread():
+                _loop = pyuv.Loop.default_loop()
+            else:
+                _loop = pyuv.Loop()
+        self._loop = _loop
         self._atomic = collections.deque()
         self._callbacks = collections.deque()
+        self._timeouts = []
+        self._timeout_seqno = itertools.count()
+        self._cancelled = 0
+        self._expiring = False
+        self._timer = None
+        self._timer_deadline = None
+        self._idle = None
+        self._switchbacks = weakref.WeakKeyDictionary()
+        self._threadsafe_callbacks = collections.deque()
+        # The async handle should not keep the loop alive by itself.
+        self._async = pyuv.Async(self._loop, self._on_async)
+        self._async.ref = False
+        self._async_refs = 0
         from gruvi import logging, util
         self._log = logging.get_logger(util.objref(self))
 
@@ -178,7 +314,8 @@ class Hub(fibers.Fiber):
         This method may be called from the root fiber to start or switch to
         the Hub, or from a non-root fiber yield and wait for a switch back.
         The optional *timeout* argument specifies the maximum time to wait. If
-        the timeout expires then a switch back is automatically performed.
+        the timeout expires then a switch back is automatically performed, and
+        the return value is an empty tuple.
 
         If called from the root fiber, then this method returns when there
         are no more callbacks (see :meth:`run_callback`) and no more events in
@@ -187,14 +324,14 @@ class Hub(fibers.Fiber):
         if self.current() is self:
             raise RuntimeError('Cannot switch() to the Hub from the Hub')
         if timeout is not None:
-            timer = pyuv.Timer(self.loop)
-            timer.start(self.switch_back(), timeout, 0)
+            timer = self.call_later(timeout, self.switch_back())
         if interrupt:
             sigh = pyuv.Signal(self.loop)
             sigh.start(self.switch_back(), signal.SIGINT)
         ret = super(Hub, self).switch()
+        self._retire_switch_back()
         if timeout is not None:
-            timer.close()
+            timer.cancel()
         if interrupt:
             sigh.close()
         return ret
@@ -206,22 +343,52 @@ class Hub(fibers.Fiber):
         The callback is often used as the callback target to pyuv methods. At
         the moment, the callback accepts positional arguments only, which are
         returned in a tuple as the result of :meth:`Hub.switch`.
+
+        The callback is a :class:`SwitchBack` instance. It is valid for the
+        next wait of the fiber only. Within one wait, repeated calls return
+        the same instance.
         """
         current = self.current()
-        def schedule_switch_back(*args):
-            def do_switch_back():
-                current.switch(args)
-            self.run_callback(do_switch_back)
-        return schedule_switch_back
+        switchback = getattr(current, '_switchback', None)
+        if switchback is None:
+            switchback = self._switchbacks.get(current)
+        if switchback is None:
+            switchback = SwitchBack(self, current)
+            try:
+                current._switchback = switchback
+            except AttributeError:
+                # The root fiber is a plain fibers.Fiber without a __dict__
+                self._switchbacks[current] = switchback
+        return switchback
+
+    def _retire_switch_back(self):
+        # Called when the current fiber resumes from a wait. Retire its
+        # switchback so that a callback that fires late for this wait can't
+        # resume it during a later one.
+        current = self.current()
+        try:
+            switchback = current._switchback
+            current._switchback = None
+        except AttributeError:
+            switchback = self._switchbacks.pop(current, None)
+        if switchback is not None:
+            switchback._retired = True
 
     def _run_callbacks(self):
-        """Run registered callbacks."""
-        for i in range(len(self._callbacks)):
-            callback, args = self._callbacks.popleft()
+        """Run registered callbacks, up to :attr:`callback_budget`."""
+        callbacks = self._callbacks
+        if not callbacks:
+            return
+        budget = self.callback_budget
+        while callbacks and budget > 0:
+            callback, args = callbacks.popleft()
+            budget -= 1
             try:
                 callback(*args)
             except Exception:
                 self._log.exception('Uncaught exception in callback.')
+        if not callbacks and not self._idle.closed:
+            self._idle.stop()
 
     def run_callback(self, callback, *args):
         """Queue a callback to be called when the event loop next runs.
@@ -230,5 +397,128 @@ class Hub(fibers.Fiber):
         event loop. If you add multiple callbacks, they will be called in the
         order that you added them.
         """
-        self._callbacks.append((callback, args))
-        self.loop.stop()
+        callbacks = self._callbacks
+        callbacks.append((callback, args))
+        if len(callbacks) == 1:
+            self._start_idle()
+
+    def run_callback_threadsafe(self, callback, *args):
+        """Queue a callback to be called by the Hub from another thread.
+
+        This is the only method of the Hub that may be called from a thread
+        other than the one the Hub runs in. The callback is passed to
+        :meth:`run_callback` in the Hub's thread, and is therefore called in
+        the next iteration of its event loop.
+        """
+        self._threadsafe_callbacks.append((callback, args))
+        self._async.send()
+
+    def _ref_async(self, delta):
+        """Adjust the number of callbacks that another thread will deliver
+        with :meth:`run_callback_threadsafe`. While this is non-zero, the
+        event loop is kept alive."""
+        self._async_refs += delta
+        self._async.ref = self._async_refs > 0
+
+    def _on_async(self, handle):
+        """Move callbacks queued by other threads to the callback queue."""
+        callbacks = self._threadsafe_callbacks
+        while callbacks:
+            callback, args = callbacks.popleft()
+            self.run_callback(callback, *args)
+
+    def _start_idle(self):
+        """Start the idle handle. This prevents the event loop from blocking
+        while there are callbacks to run."""
+        if self._idle is None or self._idle.closed:
+            # The handle may have been closed by a loop.walk()
+            self._idle = pyuv.Idle(self.loop)
+        self._idle.start(_idle_callback)
+
+    def call_later(self, timeout, callback, *args):
+        """Call *callback* with *args* after *timeout* seconds.
+
+        Return a :class:`Timeout` instance that can be used to cancel the
+        call. The callback is called from the Hub, so it may not call a
+        switchpoint.
+
+        All timeouts share a single pyuv timer, so this method is cheap
+        compared to creating a :class:`pyuv.Timer` per timeout.
+        """
+        now = self.loop.now()
+        deadline = now + int(timeout * 1000)
+        entry = Timeout(self, deadline, next(self._timeout_seqno), callback,
+                        args)
+        heapq.heappush(self._timeouts, entry)
+        if self._timer_deadline is None or deadline < self._timer_deadline \
+                    or self._timer.closed:
+            self._start_timer(now)
+        return entry
+
+    def _timeout_cancelled(self):
+        """Called by :meth:`Timeout.cancel`."""
+        self._cancelled += 1
+        # The heap is not compacted while timeouts are being expired, because
+        # _on_timer_expired() is still popping entries from it.
+        if self._expiring:
+            return
+        if self._cancelled > len(self._timeouts) * self._max_cancelled:
+            self._timeouts[:] = [entry for entry in self._timeouts
+                                 if entry._callback is not None]
+            heapq.heapify(self._timeouts)
+            self._cancelled = 0
+            if not self._timeouts and self._timer_deadline is not None:
+                self._stop_timer()
+
+    def _start_timer(self, now):
+        """(Re)start the timer for the earliest pending timeout."""
+        deadline = self._timeouts[0]._deadline
+        if self._timer is None or self._timer.closed:
+            # The timer may have been closed by a loop.walk()
+            self._timer = pyuv.Timer(self.loop)
+        # pyuv truncates the timeout to milliseconds. Add half a millisecond
+        # so that we do not wake up just before the deadline.
+        self._timer.start(self._on_timer_expired,
+                          (max(0, deadline - now) + 0.5) / 1000.0, 0)
+        self._timer_deadline = deadline
+
+    def _stop_timer(self):
+        """Stop the timer. It may have been closed by a loop.walk()."""
+        if not self._timer.closed:
+            self._timer.stop()
+        self._timer_deadline = None
+
+    def _on_timer_expired(self, timer):
+        """Run all expired timeouts."""
+        self._timer_deadline = None
+        now = self.loop.now()
+        timeouts = self._timeouts
+        self._expiring = True
+        try:
+            while timeouts and timeouts[0]._deadline <= now:
+                entry = heapq.heappop(timeouts)
+                callback, args = entry._callback, entry._args
+                if callback is None:
+                    self._cancelled -= 1
+                    continue
+                entry._callback = entry._args = None
+                try:
+                    callback(*args)
+                except Exception:
+                    self._log.exception('Uncaught exception in timeout '
+                                        'callback.')
+            # Skip over cancelled entries so that they don't cause a wakeup.
+            while timeouts and timeouts[0]._callback is None:
+                heapq.heappop(timeouts)
+                self._cancelled -= 1
+        finally:
+            self._expiring = False
+        if timeouts:
+            self._start_timer(now)
+        elif self._timer_deadline is not None:
+            # A callback added and then cancelled a timeout.
+            self._stop_timer()
+
+
+def _idle_callback(handle):
+    pass
@@ -292,6 +292,10 @@ class JsonRpcServer(JsonRpcBase):
     def listen(self, address, ssl=False, **transport_args):
         self._listen(address, ssl, **transport_args)
 
+    @docfrom(JsonRpcBase._add_worker)
+    def add_worker(self, protocol):
+        self._add_worker(protocol)
+
     @switchpoint
     def call_method(self, client, method, *args):
         """Call a JSON-RPC method on a connected client.
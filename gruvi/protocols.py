@@ -8,10 +8,17 @@
 
 from __future__ import absolute_import, print_function
 
+import os
+import mmap
+import time
 import json
+import signal
 import socket
 import collections
+from errno import EINTR, EAGAIN
+
 import pyuv
+import fibers
 
 from . import hub, error, logging, compat
 from .hub import switchpoint
@@ -38,6 +45,24 @@ class errno(object):
     PARSE_ERROR = 10
 
 
+def _create_listen_socket(family, address, reuseport, listen):
+    """Create a socket bound to *address*, optionally with SO_REUSEPORT."""
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise RuntimeError('SO_REUSEPORT is not supported')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        if listen:
+            sock.listen(socket.SOMAXCONN)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
 class ProtocolError(error.Error):
     """Protocol error."""
 
@@ -49,6 +74,11 @@ class Protocol(object):
 
     max_connections = 1000
     max_buffer_size = 256*1024
+    _sendfile_chunk_size = 64*1024
+
+    #: An optional :class:`gruvi.FiberPool` to run dispatchers in. If this is
+    #: ``None``, a new fiber is created for each connection.
+    fiber_pool = None
 
     def __init__(self, timeout=None):
         self._timeout = timeout
@@ -57,6 +87,9 @@ class Protocol(object):
         self._log = logging.get_logger(objref(self))
         self._clients = set()
         self._client_factory = None
+        self._workers = []
+        self._next_worker = 0
+        self._worker_pids = {}
 
     @property
     def timeout(self):
@@ -68,7 +101,8 @@ class Protocol(object):
         """The underlying transport."""
         return self._transport
 
-    def _listen(self, address, ssl=False, **transport_args):
+    def _listen(self, address, ssl=False, workers=None, reuseport=False,
+                **transport_args):
         """Start listening for new connections on *address*.
 
         The *address* may be either be a string, a (host, port) tuple, or a
@@ -83,6 +117,18 @@ class Protocol(object):
         the transport is bound to the resolved address and this method will
         start listening for new connections on it.
 
+        The *workers* argument can be used with a (host, port) tuple to serve
+        from multiple processes. The listening socket is created once, and
+        then *workers* worker processes are forked that each accept
+        connections on it using their own Hub. The parent process supervises
+        the workers and restarts them if they exit. On SIGINT or SIGTERM it
+        stops the workers, and this method returns in the parent once all of
+        them have exited. In the workers, this method returns normally. If
+        *reuseport* is true, each worker binds its own socket with
+        ``SO_REUSEPORT`` so that the kernel balances connections between them.
+        Workers must be started from the root fiber, and before doing any
+        other I/O.
+
         Extra keyword arguments may be provided in *transport_args*. These will
         be passed to the constructor of the transport that is being used for
         client connections. This is useful when using SSL.
@@ -99,14 +145,20 @@ class Protocol(object):
             self._local_address = (address, '')
             self._client_factory = Pipe
         elif isinstance(address, tuple):
-            transport = TCP() # even for SSL the listening socket is TCP
-            result = getaddrinfo(address[0], address[1], socket.AF_UNSPEC,
-                                 socket.SOCK_STREAM, socket.IPPROTO_TCP)
-            resolved = result[0][4]
-            if len(result) > 1:
-                self._log.warning('multiple addresses for {0}, using {1}',
-                                     saddr(address), saddr(resolved))
-            transport.bind(resolved)
+            if workers:
+                transport = self._start_workers(address, workers, reuseport)
+                if transport is None:
+                    return  # parent, all workers have exited
+                resolved = transport.getsockname()
+            else:
+                transport = TCP() # even for SSL the listening socket is TCP
+                result = getaddrinfo(address[0], address[1], socket.AF_UNSPEC,
+                                     socket.SOCK_STREAM, socket.IPPROTO_TCP)
+                resolved = result[0][4]
+                if len(result) > 1:
+                    self._log.warning('multiple addresses for {0}, using {1}',
+                                         saddr(address), saddr(resolved))
+                transport.bind(resolved)
             self._log.debug('bound to {0}', saddr(resolved))
             self._local_address = resolved
             client_type = SSL if ssl else TCP
@@ -126,15 +178,124 @@ class Protocol(object):
         self._transport.listen(self._on_new_connection)
         self._log.debug('transport is {0}', objref(transport))
 
+    def _start_workers(self, address, workers, reuseport):
+        """Fork *workers* worker processes that serve *address*.
+
+        In a worker, return a TCP transport for the listening socket, bound to
+        a new Hub. In the parent, supervise the workers, and return None after
+        they have exited.
+        """
+        if fibers.current().parent is not None:
+            raise RuntimeError('workers must be started from the root fiber')
+        # Resolve the address with the blocking resolver. The libuv thread pool
+        # does not survive a fork().
+        result = socket.getaddrinfo(address[0], address[1], socket.AF_UNSPEC,
+                                    socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        family, resolved = result[0][0], result[0][4]
+        if len(result) > 1:
+            self._log.warning('multiple addresses for {0}, using {1}',
+                              saddr(address), saddr(resolved))
+        # With SO_REUSEPORT the parent only binds to reserve the port, which
+        # matters if port 0 was requested. Each worker binds and listens on its
+        # own socket.
+        sock = _create_listen_socket(family, resolved, reuseport, not reuseport)
+        resolved = sock.getsockname()
+        try:
+            if not self._supervise_workers(workers):
+                return
+            if reuseport:
+                sock.close()
+                sock = _create_listen_socket(family, resolved, True, True)
+            # Each worker runs its own Hub with its own event loop. The parent's
+            # loop may not be used after the fork.
+            hub.Hub._local.hub = hub.Hub(pyuv.Loop())
+            self._hub = hub.get_hub()
+            transport = TCP()
+            transport.open(os.dup(sock.fileno()))
+        finally:
+            sock.close()
+        self._log.debug('worker {0} started', os.getpid())
+        return transport
+
+    def _supervise_workers(self, nworkers):
+        """Fork and supervise *nworkers* worker processes.
+
+        Return True in a worker, and False in the parent once all workers have
+        exited. If this method raises an exception, the workers that were
+        already started are stopped by :meth:`close`.
+        """
+        workers = self._worker_pids  # pid -> start time
+        stopping = []
+        def stop_workers(signum, frame):
+            stopping.append(signum)
+            self._kill_workers()
+        handlers = [(signum, signal.signal(signum, stop_workers))
+                    for signum in (signal.SIGINT, signal.SIGTERM)]
+        try:
+            while True:
+                while not stopping and len(workers) < nworkers:
+                    pid = os.fork()
+                    if pid == 0:
+                        self._worker_pids = {}
+                        return True  # the finally clause restores the handlers
+                    self._log.debug('started worker {0}', pid)
+                    workers[pid] = time.time()
+                if not workers:
+                    break
+                try:
+                    pid, status = os.waitpid(-1, 0)
+                except OSError as e:
+                    if e.args[0] == EINTR:
+                        continue
+                    raise
+                started = workers.pop(pid, None)
+                if started is None or stopping:
+                    continue
+                self._log.warning('worker {0} exited with status {1}, '
+                                  'restarting', pid, status)
+                if time.time() - started < 1:
+                    time.sleep(1)  # Don't restart a failing worker in a loop
+        finally:
+            for signum, handler in handlers:
+                signal.signal(signum, handler)
+        self._log.debug('all workers exited')
+        return False
+
+    def _kill_workers(self):
+        """Send SIGTERM to the worker processes."""
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _reap_workers(self):
+        """Stop the worker processes that are still running, and wait for them
+        to exit."""
+        self._kill_workers()
+        for pid in list(self._worker_pids):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            del self._worker_pids[pid]
+
     def _on_new_connection(self, transport, error):
         """Callback that is called for new connections."""
         assert transport is self._transport
         if error:
             self._log.error('error {0} in listen callback', error)
             return
+        if self._workers:
+            self._handoff_connection(transport)
+            return
         client = self._client_factory()
-        self._clients.add(client)
         transport.accept(client)
+        self._add_client(client)
+
+    def _add_client(self, client):
+        """Start serving an accepted client transport."""
+        self._clients.add(client)
         if len(self._clients) >= self.max_connections:
             self._log.error('max connections reached, dropping connection')
             self._close_transport(client, errno.SERVER_BUSY)
@@ -142,6 +303,70 @@ class Protocol(object):
         self._log.debug('new client on {0}', objref(client))
         self._init_transport(client)
 
+    def _add_worker(self, protocol):
+        """Hand off new connections to *protocol*.
+
+        This method must be called from the thread that *protocol* was
+        created in, which should be different from the thread this protocol
+        is listening in. After this, new connections are accepted here, and
+        are then passed to the worker protocols in a round-robin fashion, using
+        an IPC pipe. This allows a multi-threaded server with one Hub per
+        thread. This is not supported on Windows.
+        """
+        if self._client_factory is None:
+            raise RuntimeError('not listening')
+        protocol._local_address = self._local_address
+        protocol._client_factory = self._client_factory
+        sock1, sock2 = socket.socketpair()
+        pipe = Pipe(ipc=True)
+        try:
+            pipe.open(os.dup(sock2.fileno()))
+            fd = os.dup(sock1.fileno())
+        finally:
+            sock1.close()
+            sock2.close()
+        pipe.start_read2(protocol._on_handoff)
+        self._hub.run_callback_threadsafe(self._attach_worker, fd)
+
+    def _attach_worker(self, fd):
+        """Add the acceptor side of a worker pipe. Runs in our Hub."""
+        pipe = Pipe(ipc=True)
+        pipe.open(fd)
+        self._workers.append(pipe)
+        self._log.debug('added worker pipe {0}', objref(pipe))
+
+    def _handoff_connection(self, transport):
+        """Accept a new connection and pass it on to a worker."""
+        client = type(transport)()
+        transport.accept(client)
+        pipe = self._workers[self._next_worker % len(self._workers)]
+        self._next_worker += 1
+        def on_write_complete(pipe, error):
+            if error:
+                self._log.error('error {0} handing off connection', error)
+            client.close()
+        pipe.write2(b'.', client, on_write_complete)
+
+    def _on_handoff(self, pipe, data, pending, error):
+        """Callback for connections handed off by an acceptor."""
+        if error:
+            if error != pyuv.errno.UV_EOF:
+                self._log.error('error {0} on handoff pipe', error)
+            pipe.close()
+            return
+        if pending == pyuv.UV_UNKNOWN_HANDLE:
+            return
+        client = self._client_factory()
+        pipe.accept(client)
+        self._add_client(client)
+
+    def _spawn(self, func, *args):
+        """Run ``func(*args)`` in a new fiber, or in the fiber pool."""
+        if self.fiber_pool is not None:
+            self.fiber_pool.spawn(func, *args)
+        else:
+            Fiber(func, args=args).start()
+
     def _init_transport(self, transport):
         """Initialize a client or server transport."""
         transport._eof = False
@@ -171,9 +396,27 @@ class Protocol(object):
         """Write *data* to the transport."""
         if not data:
             return 0
+        return self._write_buffers(transport, transport.write, data, len(data))
+
+    @switchpoint
+    def _writelines(self, transport, lines):
+        """Write the elements of the sequence *lines* to the transport.
+
+        The elements are passed to the transport in a single gathering write.
+        """
+        lines = [line for line in lines if line]
+        if not lines:
+            return 0
+        elif len(lines) == 1:
+            return self._write(transport, lines[0])
+        nbytes = sum(len(line) for line in lines)
+        return self._write_buffers(transport, transport.writelines, lines,
+                                   nbytes)
+
+    def _write_buffers(self, transport, write, data, nbytes):
+        """Call ``write(data, callback)`` and do flow control for *nbytes*."""
         if transport._error:
             raise transport._error
-        nbytes = len(data)
         def on_write_complete(transport, error):
             if error:
                 error = pyuv_exc(transport, error)
@@ -187,7 +430,7 @@ class Protocol(object):
             if transport._write_buffer == 0:
                 transport._events.notify('BufferEmpty')
         transport._write_buffer += nbytes
-        transport.write(data, on_write_complete)
+        write(data, on_write_complete)
         if transport._write_buffer > self.max_buffer_size:
             transport._events.wait('BufferBelowThreshold', 'HandleError')
         if transport._error:
@@ -195,10 +438,95 @@ class Protocol(object):
         return nbytes
 
     @switchpoint
-    def _writelines(self, transport, lines):
-        """Write the elements of the sequence *lines* to the transport."""
-        for line in lines:
-            self._write(transport, line)
+    def _sendfile(self, transport, file, offset=0, count=None):
+        """Send *count* bytes from *file*, starting at *offset*.
+
+        The *file* argument must be a file object or a file descriptor. If
+        *count* is not specified, the file is sent until EOF. Any pending
+        writes are flushed first.
+
+        Where possible, the data is sent with :func:`os.sendfile` and never
+        passes through user space. For SSL transports, and on platforms that
+        do not have ``sendfile()``, the data is read from a memory map of the
+        file instead. Return the number of bytes sent.
+        """
+        infd = file if isinstance(file, int) else file.fileno()
+        if count is None:
+            count = os.fstat(infd).st_size - offset
+        if count <= 0:
+            return 0
+        self._flush(transport)
+        outfd = None
+        if hasattr(os, 'sendfile') and not isinstance(transport, SSL):
+            try:
+                outfd = transport.fileno()
+            except (AttributeError, pyuv.error.UVError):
+                pass
+        if outfd is None:
+            return self._sendfile_mmap(transport, infd, offset, count)
+        sent = 0
+        poll = pollfd = None
+        try:
+            while sent < count:
+                try:
+                    nbytes = os.sendfile(outfd, infd, offset+sent, count-sent)
+                except OSError as e:
+                    if e.errno == EINTR:
+                        continue
+                    elif e.errno != EAGAIN:
+                        raise
+                    nbytes = None
+                if nbytes == 0:
+                    break  # file was truncated
+                elif nbytes:
+                    sent += nbytes
+                    continue
+                # The socket buffer is full. Wait for it to become writable
+                # via a duplicate descriptor, as libuv already polls outfd.
+                if poll is None:
+                    pollfd = os.dup(outfd)
+                    poll = pyuv.Poll(self._hub.loop, pollfd)
+                poll.start(pyuv.UV_WRITABLE, self._hub.switch_back())
+                result = self._hub.switch(self._timeout)
+                poll.stop()
+                if not result:
+                    raise pyuv_exc(transport, pyuv.errno.UV_ETIMEDOUT)
+                elif result[2]:
+                    raise pyuv_exc(transport, result[2])
+        finally:
+            if poll is not None:
+                poll.close()
+                os.close(pollfd)
+        return sent
+
+    @switchpoint
+    def _sendfile_mmap(self, transport, infd, offset, count):
+        # Fallback for _sendfile(). A memory map is used so that the file is
+        # only copied once, into the buffers that are passed to write().
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        try:
+            fmap = mmap.mmap(infd, offset + count - start,
+                             access=mmap.ACCESS_READ, offset=start)
+        except (EnvironmentError, ValueError):
+            fmap = None
+        sent = 0
+        try:
+            while sent < count:
+                size = min(count - sent, self._sendfile_chunk_size)
+                if fmap is not None:
+                    pos = offset - start + sent
+                    chunk = fmap[pos:pos+size]
+                else:
+                    os.lseek(infd, offset + sent, os.SEEK_SET)
+                    chunk = os.read(infd, size)
+                if not chunk:
+                    break
+                self._write(transport, chunk)
+                sent += len(chunk)
+        finally:
+            if fmap is not None:
+                fmap.close()
+        return sent
 
     @switchpoint
     def _flush(self, transport):
@@ -242,7 +570,12 @@ class Protocol(object):
                     client.close(on_client_close)
             switch_back = self._hub.switch_back()
             self._hub.switch(self._timeout)
-        if not self._transport.closed:
+        for pipe in self._workers:
+            pipe.close()
+        del self._workers[:]
+        if self._worker_pids:
+            self._reap_workers()
+        if self._transport is not None and not self._transport.closed:
             self._transport.close(self._hub.switch_back())
             self._hub.switch(self._timeout)
 
@@ -289,12 +622,17 @@ class RequestResponseProtocol(Protocol):
                 transport.stop_read()
             elif oldsize >= self.max_buffer_size > newsize:
                 transport.start_read(self._on_transport_readable)
-        transport._queue = Queue(on_queue_size_change)
+        def sizefunc(message):
+            # The queue also carries the EOF marker (None) and errors.
+            if message is None or isinstance(message, Exception):
+                return 0
+            return len(message)
+        transport._queue = Queue(on_queue_size_change, sizefunc)
         transport._dispatcher = None
 
     def _start_dispatcher(self, transport):
-        transport._dispatcher = Fiber(self._dispatch, args=(transport,))
-        transport._dispatcher.start()
+        self._spawn(self._dispatch, transport)
+        transport._dispatcher = True
 
     def _dispatch_fast_path(self, transport, message):
         """Fast path dispatch. This is run in the read callback."""
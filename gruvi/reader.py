@@ -7,8 +7,11 @@
 # complete list.
 
 import io
+import mmap
+import tempfile
 import collections
 
+from . import compat
 from .hub import switchpoint
 from .fiber import ConditionSet
 
@@ -20,6 +23,10 @@ class Reader(io.BufferedIOBase):
     read back again using the :meth:`read`, :meth:`readline` and related
     methods. The methods that read data are all switchpoints and will block in
     case a read cannot be satisified.
+
+    The data is kept in the buffers in which it was received. The
+    :meth:`read_view`, :meth:`peek` and :meth:`readinto` methods give access
+    to it without creating intermediate copies.
     """
 
     def __init__(self, on_size_change=None):
@@ -31,15 +38,15 @@ class Reader(io.BufferedIOBase):
         self._error = None
         self._buffer_size = 0
         self._on_size_change = on_size_change
+        self._on_eof = None
         self._events = ConditionSet()
 
     def _adjust_size(self, delta):
         """Adjust the buffer size and fire the callback if any."""
+        if not delta:
+            return
         oldsize = self._buffer_size
-        if delta:
-            self._buffer_size += delta
-        else:
-            self._buffer_size = 0
+        self._buffer_size += delta
         if self._on_size_change:
             self._on_size_change(oldsize, self._buffer_size)
 
@@ -52,6 +59,8 @@ class Reader(io.BufferedIOBase):
         else:
             self._eof = True
             self._events.notify('EOF')
+            if self._on_eof:
+                self._on_eof()
 
     def _set_error(self, error):
         """Set an error state on the reader."""
@@ -62,15 +71,49 @@ class Reader(io.BufferedIOBase):
         """Get one buffer, of length no more than *size*."""
         if not self._buffers:
             return b''
+        buf = self._buffers[0]
+        offset = self._offset
+        if offset == 0 and (size is None or size >= len(buf)):
+            # Common case: return the entire buffer without copying it.
+            self._buffers.popleft()
+            self._adjust_size(-len(buf))
+            return buf
+        if size is None:
+            size = len(buf)
+        buf = buf[offset:offset+size]
+        self._consume(len(buf))
+        return buf
+
+    def _get_view(self, size=None):
+        """Like :meth:`_get` but return a memoryview."""
+        if not self._buffers:
+            return compat.memoryview(b'')
+        offset = self._offset
+        view = compat.memoryview(self._buffers[0])
         if size is None:
-            size = len(self._buffers[0])
-        buf = self._buffers[0][self._offset:self._offset+size]
+            size = len(view)
+        view = view[offset:offset+size]
+        self._consume(len(view))
+        return view
+
+    def _consume(self, size):
+        """Remove *size* bytes from the first buffer."""
         self._offset += size
         if self._offset >= len(self._buffers[0]):
             self._offset = 0
             self._buffers.popleft()
-        self._adjust_size(-len(buf))
-        return buf
+        self._adjust_size(-size)
+
+    @switchpoint
+    def _wait_readable(self):
+        """Wait until there is data available, or until EOF or an error.
+
+        A pending error is raised only when all data has been read.
+        """
+        if not self._buffers and not self._eof and not self._error:
+            self._events.wait('InputReceived', 'EOF', 'Error')
+        if not self._buffers and self._error:
+            raise self._error
 
     def _getall(self):
         """Return all buffers."""
@@ -83,20 +126,46 @@ class Reader(io.BufferedIOBase):
         self._adjust_size(-self._buffer_size)
         return bufs
 
-    def _find(self, s):
-        """Find the string *s* in the buffers."""
-        pos = 0
-        offset = self._offset
-        for buf in self._buffers:
-            found = buf.find(s, offset)
+    def _find(self, delim, state):
+        """Find the string *delim* in the buffers.
+
+        The *state* argument is a list ``[index, pos, tail]`` that keeps the
+        scan position between calls, so that data is scanned only once even
+        if it arrives in many small buffers. It must be initialized to ``[0,
+        0, b'']`` and no data may be read between calls.
+
+        Return the position of *delim* relative to the current read position,
+        or -1 if it was not found.
+        """
+        index, pos, tail = state
+        keep = len(delim) - 1
+        buffers = self._buffers
+        while index < len(buffers):
+            buf = buffers[index]
+            start = self._offset if index == 0 else 0
+            if tail:
+                # A match that straddles the previous buffer(s) and this one.
+                found = (tail + buf[start:start+keep]).find(delim)
+                if found != -1:
+                    return pos - len(tail) + found
+            found = buf.find(delim, start)
             if found != -1:
-                pos += found
-                break
-            pos += len(buf) - offset
-            offset = 0
-        if not found:
-            pos = -1
-        return pos
+                return pos + found - start
+            pos += len(buf) - start
+            if keep:
+                tail = (tail + buf[max(start, len(buf)-keep):])[-keep:]
+            index += 1
+        state[:] = [index, pos, tail]
+        return -1
+
+    def _get_exact(self, size):
+        """Get exactly *size* bytes. There must be enough data."""
+        chunks = []
+        while size > 0:
+            chunk = self._get(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
 
     @switchpoint
     def read(self, size=None):
@@ -124,28 +193,96 @@ class Reader(io.BufferedIOBase):
         return buf
 
     @switchpoint
-    def readline(self, limit=-1):
-        """Read a single line.
+    def read_view(self, size=None):
+        """Read up to *size* bytes, and return them as a memoryview.
 
-        If EOF is reached before a full line can be read, a partial line is
+        This does not copy the data. The view is a slice of a single buffer
+        that was received, so it can be shorter than *size* even if more data
+        is available. An empty view is returned at EOF.
+        """
+        self._wait_readable()
+        return self._get_view(size)
+
+    @switchpoint
+    def peek(self, size=None):
+        """Return a memoryview of up to *size* bytes without consuming them.
+
+        Like :meth:`read_view`, this returns a slice of a single buffer, and
+        waits if no data is available.
+        """
+        self._wait_readable()
+        if not self._buffers:
+            return compat.memoryview(b'')
+        view = compat.memoryview(self._buffers[0])
+        offset = self._offset
+        if size is None:
+            size = len(view)
+        return view[offset:offset+size]
+
+    @switchpoint
+    def readinto(self, b):
+        """Read data into the pre-allocated writable buffer *b*.
+
+        This waits until data is available, and then copies as much of the
+        available data as fits into *b*. Return the number of bytes read,
+        which is zero at EOF.
+        """
+        self._wait_readable()
+        view = compat.memoryview(b)
+        size = len(view)
+        pos = 0
+        while self._buffers and pos < size:
+            chunk = self._get_view(size - pos)
+            view[pos:pos+len(chunk)] = chunk
+            pos += len(chunk)
+        return pos
+
+    @switchpoint
+    def readinto1(self, b):
+        """Read data into the pre-allocated writable buffer *b*.
+
+        This is like :meth:`readinto`, but copies data from at most one of
+        the received buffers.
+        """
+        self._wait_readable()
+        view = compat.memoryview(b)
+        chunk = self._get_view(len(view))
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    @switchpoint
+    def readuntil(self, delim, limit=-1):
+        """Read until and including the delimiter *delim*.
+
+        If EOF is reached before the delimiter is found, the remaining data is
         returned. If *limit* is specified, at most *limit* bytes will be read.
         """
-        chunks = []
+        if not delim:
+            raise ValueError('delim: must not be empty')
+        state = [0, 0, b'']
         while True:
-            pos = self._find('\n')
+            pos = self._find(delim, state)
             if pos != -1:
-                nbytes = pos+1
-                while nbytes > 0:
-                    chunks.append(self._get(nbytes))
-                    nbytes -= len(chunk)
+                nbytes = pos + len(delim)
                 break
-            chunks.extend(self._getall())
-            if self._eof or self._error:
+            if 0 <= limit <= self._buffer_size or self._eof or self._error:
+                nbytes = self._buffer_size
                 break
-            self._wait('InputReceived', 'EOF')
-        if not chunks and self._error:
+            self._events.wait('InputReceived', 'EOF', 'Error')
+        if limit >= 0:
+            nbytes = min(nbytes, limit)
+        if not nbytes and self._error:
             raise self._error
-        return b''.join(chunks)
+        return self._get_exact(nbytes)
+
+    @switchpoint
+    def readline(self, limit=-1):
+        """Read a single line.
+
+        If EOF is reached before a full line can be read, a partial line is
+        returned. If *limit* is specified, at most *limit* bytes will be read.
+        """
+        return self.readuntil(b'\n', limit)
 
     @switchpoint
     def readlines(self, hint=-1):
@@ -174,3 +311,124 @@ class Reader(io.BufferedIOBase):
             if not line:
                 break
             yield line
+
+
+class SpooledReader(Reader):
+    """A reader that spools its data to a temporary file.
+
+    This is useful for large amounts of data that are produced by the network
+    faster than they are consumed. The data does not count towards the buffer
+    size, so it does not cause flow control to kick in.
+
+    Reads block until all data has been fed into the reader. After that, the
+    data is read from a memory map of the file, and the reader is seekable.
+    Call :meth:`close` to release the file.
+
+    The data is written to the file as it is received, in the thread of the
+    Hub. Writes usually go to the page cache and are fast. On a slow or busy
+    disk however they block the event loop, and with it all other fibers.
+    """
+
+    def __init__(self, on_size_change=None):
+        super(SpooledReader, self).__init__(on_size_change)
+        self._file = tempfile.TemporaryFile()
+        self._map = None
+        self._size = 0
+        self._pos = 0
+
+    def _feed(self, data):
+        if self._file.closed:
+            return  # closed before all data was received
+        if data:
+            self._file.write(data)
+            self._size += len(data)
+            return
+        self._file.flush()
+        if self._size:
+            self._map = mmap.mmap(self._file.fileno(), self._size,
+                                  access=mmap.ACCESS_READ)
+        super(SpooledReader, self)._feed(data)
+
+    @switchpoint
+    def _wait_complete(self):
+        """Wait until all data has been spooled."""
+        if not self._eof and not self._error:
+            self._events.wait('EOF', 'Error')
+        if self._error:
+            raise self._error
+
+    def _slice(self, end):
+        # Return the data up to *end*, and advance the position.
+        end = min(end, self._size)
+        if end <= self._pos:
+            return b''
+        data = self._map[self._pos:end]
+        self._pos = end
+        return data
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    @switchpoint
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._wait_complete()
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        if offset < 0:
+            raise ValueError('negative seek position')
+        self._pos = offset
+        return offset
+
+    @switchpoint
+    def read(self, size=None):
+        self._wait_complete()
+        if size is None or size < 0:
+            return self._slice(self._size)
+        return self._slice(self._pos + size)
+
+    @switchpoint
+    def read_view(self, size=None):
+        return compat.memoryview(self.read(size))
+
+    @switchpoint
+    def peek(self, size=None):
+        pos = self._pos
+        data = self.read(size)
+        self._pos = pos
+        return compat.memoryview(data)
+
+    @switchpoint
+    def readinto(self, b):
+        self._wait_complete()
+        view = compat.memoryview(b)
+        data = self._slice(self._pos + len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    readinto1 = readinto
+
+    @switchpoint
+    def readuntil(self, delim, limit=-1):
+        if not delim:
+            raise ValueError('delim: must not be empty')
+        self._wait_complete()
+        if self._map is None:
+            return b''
+        end = self._map.find(delim, self._pos)
+        end = self._size if end == -1 else end + len(delim)
+        if limit >= 0:
+            end = min(end, self._pos + limit)
+        return self._slice(end)
+
+    def close(self):
+        """Close the reader and remove the temporary file."""
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+        super(SpooledReader, self).close()
@@ -306,6 +306,11 @@ class SSL(pyuv.TCP):
         self._write_backlog.append((data, 0, callback))
         self._write()
 
+    def writelines(self, seq, callback=None):
+        # Coalesce into one buffer so that it is sent in as few SSL records
+        # as possible.
+        self.write(b''.join(seq), callback)
+
     def _write(self):
         # Try to make progress on the write backlog.
         while self._write_backlog:
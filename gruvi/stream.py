@@ -22,7 +22,7 @@ import pyuv
 from .hub import switchpoint
 from .pyuv import pyuv_exc
 from .util import docfrom, objref
-from . import fiber, reader, protocols, error
+from . import reader, protocols, error
 
 
 __all__ = ['StreamError', 'Stream', 'StreamClient', 'StreamServer']
@@ -44,11 +44,26 @@ class Stream(io.BufferedIOBase):
     def read(self, size=None):
         return self._transport._reader.read(size)
 
+    @switchpoint
+    @docfrom(reader.Reader.readinto)
+    def readinto(self, b):
+        return self._transport._reader.readinto(b)
+
+    @switchpoint
+    @docfrom(reader.Reader.readinto1)
+    def readinto1(self, b):
+        return self._transport._reader.readinto1(b)
+
     @switchpoint
     @docfrom(reader.Reader.readline)
     def readline(self, limit=-1):
         return self._transport._reader.readline(limit)
 
+    @switchpoint
+    @docfrom(reader.Reader.readuntil)
+    def readuntil(self, delim, limit=-1):
+        return self._transport._reader.readuntil(delim, limit)
+
     @switchpoint
     @docfrom(reader.Reader.readlines)
     def readlines(self, hint=-1):
@@ -64,6 +79,11 @@ class Stream(io.BufferedIOBase):
     def writelines(self, lines):
         self._protocol._writelines(self._transport, lines)
 
+    @switchpoint
+    @docfrom(protocols.Protocol._sendfile)
+    def sendfile(self, file, offset=0, count=None):
+        return self._protocol._sendfile(self._transport, file, offset, count)
+
     @switchpoint
     @docfrom(protocols.Protocol._flush)
     def flush(self):
@@ -98,9 +118,8 @@ class StreamBase(protocols.Protocol):
         transport._stream = Stream(transport, self)
         if self._connection_handler is None:
             return
-        transport._dispatcher = fiber.Fiber(self._dispatch_connection,
-                                            args=(transport,))
-        transport._dispatcher.start()
+        self._spawn(self._dispatch_connection, transport)
+        transport._dispatcher = True
 
     def _on_transport_readable(self, transport, data, error):
         if error == pyuv.errno.UV_EOF:
@@ -137,11 +156,26 @@ class StreamClient(StreamBase):
     def read(self, size=None):
         return self.transport._stream.read(size)
 
+    @switchpoint
+    @docfrom(Stream.readinto)
+    def readinto(self, b):
+        return self.transport._stream.readinto(b)
+
+    @switchpoint
+    @docfrom(Stream.readinto1)
+    def readinto1(self, b):
+        return self.transport._stream.readinto1(b)
+
     @switchpoint
     @docfrom(Stream.readline)
     def readline(self, limit=-1):
         return self.transport._stream.readline(limit)
 
+    @switchpoint
+    @docfrom(Stream.readuntil)
+    def readuntil(self, delim, limit=-1):
+        return self.transport._stream.readuntil(delim, limit)
+
     @switchpoint
     @docfrom(Stream.readlines)
     def readlines(self, hint=-1):
@@ -157,6 +191,11 @@ class StreamClient(StreamBase):
     def writelines(self, lines):
         self.transport._stream.writelines(lines)
 
+    @switchpoint
+    @docfrom(Stream.sendfile)
+    def sendfile(self, file, offset=0, count=None):
+        return self.transport._stream.sendfile(file, offset, count)
+
     @switchpoint
     @docfrom(Stream.flush)
     def flush(self):
@@ -198,3 +237,7 @@ class StreamServer(StreamBase):
     @docfrom(StreamBase._listen)
     def listen(self, address, ssl=False, **transport_args):
         self._listen(address, ssl, **transport_args)
+
+    @docfrom(StreamBase._add_worker)
+    def add_worker(self, protocol):
+        self._add_worker(protocol)
@@ -0,0 +1,107 @@
+#
+# This file is part of Gruvi. Gruvi is free software available under the
+# terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2012-2013 the Gruvi authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import time
+import operator
+import gruvi
+from gruvi.test import UnitTest, assert_raises
+
+
+def divide(a, b):
+    return a // b
+
+
+class TestExecutor(UnitTest):
+
+    def run_fibers(self, *funcs):
+        fibers = [gruvi.Fiber(func) for func in funcs]
+        for fiber in fibers:
+            fiber.start()
+        gruvi.get_hub().switch()
+
+    def test_run_in_executor(self):
+        result = []
+        def worker():
+            result.append(gruvi.run_in_executor(divide, 10, 2))
+            assert_raises(ZeroDivisionError, gruvi.run_in_executor,
+                          divide, 1, 0)
+            result.append('done')
+        self.run_fibers(worker)
+        assert result == [5, 'done']
+
+    def test_run_in_executor_concurrent(self):
+        # A blocking call must only suspend the calling fiber.
+        result = []
+        def blocker():
+            gruvi.run_in_executor(time.sleep, 0.1)
+            result.append('blocker')
+        def sleeper():
+            gruvi.util.sleep(0.01)
+            result.append('sleeper')
+        self.run_fibers(blocker, sleeper)
+        assert result == ['sleeper', 'blocker']
+
+    def test_thread_pool(self):
+        pool = gruvi.ThreadPool(2)
+        result = []
+        def worker():
+            result.append(pool.run(divide, 10, 2))
+            assert_raises(ZeroDivisionError, pool.run, divide, 1, 0)
+        self.run_fibers(worker, worker)
+        pool.close()
+        assert result == [5, 5]
+        assert_raises(RuntimeError, pool.run, divide, 1, 1)
+
+    def test_thread_pool_concurrent(self):
+        pool = gruvi.ThreadPool(4)
+        def blocker():
+            pool.run(time.sleep, 0.1)
+        t0 = time.time()
+        self.run_fibers(*[blocker]*4)
+        pool.close()
+        assert time.time() - t0 < 0.3
+
+    def test_thread_pool_spurious_wakeup(self):
+        # A fiber that is switched to while it waits must keep waiting.
+        pool = gruvi.ThreadPool(1)
+        hub = gruvi.get_hub()
+        result = []
+        def blocker():
+            t0 = time.time()
+            pool.run(time.sleep, 0.1)
+            result.append(time.time() - t0)
+        fiber = gruvi.Fiber(blocker)
+        fiber.start()
+        hub.call_later(0.01, fiber.switch, ('spurious',))
+        hub.switch()
+        pool.close()
+        assert len(result) == 1
+        assert result[0] >= 0.09
+
+    def test_process_pool(self):
+        pool = gruvi.ProcessPool(2)
+        result = []
+        def worker():
+            result.append(pool.run(operator.add, 1, 2))
+            assert_raises(ZeroDivisionError, pool.run, divide, 1, 0)
+        self.run_fibers(worker, worker)
+        pool.close()
+        assert result == [3, 3]
+
+    def test_process_pool_unpicklable(self):
+        # A call that cannot be pickled must raise, not hang.
+        pool = gruvi.ProcessPool(1)
+        result = []
+        def worker():
+            assert_raises(Exception, pool.run, operator.add, lambda: 1, 2)
+            result.append(pool.run(operator.add, 1, 2))
+        self.run_fibers(worker)
+        pool.close()
+        assert result == [3]
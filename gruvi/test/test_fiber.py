@@ -8,6 +8,7 @@
 
 from __future__ import absolute_import, print_function
 
+import time
 import pyuv
 import gruvi
 from gruvi.test import UnitTest
@@ -53,3 +54,56 @@ class TestFiber(UnitTest):
         gr1 = gruvi.Fiber(target)
         gr1.start()
         hub.switch()
+
+    def test_fiber_pool(self):
+        hub = gruvi.Hub.get()
+        pool = gruvi.FiberPool(size=10, max_idle=5)
+        result = []
+        for i in range(10):
+            pool.spawn(result.append, i)
+        hub.switch()
+        assert result == list(range(10))
+        assert pool.misses == 10
+        assert pool.active == 0
+        for i in range(10):
+            pool.spawn(result.append, i)
+        hub.switch()
+        assert result == list(range(10)) * 2
+        assert pool.hits == 5
+        assert pool.queued == 0
+
+    def test_fiber_pool_queue(self):
+        hub = gruvi.Hub.get()
+        pool = gruvi.FiberPool(size=2)
+        running = [0]
+        result = []
+        def worker(i):
+            running[0] += 1
+            result.append(running[0])
+            gruvi.util.sleep(0.01)
+            running[0] -= 1
+        for i in range(10):
+            pool.spawn(worker, i)
+        hub.switch()
+        assert len(result) == 10
+        assert max(result) == 2
+        assert pool.misses == 2
+        assert pool.queued == 8
+        assert pool.queue_delay > 0
+
+    def test_fiber_pool_speed(self):
+        hub = gruvi.Hub.get()
+        pool = gruvi.FiberPool()
+        def worker():
+            pass
+        for name, spawn in (('fibers', lambda: gruvi.Fiber(worker).start()),
+                            ('pool', lambda: pool.spawn(worker))):
+            count = 0
+            t0 = time.time()
+            while time.time() - t0 < 0.5:
+                for i in range(100):
+                    spawn()
+                hub.switch()
+                count += 100
+            speed = count / (time.time() - t0)
+            print('Speed ({0}): {1:.0f} spawns/sec'.format(name, speed))
@@ -8,9 +8,96 @@
 
 from __future__ import absolute_import, print_function
 
+import io
+import os
+import sys
+import zlib
 import time
-from gruvi.test import UnitTest
+import signal
+import socket
+import subprocess
+import gruvi
+from gruvi.test import UnitTest, assert_raises
 from gruvi.http import HttpParser, HttpMessage, HttpServer, HttpClient
+from gruvi.http import HttpError
+from gruvi.http import HttpHeaders, get_header
+from gruvi.http import HttpConnectionPool, HttpProxy, geturlinfo
+from gruvi.http import HttpResponseWriter, HttpRouter
+from gruvi.http import _ServerResponse
+from gruvi.reader import SpooledReader
+from gruvi import http_ffi
+
+
+class CallbackParser(object):
+    # A request parser with a Python callback for each URL, header field,
+    # header value and body chunk, as HttpParser had before these were
+    # collected in C. Used as the reference in test_request_corpus_speed.
+
+    def __init__(self):
+        ffi, lib = http_ffi.ffi, http_ffi.lib
+        self._parser = ffi.new('http_parser *')
+        lib.http_parser_init(self._parser, lib.HTTP_REQUEST)
+        self._settings = ffi.new('http_parser_settings *')
+        self._callbacks = []
+        for name in ('message_begin', 'url', 'header_field', 'header_value',
+                     'headers_complete', 'body', 'message_complete'):
+            cbtype = 'http_cb' if 'complete' in name or 'begin' in name \
+                        else 'http_data_cb'
+            cb = ffi.callback(cbtype, getattr(self, '_on_' + name))
+            self._callbacks.append(cb)
+            setattr(self._settings, 'on_' + name, cb)
+        self.messages = []
+
+    def feed(self, data):
+        return http_ffi.lib.http_parser_execute(self._parser, self._settings,
+                                                data, len(data))
+
+    def _on_message_begin(self, parser):
+        self._message = HttpMessage()
+        self._url = bytearray()
+        self._data = bytearray()
+        self._name = None
+        return 0
+
+    def _on_url(self, parser, at, length):
+        self._url.extend(http_ffi.ffi.buffer(at, length))
+        return 0
+
+    def _on_header_field(self, parser, at, length):
+        if self._name is not None:
+            value = self._data.decode('iso-8859-1')
+            self._message.headers.append((self._name, value))
+            self._name = None
+            del self._data[:]
+        self._data.extend(http_ffi.ffi.buffer(at, length))
+        return 0
+
+    def _on_header_value(self, parser, at, length):
+        if self._name is None:
+            self._name = self._data.decode('iso-8859-1')
+            del self._data[:]
+        self._data.extend(http_ffi.ffi.buffer(at, length))
+        return 0
+
+    def _on_headers_complete(self, parser):
+        msg = self._message
+        if self._name is not None:
+            msg.headers.append((self._name, self._data.decode('iso-8859-1')))
+            self._name = None
+        msg.method = http_ffi.ffi.string(
+                http_ffi.lib.http_method_str(parser.method))
+        msg.url = self._url.decode('iso-8859-1')
+        msg.version = (parser.http_major, parser.http_minor)
+        self.messages.append(msg)
+        return 0
+
+    def _on_body(self, parser, at, length):
+        self._message.body._feed(http_ffi.ffi.buffer(at, length)[:])
+        return 0
+
+    def _on_message_complete(self, parser):
+        self._message.body._feed(b'')
+        return 0
 
 
 class TestHttpParser(UnitTest):
@@ -28,6 +115,16 @@ class TestHttpParser(UnitTest):
         assert msg.headers == [('Host', 'example.com')]
         assert msg.body.read() == b''
 
+    def test_parsed_url(self):
+        r = b'GET /foo/bar?baz=1 HTTP/1.1\r\n\r\n' \
+            b'GET http://example.com/qux HTTP/1.1\r\n\r\n'
+        parser = HttpParser()
+        parser.feed(r)
+        msg = parser.pop_message()
+        assert msg.parsed_url == ['/foo/bar', 'baz=1']
+        msg = parser.pop_message()
+        assert msg.parsed_url == ['/qux', '']
+
     def test_request_with_body(self):
         r = b'GET / HTTP/1.1\r\nHost: example.com\r\n' \
             b'Content-Length: 3\r\n\r\nFoo'
@@ -42,6 +139,42 @@ class TestHttpParser(UnitTest):
         assert msg.headers == [('Host', 'example.com'), ('Content-Length', '3')]
         assert msg.body.read() == b'Foo'
 
+    def test_request_with_spooled_body(self):
+        r = b'POST / HTTP/1.1\r\nHost: example.com\r\n' \
+            b'Content-Length: 11\r\n\r\nFoo\nBar\nBaz'
+        parser = HttpParser(HttpParser.HTTP_REQUEST, spool_threshold=5)
+        nbytes = parser.feed(r)
+        assert nbytes == len(r)
+        msg = parser.pop_message()
+        assert isinstance(msg.body, SpooledReader)
+        assert msg.body._buffer_size == 0
+        assert msg.body.readline() == b'Foo\n'
+        assert msg.body.read(2) == b'Ba'
+        assert msg.body.seekable()
+        msg.body.seek(0)
+        assert msg.body.read() == b'Foo\nBar\nBaz'
+        msg.body.close()
+
+    def test_request_with_chunked_spooled_body(self):
+        r = b'POST / HTTP/1.1\r\nHost: example.com\r\n' \
+            b'Transfer-Encoding: chunked\r\n\r\n' \
+            b'3\r\nFoo\r\n3\r\nBar\r\n0\r\n\r\n'
+        parser = HttpParser(HttpParser.HTTP_REQUEST, spool_threshold=1000)
+        parser.feed(r)
+        msg = parser.pop_message()
+        assert isinstance(msg.body, SpooledReader)
+        assert msg.body.read() == b'FooBar'
+        msg.body.close()
+
+    def test_request_below_spool_threshold(self):
+        r = b'POST / HTTP/1.1\r\nHost: example.com\r\n' \
+            b'Content-Length: 3\r\n\r\nFoo'
+        parser = HttpParser(HttpParser.HTTP_REQUEST, spool_threshold=5)
+        parser.feed(r)
+        msg = parser.pop_message()
+        assert not isinstance(msg.body, SpooledReader)
+        assert msg.body.read() == b'Foo'
+
     def test_request_with_body_incremental(self):
         r = b'GET / HTTP/1.1\r\nHost: example.com\r\n' \
             b'Content-Length: 3\r\n\r\nFoo'
@@ -255,6 +388,52 @@ class TestHttpParser(UnitTest):
             assert msg.headers == [('Content-Length', '4')]
             assert msg.body.read() == 'Foo{0}'.format(i).encode('ascii')
 
+    def test_interim_response(self):
+        r = b'HTTP/1.1 100 Continue\r\n\r\n' \
+            b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nfoo'
+        parser = HttpParser()
+        parser.push_request('POST')
+        parser.feed(r[:25])
+        msg = parser.pop_message()
+        assert msg.status_code == 100
+        assert list(parser.requests) == ['POST']
+        parser.feed(r[25:])
+        msg = parser.pop_message()
+        assert msg.status_code == 200
+        assert msg.body.read() == b'foo'
+        assert not parser.requests
+
+    def test_response_with_gzip_body(self):
+        body = b'foo bar baz ' * 1000
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(body) + compressor.flush()
+        r = b'HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\n' \
+            b'Transfer-Encoding: chunked\r\n\r\n'
+        r += '{0:X}\r\n'.format(len(data)).encode('ascii') + data
+        r += b'\r\n0\r\n\r\n'
+        parser = HttpParser(HttpParser.HTTP_RESPONSE, decompress=True)
+        for i in range(0, len(r), 10):
+            parser.feed(r[i:i+10])
+        msg = parser.pop_message()
+        assert msg.headers.get('Content-Encoding') is None
+        assert msg.body.read() == body
+
+    def test_response_with_deflate_body(self):
+        body = b'foo bar baz ' * 1000
+        # Both zlib wrapped and raw deflate data are accepted.
+        for data in (zlib.compress(body), zlib.compress(body)[2:-4]):
+            clen = '{0}'.format(len(data)).encode('ascii')
+            r = b'HTTP/1.1 200 OK\r\nContent-Encoding: deflate\r\n' \
+                b'Content-Length: ' + clen + b'\r\n\r\n' + data
+            # Start with a body of a single byte, to test the detection.
+            hlen = len(r) - len(data)
+            parser = HttpParser(HttpParser.HTTP_RESPONSE, decompress=True)
+            parser.feed(r[:hlen+1])
+            parser.feed(r[hlen+1:])
+            msg = parser.pop_message()
+            assert msg.headers.get('Content-Length') is None
+            assert msg.body.read() == body
+
     def test_pipelined_head_responses(self):
         r = b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\n' \
             b'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\n'
@@ -300,6 +479,118 @@ class TestHttpParser(UnitTest):
         assert msg.headers == [('Cookie', 'foo0')]
         assert msg.body.read() == b'HTTP/1.1 204 OK\r\nCookie: foo1\r\n\r\n'
 
+    def test_headers(self):
+        headers = HttpHeaders([('Host', 'example.com'), ('X-Foo', 'bar')])
+        assert headers.get('host') == 'example.com'
+        assert headers.get('X-FOO') == 'bar'
+        assert headers.get('Baz', 'qux') == 'qux'
+        headers.append(('baz', 'qux2'))
+        assert headers.get('Baz') == 'qux2'
+        assert get_header(headers, 'x-foo') == 'bar'
+        assert headers == [('Host', 'example.com'), ('X-Foo', 'bar'),
+                           ('baz', 'qux2')]
+
+    def test_wsgi_environ(self):
+        r = b'POST /foo?bar HTTP/1.1\r\nHost: example.com\r\n' \
+            b'content-type: text/plain\r\nContent-Length: 3\r\n' \
+            b'X-Custom-Header: 1\r\n\r\nfoo'
+        parser = HttpParser()
+        parser.feed(r)
+        msg = parser.pop_message()
+        assert isinstance(msg.headers, HttpHeaders)
+        assert msg.headers.get('CONTENT-TYPE') == 'text/plain'
+        env = msg.get_wsgi_environ()
+        assert env['REQUEST_METHOD'] == 'POST'
+        assert env['HTTP_HOST'] == 'example.com'
+        assert env['CONTENT_TYPE'] == 'text/plain'
+        assert env['CONTENT_LENGTH'] == '3'
+        assert env['HTTP_X_CUSTOM_HEADER'] == '1'
+        assert 'HTTP_CONTENT_LENGTH' not in env
+
+    def test_request_header_speed(self):
+        r = b'GET / HTTP/1.1\r\nHost: example.com\r\n' \
+            b'User-Agent: Mozilla/5.0\r\nAccept: */*\r\n' \
+            b'Accept-Encoding: gzip, deflate\r\n' \
+            b'Accept-Language: en-US,en;q=0.5\r\n' \
+            b'Cookie: session=1234\r\nConnection: keep-alive\r\n\r\n'
+        reqs = 10 * r
+        parser = HttpParser()
+        nrequests = 0
+        t0 = time.time()
+        while time.time() - t0 < 0.5:
+            parser.feed(reqs)
+            while True:
+                msg = parser.pop_message()
+                if msg is None:
+                    break
+                msg.get_wsgi_environ()
+                msg.headers.get('Connection')
+                nrequests += 1
+        speed = nrequests / (time.time() - t0)
+        print('Speed: {0:.0f} requests/sec'.format(speed))
+
+    def test_request_corpus_speed(self):
+        # A mix of requests as sent by browsers, command-line tools and API
+        # clients.
+        corpus = [
+            b'GET /index.html HTTP/1.1\r\nHost: www.example.com\r\n'
+            b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:24.0) '
+            b'Gecko/20100101 Firefox/24.0\r\n'
+            b'Accept: text/html,application/xhtml+xml,application/xml;'
+            b'q=0.9,*/*;q=0.8\r\nAccept-Language: en-US,en;q=0.5\r\n'
+            b'Accept-Encoding: gzip, deflate\r\n'
+            b'Cookie: session=7f3a9b2c; theme=dark\r\n'
+            b'Connection: keep-alive\r\nCache-Control: max-age=0\r\n\r\n',
+            b'GET /api/v1/items?page=2&size=50 HTTP/1.1\r\n'
+            b'Host: api.example.com\r\nUser-Agent: curl/7.32.0\r\n'
+            b'Accept: */*\r\n\r\n',
+            b'POST /api/v1/items HTTP/1.1\r\nHost: api.example.com\r\n'
+            b'Content-Type: application/json\r\nContent-Length: 27\r\n'
+            b'Authorization: Bearer 0123456789abcdef\r\n\r\n'
+            b'{"name": "foo", "qty": 100}',
+            b'PUT /upload HTTP/1.1\r\nHost: example.com\r\n'
+            b'Transfer-Encoding: chunked\r\n\r\n'
+            b'5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n',
+            b'GET /static/style.css HTTP/1.1\r\nHost: www.example.com\r\n'
+            b'Referer: http://www.example.com/index.html\r\n'
+            b'If-Modified-Since: Sat, 29 Oct 1994 19:43:31 GMT\r\n'
+            b'If-None-Match: "737060cd8c284d8af7ad3082f209582d"\r\n\r\n']
+        data = b''.join(corpus) * 10
+        def callbacks():
+            parser = CallbackParser()
+            nbytes = parser.feed(data)
+            for msg in parser.messages:
+                msg.body.read()
+            return nbytes, len(parser.messages)
+        parser = HttpParser()
+        def collected():
+            nbytes = parser.feed(data)
+            nrequests = 0
+            while True:
+                msg = parser.pop_message()
+                if msg is None:
+                    break
+                msg.body.read()
+                nrequests += 1
+            return nbytes, nrequests
+        speeds = []
+        for name, parse in (('callbacks', callbacks),
+                            ('collected in C', collected)):
+            nrequests = nbytes = 0
+            t0 = time.time()
+            while time.time() - t0 < 0.5:
+                n, m = parse()
+                nbytes += n
+                nrequests += m
+            t1 = time.time()
+            assert nrequests % len(corpus) == 0
+            speeds.append(nrequests / (t1 - t0))
+            print('Speed ({0}): {1:.0f} requests/sec, {2:.2f} MiB/sec'
+                        .format(name, speeds[-1],
+                                nbytes / (1024 * 1024 * (t1 - t0))))
+        print('Speed (collected/callbacks): {0:.2f}x'
+                    .format(speeds[1] / speeds[0]))
+
     def test_speed(self):
         r = b'HTTP/1.1 200 OK\r\nContent-Length: 1000\r\n\r\n'
         r += b'x' * 1000
@@ -331,6 +622,58 @@ def hello_app(environ, start_response):
     return ['Hello!']
 
 
+def echo_app(environ, start_response):
+    body = environ['wsgi.input'].read()
+    headers = [('Content-Type', 'text/plain'),
+               ('Content-Length', str(len(body)))]
+    start_response('200 OK', headers)
+    return [body]
+
+
+def create_header_uncached(server_id, response):
+    # The response header code before status lines and header names were
+    # cached. Used as the reference in test_create_header_speed.
+    headers = response.headers
+    clen = get_header(headers, 'Content-Length')
+    response.chunked = clen is None and response.version == (1, 1)
+    if response.chunked:
+        headers.append(('Transfer-Encoding', 'chunked'))
+    if not clen and response.version == (1, 0):
+        response.keepalive = False
+    if response.version == (1, 1) and not response.keepalive:
+        headers.append(('Connection', 'close'))
+    elif response.version == (1, 0) and response.keepalive:
+        headers.append(('Connection', 'keep-alive'))
+    if get_header(headers, 'Server') is None:
+        headers.append(('Server', server_id))
+    response.headers_sent = True
+    message = bytearray()
+    status = 'HTTP/{0[0]}.{0[1]} {1}\r\n'.format(response.version,
+                                                  response.status)
+    message.extend(status.encode('iso-8859-1'))
+    for name,value in headers:
+        line = '{0}: {1}\r\n'.format(name, value)
+        message.extend(line.encode('iso-8859-1'))
+    message.extend(b'\r\n')
+    return message
+
+
+# A server with two worker processes, that runs until it gets SIGTERM.
+worker_script = '''
+import os, sys, time, gruvi
+from gruvi.http import HttpServer
+def pid_app(environ, start_response):
+    time.sleep(0.05)  # block this worker so that another one accepts
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+server = HttpServer(pid_app)
+server.listen(('localhost', int(sys.argv[1])), workers=2)
+if server.transport is not None:
+    gruvi.get_hub().switch()  # in a worker
+server.close()
+'''
+
+
 class TestHttp(UnitTest):
 
     def test_simple(self):
@@ -348,3 +691,852 @@ class TestHttp(UnitTest):
         ctype = response.get_header('Content-Type')
         assert ctype == 'text/plain'
         assert response.read() == b'Hello!'
+
+    def test_workers(self):
+        sock = socket.socket()
+        sock.bind(('localhost', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        script = self.tempname('workers.py')
+        with open(script, 'w') as fout:
+            fout.write(worker_script)
+        env = os.environ.copy()
+        topdir = os.path.abspath(gruvi.__file__)
+        topdir = os.path.dirname(os.path.dirname(topdir))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None,
+                                (topdir, env.get('PYTHONPATH'))))
+        master = subprocess.Popen([sys.executable, script, str(port)], env=env)
+        pids = set()
+        def fetch():
+            client = HttpClient()
+            client.connect(('localhost', port))
+            client.request('GET', '/')
+            response = client.getresponse()
+            pids.add(int(response.read()))
+            client.close()
+        def fetch_until(func, timeout=10):
+            # Make concurrent requests until func() returns True.
+            t0 = time.time()
+            while not func():
+                assert time.time() - t0 < timeout
+                fibers = [gruvi.Fiber(fetch) for i in range(4)]
+                for fiber in fibers:
+                    fiber.start()
+                gruvi.util.sleep(0.2)
+        try:
+            t0 = time.time()
+            while True:
+                try:
+                    fetch()
+                    break
+                except gruvi.Error:
+                    assert time.time() - t0 < 10
+                    gruvi.util.sleep(0.1)
+            # Requests are served by both workers.
+            fetch_until(lambda: len(pids) >= 2)
+            assert master.pid not in pids
+            # A killed worker is restarted.
+            seen = set(pids)
+            os.kill(min(seen), signal.SIGKILL)
+            fetch_until(lambda: pids - seen)
+        finally:
+            master.send_signal(signal.SIGTERM)
+            t0 = time.time()
+            while master.poll() is None and time.time() - t0 < 10:
+                time.sleep(0.1)
+        assert master.returncode == 0
+        # The workers were stopped and reaped by the master.
+        for pid in pids:
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                continue
+            raise AssertionError('worker {0} is still running'.format(pid))
+
+    def test_close_reaps_workers(self):
+        # Workers that are left when supervision was interrupted by an error
+        # are stopped by close().
+        server = HttpServer(hello_app)
+        pid = os.fork()
+        if pid == 0:
+            time.sleep(10)
+            os._exit(0)
+        server._worker_pids[pid] = time.time()
+        t0 = time.time()
+        server.close()
+        assert time.time() - t0 < 5
+        assert not server._worker_pids
+        try:
+            os.waitpid(pid, os.WNOHANG)
+        except OSError:
+            pass  # already reaped
+        else:
+            raise AssertionError('worker {0} was not reaped'.format(pid))
+
+    def test_date_header(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        client.request('GET', '/')
+        response = client.getresponse()
+        date = response.get_header('Date')
+        assert date.endswith(' GMT')
+        assert response.read() == b'Hello!'
+        server.close()
+
+    def test_create_header(self):
+        server = HttpServer(hello_app)
+        response = _ServerResponse((1, 1), True)
+        response.status = '200 OK'
+        response.headers = [('Content-Length', 6), ('Server', 'foo')]
+        header = server._create_header(response)
+        lines = header.split(b'\r\n')
+        assert lines[0] == b'HTTP/1.1 200 OK'
+        assert b'Content-Length: 6' in lines
+        assert b'Server: foo' in lines
+        assert lines[-3].startswith(b'Date: ')
+        assert lines[-2:] == [b'', b'']
+        assert not response.chunked
+        response = _ServerResponse((1, 0), False)
+        response.status = '404 Not Found'
+        response.headers = []
+        header = server._create_header(response)
+        assert header.startswith(b'HTTP/1.0 404 Not Found\r\n')
+        assert b'Connection' not in header
+        assert b'Server: gruvi.http' in header
+        server.close()
+
+    def test_date_timer_closed(self):
+        server = HttpServer(hello_app)
+        response = _ServerResponse((1, 1), True)
+        response.status = '200 OK'
+        server._create_header(response)
+        # Closing all handles, like the test teardown does, also closes the
+        # timer that updates the Date header. It must be restarted.
+        server._date_timer.close()
+        server._date_line = None
+        response = _ServerResponse((1, 1), True)
+        response.status = '200 OK'
+        header = server._create_header(response)
+        assert b'\r\nDate: ' in header
+        assert not server._date_timer.closed
+        server._date_timer.close()
+        server.close()
+        assert server._date_timer is None
+
+    def test_create_header_speed(self):
+        server = HttpServer(hello_app)
+        headers = [('Content-Type', 'text/plain'), ('Content-Length', '13')]
+        # The uncached reference does not add a Date header.
+        uncached = lambda r: create_header_uncached(server.server_id, r)
+        speeds = []
+        for name, create in (('uncached', uncached),
+                             ('cached', server._create_header)):
+            nheaders = 0
+            t0 = time.time()
+            while time.time() - t0 < 0.2:
+                for i in range(100):
+                    response = _ServerResponse((1, 1), True)
+                    response.status = '200 OK'
+                    response.headers = list(headers)
+                    create(response)
+                nheaders += 100
+            speeds.append(nheaders / (time.time() - t0))
+            print('Speed ({0}): {1:.0f} headers/sec'.format(name, speeds[-1]))
+        print('Speed (cached/uncached): {0:.2f}x'.format(speeds[1] / speeds[0]))
+        server.close()
+
+    def test_chunked_upload(self):
+        server = HttpServer(echo_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        body = (chunk for chunk in (b'foo', b'', b'bar'))
+        client.request('POST', '/', body=body)
+        response = client.getresponse()
+        assert response.read() == b'foobar'
+
+    def test_file_upload(self):
+        server = HttpServer(echo_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.chunk_size = 1000
+        client.connect(('localhost', port))
+        data = b'x' * 100000
+        client.request('PUT', '/', body=io.BytesIO(data))
+        response = client.getresponse()
+        assert response.read() == data
+        client.request('PUT', '/', [('Content-Length', str(len(data)))],
+                       io.BytesIO(data))
+        response = client.getresponse()
+        assert response.read() == data
+        # A text file returns '' at EOF.
+        client.request('PUT', '/', body=io.StringIO(u'foo' * 1000))
+        response = client.getresponse()
+        assert response.read() == b'foo' * 1000
+
+    def test_expect_continue(self):
+        server = HttpServer(echo_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        t0 = time.time()
+        client.request('POST', '/', [('Expect', '100-continue')], [b'foo'])
+        response = client.getresponse()
+        assert response.status == 200
+        assert response.read() == b'foo'
+        assert time.time() - t0 < client.continue_timeout
+        t0 = time.time()
+        client.request('POST', '/', [('Expect', '100-continue')], b'bar')
+        response = client.getresponse()
+        assert response.status == 200
+        assert response.read() == b'bar'
+        assert time.time() - t0 < client.continue_timeout
+
+    def test_shared_request_headers(self):
+        server = HttpServer(echo_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        headers = [('Content-Type', 'text/plain')]
+        client.request('POST', '/', headers, b'foo')
+        response = client.getresponse()
+        assert response.read() == b'foo'
+        client.request('POST', '/', headers, b'barbaz')
+        response = client.getresponse()
+        assert response.read() == b'barbaz'
+        client.request('POST', '/', headers, [b'qux'])
+        response = client.getresponse()
+        assert response.read() == b'qux'
+        assert headers == [('Content-Type', 'text/plain')]
+
+    def test_compressed_response(self):
+        body = b'Hello, world! ' * 1000
+        def app(environ, start_response):
+            headers = [('Content-Type', 'text/plain'),
+                       ('Content-Length', str(len(body)))]
+            start_response('200 OK', headers)
+            return [body]
+        server = HttpServer(app, compress_threshold=1000)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.decompress = True
+        client.connect(('localhost', port))
+        client.request('GET', '/')
+        response = client.getresponse()
+        assert response.get_header('Vary') == 'Accept-Encoding'
+        assert response.get_header('Content-Encoding') is None
+        assert response.get_header('Content-Length') is None
+        assert response.read() == body
+        client.request('GET', '/', [('Accept-Encoding', 'identity')])
+        response = client.getresponse()
+        assert response.get_header('Content-Encoding') is None
+        assert response.read() == body
+
+    def test_compressed_streaming_response(self):
+        chunk = b'Hello, world! ' * 100
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            yield chunk
+            gruvi.util.sleep(0.5)
+            yield chunk
+        server = HttpServer(app, compress_threshold=1000)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.decompress = True
+        client.connect(('localhost', port))
+        t0 = time.time()
+        client.request('GET', '/')
+        response = client.getresponse()
+        assert response.get_header('Vary') == 'Accept-Encoding'
+        # The first chunk must not stay buffered in the compressor.
+        data = b''
+        while len(data) < len(chunk):
+            buf = response.read(len(chunk) - len(data))
+            assert buf
+            data += buf
+        assert data == chunk
+        assert time.time() - t0 < 0.5
+        assert response.read() == chunk
+        server.close()
+
+    def test_readinto(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        client.request('GET', '/')
+        response = client.getresponse()
+        buf = bytearray(100)
+        nbytes = 0
+        while True:
+            n = response.readinto(memoryview(buf)[nbytes:])
+            if not n:
+                break
+            nbytes += n
+        assert buf[:nbytes] == b'Hello!'
+
+    def test_file_wrapper(self):
+        data = b'x' * 100000 + b'y' * 100000
+        fname = self.tempname('file_wrapper')
+        with open(fname, 'wb') as fout:
+            fout.write(data)
+        def file_app(environ, start_response):
+            headers = [('Content-Type', 'application/octet-stream')]
+            if environ['PATH_INFO'] == '/clen':
+                headers.append(('Content-Length', '1000'))
+            elif environ['PATH_INFO'] == '/short':
+                headers.append(('Content-Length', str(len(data))))
+            start_response('200 OK', headers)
+            fin = open(fname, 'rb')
+            fin.seek(10)
+            return environ['wsgi.file_wrapper'](fin)
+        server = HttpServer(file_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        client.request('GET', '/')
+        response = client.getresponse()
+        assert response.get_header('Transfer-Encoding') == 'chunked'
+        assert response.read() == data[10:]
+        client.request('GET', '/clen')
+        response = client.getresponse()
+        assert response.read() == data[10:1010]
+        # The file is shorter than the Content-Length: the connection is
+        # closed rather than sending a short response.
+        client.request('GET', '/short')
+        assert_raises(HttpError, client.getresponse)
+
+    def test_spooled_upload(self):
+        def upload_app(environ, start_response):
+            body = environ['wsgi.input']
+            assert body.seekable()
+            data = body.read()
+            body.seek(0)
+            assert body.read() == data
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [str(len(data))]
+        server = HttpServer(upload_app, spool_threshold=1000)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        body = b'x' * 1000000
+        headers = [('Content-Length', str(len(body)))]
+        client.request('POST', '/', headers, body)
+        response = client.getresponse()
+        assert response.read() == b'1000000'
+
+    def test_concurrent_pipelining(self):
+        def sleep_app(environ, start_response):
+            delay = float(environ['PATH_INFO'][1:])
+            gruvi.util.sleep(delay)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['PATH_INFO']]
+        server = HttpServer(sleep_app)
+        server.concurrent_pipelining = True
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        paths = ['/0.2', '/0.1', '/0']
+        t0 = time.time()
+        for path in paths:
+            client.request('GET', path)
+        for path in paths:
+            response = client.getresponse()
+            assert response.status == 200
+            assert response.read() == path.encode('ascii')
+        assert time.time() - t0 < 0.3
+
+    def test_concurrent_pipelining_limit(self):
+        running = [0, 0]
+        def sleep_app(environ, start_response):
+            running[0] += 1
+            running[1] = max(running)
+            gruvi.util.sleep(0.05)
+            running[0] -= 1
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [environ['PATH_INFO']]
+        server = HttpServer(sleep_app)
+        server.concurrent_pipelining = True
+        server.max_pipeline_size = 2
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        paths = ['/{0}'.format(i) for i in range(6)]
+        for path in paths:
+            client.request('GET', path)
+        for path in paths:
+            response = client.getresponse()
+            assert response.status == 200
+            assert response.read() == path.encode('ascii')
+        assert running[1] == 2
+
+    def test_fiber_pool(self):
+        server = HttpServer(hello_app)
+        server.fiber_pool = gruvi.FiberPool()
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        for i in range(3):
+            client = HttpClient()
+            client.connect(('localhost', port))
+            client.request('GET', '/')
+            response = client.getresponse()
+            assert response.read() == b'Hello!'
+            client.close()
+        pool = server.fiber_pool
+        assert pool.hits + pool.misses == 3
+
+    def test_request_async(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        futures = [client.request_async('GET', '/') for i in range(5)]
+        for future in futures:
+            response = future.result()
+            assert response.status == 200
+            assert response.read() == b'Hello!'
+            assert future.done()
+
+    def test_fetch_many(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.max_pipeline_depth = 2
+        client.connect(('localhost', port))
+        requests = [('GET', '/'), ('POST', '/', None, b'foo'), ('GET', '/'),
+                    ('HEAD', '/'), ('GET', '/')]
+        responses = client.fetch_many(requests)
+        assert len(responses) == 5
+        for request, response in zip(requests, responses):
+            assert response.status == 200
+            body = b'' if request[0] == 'HEAD' else b'Hello!'
+            assert response.read() == body
+        assert not client._pipeline_inflight
+
+    def test_fetch_many_speed(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        requests = [('GET', '/')] * 10
+        def sequential():
+            for request in requests:
+                client.request(*request)
+                response = client.getresponse()
+                assert response.read() == b'Hello!'
+        def pipelined():
+            for response in client.fetch_many(requests):
+                assert response.read() == b'Hello!'
+        for name, func in (('sequential', sequential), ('fetch_many', pipelined)):
+            nrequests = 0
+            t0 = time.time()
+            while time.time() - t0 < 0.5:
+                func()
+                nrequests += len(requests)
+            speed = nrequests / (time.time() - t0)
+            print('Speed ({0}): {1:.0f} requests/sec'.format(name, speed))
+
+    def test_geturlinfo(self):
+        assert geturlinfo('http://foo/') == ('foo', 80, False, '/')
+        assert geturlinfo('https://foo:8443') == ('foo', 8443, True, '/')
+        assert geturlinfo('http://foo/bar?baz') == ('foo', 80, False, '/bar?baz')
+
+    def test_connection_pool(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        url = 'http://localhost:{0}/'.format(port)
+        pool = HttpConnectionPool()
+        for i in range(5):
+            response = pool.request('GET', url)
+            assert response.status == 200
+            assert response.read() == b'Hello!'
+        assert pool.misses == 1
+        assert pool.hits == 4
+        pool.close()
+
+    def test_connection_pool_limit(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        url = 'http://localhost:{0}/'.format(port)
+        pool = HttpConnectionPool(max_connections_per_host=2)
+        result = []
+        def fetch():
+            response = pool.request('GET', url)
+            gruvi.util.sleep(0.01)
+            result.append(response.read())
+        fibers = [gruvi.Fiber(fetch) for i in range(6)]
+        for fiber in fibers:
+            fiber.start()
+        gruvi.util.sleep(0.2)
+        assert result == [b'Hello!'] * 6
+        assert pool.misses == 2
+        assert pool.hits == 4
+        pool.close()
+
+    def test_connection_pool_abandoned(self):
+        # A response whose body is not read must be closed to release its
+        # connection. The connection is then not reused.
+        def big_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return (b'x' * 65536 for i in range(100))
+        server = HttpServer(big_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        url = 'http://localhost:{0}/'.format(port)
+        pool = HttpConnectionPool(max_connections_per_host=1, timeout=5)
+        response = pool.request('GET', url)
+        assert response.status == 200
+        response.close()
+        with pool.request('GET', url) as response:
+            assert len(response.read()) == 6553600
+        assert pool.misses == 2
+        response = pool.request('GET', url)
+        response.read()
+        response.close()  # the connection was already released
+        assert pool.hits == 1
+        pool.close()
+
+    def test_connection_pool_speed(self):
+        # Compare a new connection per request with a pooled connection.
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        url = 'http://localhost:{0}/'.format(port)
+        def new_connection():
+            client = HttpClient()
+            client.connect(('localhost', port))
+            client.request('GET', '/')
+            response = client.getresponse()
+            assert response.read() == b'Hello!'
+            client.close()
+        pool = HttpConnectionPool()
+        def pooled():
+            response = pool.request('GET', url)
+            assert response.read() == b'Hello!'
+        for name, func in (('new connection', new_connection), ('pool', pooled)):
+            nrequests = 0
+            t0 = time.time()
+            while time.time() - t0 < 0.5:
+                func()
+                nrequests += 1
+            speed = nrequests / (time.time() - t0)
+            print('Speed ({0}): {1:.0f} requests/sec'.format(name, speed))
+        pool.close()
+
+    def test_native_handler(self):
+        def handler(request, response):
+            assert isinstance(response, HttpResponseWriter)
+            if request.method == 'POST':
+                response.start(201, [('Content-Type', 'text/plain')])
+                response.write(request.body.read())
+                response.write(b'!')
+            else:
+                response.start('200 OK', [('Content-Type', 'text/plain')])
+                response.finish(request.headers.get('X-Name'))
+        server = HttpServer(handler, native=True)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        client.request('GET', '/', [('X-Name', 'foo')])
+        response = client.getresponse()
+        assert response.status == 200
+        assert response.get_header('Content-Length') == '3'
+        assert response.read() == b'foo'
+        client.request('POST', '/', body=b'bar')
+        response = client.getresponse()
+        assert response.status == 201
+        assert response.get_header('Transfer-Encoding') == 'chunked'
+        assert response.read() == b'bar!'
+        server.close()
+
+    def test_native_handler_not_started(self):
+        errors = []
+        def handler(request, response):
+            for func in (response.write, response.finish):
+                try:
+                    func(b'foo')
+                except RuntimeError as e:
+                    errors.append(str(e))
+            response.start(200)
+            response.finish(b'bar')
+            try:
+                response.write(b'baz')
+            except RuntimeError as e:
+                errors.append(str(e))
+        server = HttpServer(handler, native=True)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        client.request('GET', '/')
+        response = client.getresponse()
+        assert response.status == 200
+        assert response.read() == b'bar'
+        assert errors == ['response not started'] * 2 + \
+                         ['response already finished']
+        server.close()
+
+    def test_native_handler_speed(self):
+        # Compare the WSGI interface with the native handler interface.
+        def native_hello(request, response):
+            response.start('200 OK', [('Content-Type', 'text/plain')])
+            response.finish(b'Hello!')
+        for name, handler, native in (('wsgi', hello_app, False),
+                                      ('native', native_hello, True)):
+            server = HttpServer(handler, native=native)
+            server.listen(('localhost', 0))
+            port = server.transport.getsockname()[1]
+            client = HttpClient()
+            client.connect(('localhost', port))
+            nrequests = 0
+            t0 = time.time()
+            while time.time() - t0 < 0.5:
+                client.request('GET', '/')
+                response = client.getresponse()
+                assert response.read() == b'Hello!'
+                nrequests += 1
+            speed = nrequests / (time.time() - t0)
+            print('Speed ({0}): {1:.0f} requests/sec'.format(name, speed))
+            client.close()
+            server.close()
+
+    def test_router_match(self):
+        router = HttpRouter()
+        router.add_route('GET', '/', 'index')
+        router.add_route('GET', '/users/{id}', 'get_user')
+        router.add_route('PUT', '/users/{id}', 'put_user')
+        router.add_route('GET', '/users/me', 'me')
+        router.add_route(None, '/users/{id}/posts/{post}', 'post')
+        assert router.match('GET', '/') == ('index', {}, None)
+        assert router.match('GET', '/users/1') == \
+                    ('get_user', {'id': '1'}, None)
+        assert router.match('HEAD', '/users/1')[0] == 'get_user'
+        assert router.match('PUT', '/users/me') == \
+                    ('put_user', {'id': 'me'}, None)
+        assert router.match('GET', '/users/me') == ('me', {}, None)
+        assert router.match('DELETE', '/users/1/posts/2') == \
+                    ('post', {'id': '1', 'post': '2'}, None)
+        assert router.match('DELETE', '/users/1') == \
+                    (None, {}, ['GET', 'HEAD', 'PUT'])
+        assert router.match('GET', '/users/') == (None, {}, [])
+        assert router.match('GET', '/users') == (None, {}, [])
+        assert router.match('GET', 'users') == (None, {}, [])
+        add_route = router.add_route
+        assert_raises(ValueError, add_route, 'GET', '/users/{name}', None)
+        assert_raises(ValueError, add_route, 'GET', '/users/me', None)
+        assert_raises(ValueError, add_route, 'GET', 'users', None)
+
+    def test_router(self):
+        def get_user(environ, start_response):
+            args = environ['wsgiorg.routing_args'][1]
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [args['id']]
+        router = HttpRouter()
+        router.add_route('GET', '/users/{id}', get_user)
+        server = HttpServer(router)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        client.request('GET', '/users/foo?bar')
+        response = client.getresponse()
+        assert response.status == 200
+        assert response.read() == b'foo'
+        client.request('GET', '/posts/foo')
+        response = client.getresponse()
+        assert response.status == 404
+        assert response.read() == b'Not Found'
+        client.request('POST', '/users/foo', body=b'bar')
+        response = client.getresponse()
+        assert response.status == 405
+        assert response.get_header('Allow') == 'GET, HEAD'
+        assert response.read() == b'Method Not Allowed'
+        server.close()
+
+    def test_router_native(self):
+        def get_user(request, response, id):
+            response.start(200, [('Content-Type', 'text/plain')])
+            response.finish(id)
+        router = HttpRouter(native=True)
+        router.add_route('GET', '/users/{id}', get_user)
+        server = HttpServer(router, native=True)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        client.request('GET', '/users/foo')
+        response = client.getresponse()
+        assert response.status == 200
+        assert response.read() == b'foo'
+        client.request('GET', '/')
+        response = client.getresponse()
+        assert response.status == 404
+        assert response.read() == b'Not Found'
+        server.close()
+
+    def test_router_speed(self):
+        # The time to match a route should not depend on the number of routes.
+        for nroutes in (10, 1000):
+            router = HttpRouter()
+            for i in range(nroutes):
+                router.add_route('GET', '/api/v1/resource{0}/{{id}}'.format(i),
+                                 hello_app)
+            path = '/api/v1/resource{0}/123'.format(nroutes-1)
+            nmatches = 0
+            t0 = time.time()
+            while time.time() - t0 < 0.2:
+                for i in range(1000):
+                    router.match('GET', path)
+                nmatches += 1000
+            speed = nmatches / (time.time() - t0)
+            print('Speed ({0} routes): {1:.0f} matches/sec'
+                        .format(nroutes, speed))
+
+    def test_proxy(self):
+        backends = []
+        for i in range(2):
+            def backend_app(environ, start_response, name=str(i)):
+                start_response('200 OK', [('Content-Type', 'text/plain')])
+                return [name]
+            server = HttpServer(backend_app)
+            server.listen(('localhost', 0))
+            backends.append(('localhost', server.transport.getsockname()[1]))
+        proxy = HttpProxy(backends)
+        proxy.listen(('localhost', 0))
+        port = proxy.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        result = []
+        for i in range(4):
+            client.request('GET', '/')
+            response = client.getresponse()
+            assert response.status == 200
+            assert response.get_header('Content-Type') == 'text/plain'
+            result.append(response.read())
+        assert result == [b'0', b'1', b'0', b'1']
+        proxy.close()
+
+    def test_proxy_upload(self):
+        server = HttpServer(echo_app)
+        server.listen(('localhost', 0))
+        backend = ('localhost', server.transport.getsockname()[1])
+        proxy = HttpProxy([backend], balance='least-connections')
+        proxy.listen(('localhost', 0))
+        port = proxy.transport.getsockname()[1]
+        client = HttpClient()
+        client.chunk_size = 1000
+        client.connect(('localhost', port))
+        data = b'x' * 100000
+        client.request('PUT', '/', body=io.BytesIO(data))
+        response = client.getresponse()
+        assert response.read() == data
+        client.request('PUT', '/', [('Content-Length', str(len(data)))], data)
+        response = client.getresponse()
+        assert response.read() == data
+        proxy.close()
+
+    def test_proxy_bad_gateway(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        backend = ('localhost', server.transport.getsockname()[1])
+        server.close()
+        proxy = HttpProxy([backend])
+        proxy.listen(('localhost', 0))
+        port = proxy.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        client.request('GET', '/')
+        response = client.getresponse()
+        assert response.status == 502
+        assert response.read() == b'Bad Gateway'
+        proxy.close()
+
+    def test_proxy_speed(self):
+        # Compare requests made directly to a server with proxied requests.
+        body = b'x' * 10000
+        def app(environ, start_response):
+            headers = [('Content-Type', 'application/octet-stream'),
+                       ('Content-Length', str(len(body)))]
+            start_response('200 OK', headers)
+            return [body]
+        server = HttpServer(app)
+        server.listen(('localhost', 0))
+        backend = ('localhost', server.transport.getsockname()[1])
+        proxy = HttpProxy([backend])
+        proxy.listen(('localhost', 0))
+        for name, port in (('direct', backend[1]),
+                           ('proxied', proxy.transport.getsockname()[1])):
+            client = HttpClient()
+            client.connect(('localhost', port))
+            nbytes = 0
+            t0 = time.time()
+            while time.time() - t0 < 0.5:
+                client.request('GET', '/')
+                response = client.getresponse()
+                nbytes += len(response.read())
+            speed = nbytes / (time.time() - t0) / (1024*1024)
+            print('Speed ({0}): {1:.2f} MiB/sec'.format(name, speed))
+            client.close()
+        proxy.close()
+
+    def test_request_speed(self):
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        for checks in (True, False):
+            gruvi.set_checks(checks)
+            try:
+                nrequests = 0
+                t0 = time.time()
+                while time.time() - t0 < 0.5:
+                    client.request('GET', '/')
+                    response = client.getresponse()
+                    assert response.read() == b'Hello!'
+                    nrequests += 1
+                t1 = time.time()
+            finally:
+                gruvi.set_checks(True)
+            speed = nrequests / (t1 - t0)
+            print('Speed (checks={0}): {1:.0f} requests/sec'.format(checks, speed))
+
+    def test_pipelined_request_speed(self):
+        # Small responses on a pipelined connection. This mostly measures the
+        # per-response overhead in the server.
+        server = HttpServer(hello_app)
+        server.listen(('localhost', 0))
+        port = server.transport.getsockname()[1]
+        client = HttpClient()
+        client.connect(('localhost', port))
+        nrequests = 0
+        t0 = time.time()
+        while time.time() - t0 < 0.5:
+            for i in range(10):
+                client.request('GET', '/')
+            for i in range(10):
+                response = client.getresponse()
+                assert response.read() == b'Hello!'
+            nrequests += 10
+        speed = nrequests / (time.time() - t0)
+        print('Speed: {0:.0f} pipelined requests/sec'.format(speed))
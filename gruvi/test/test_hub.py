@@ -8,8 +8,10 @@
 
 from __future__ import absolute_import, print_function
 
+import time
+import threading
 import gruvi
-from gruvi.test import UnitTest
+from gruvi.test import UnitTest, assert_raises
 import inspect
 
 
@@ -31,3 +33,216 @@ class TestHub(UnitTest):
         assert result == (1, 2, None, (), { 'qux': 'foo'})
         result = wrapper(1, 2, 3, 4, qux='foo')
         assert result == (1, 2, 3, (4,), { 'qux': 'foo'})
+
+    def test_call_later(self):
+        hub = gruvi.get_hub()
+        result = []
+        hub.call_later(0.02, result.append, 2)
+        hub.call_later(0.01, result.append, 1)
+        hub.call_later(0.03, result.append, 3)
+        hub.switch()
+        assert result == [1, 2, 3]
+
+    def test_call_later_cancel(self):
+        hub = gruvi.get_hub()
+        result = []
+        hub.call_later(0.01, result.append, 1)
+        timeout = hub.call_later(0.02, result.append, 2)
+        hub.call_later(0.03, result.append, 3)
+        assert timeout.active
+        timeout.cancel()
+        assert not timeout.active
+        hub.switch()
+        assert result == [1, 3]
+
+    def test_cancel_all(self):
+        hub = gruvi.get_hub()
+        timeouts = [hub.call_later(10, lambda: None) for i in range(100)]
+        for timeout in timeouts:
+            timeout.cancel()
+        t0 = time.time()
+        hub.switch()
+        assert time.time() - t0 < 1
+
+    def test_cancel_in_callback(self):
+        # A callback that cancels most of the pending timeouts, and that adds
+        # a new one.
+        hub = gruvi.get_hub()
+        result = []
+        timeouts = []
+        def cancel_others():
+            for timeout in timeouts[1:-1]:
+                timeout.cancel()
+            hub.call_later(0.01, result.append, 'new')
+            result.append('cancel')
+        timeouts.append(hub.call_later(0.01, cancel_others))
+        for i in range(100):
+            timeouts.append(hub.call_later(0.01, result.append, i))
+        timeouts.append(hub.call_later(0.05, result.append, 'last'))
+        hub.switch()
+        assert result == ['cancel', 'new', 'last']
+        assert hub._cancelled == 0
+        assert not hub._timeouts
+
+    def test_cancel_after_timer_closed(self):
+        # The timer may be closed by a loop.walk(), as in the test teardown.
+        hub = gruvi.get_hub()
+        timeouts = [hub.call_later(10, lambda: None) for i in range(10)]
+        hub._timer.close()
+        for timeout in timeouts:
+            timeout.cancel()
+        assert not hub._timeouts
+        result = []
+        hub.call_later(0.01, result.append, 1)
+        hub.switch()
+        assert result == [1]
+
+    def test_switch_timeout(self):
+        hub = gruvi.get_hub()
+        result = []
+        def sleeper():
+            result.append(hub.switch(0.01))
+        fibers = [gruvi.Fiber(sleeper) for i in range(100)]
+        for fiber in fibers:
+            fiber.start()
+        hub.switch()
+        assert result == [()] * 100
+
+    def test_callback_budget(self):
+        hub = gruvi.get_hub()
+        result = []
+        def callback(i):
+            result.append(i)
+            if i < 10:
+                hub.run_callback(callback, i+1)
+        hub.run_callback(callback, 0)
+        hub.switch()
+        assert result == list(range(11))
+
+    def test_callback_speed(self):
+        hub = gruvi.get_hub()
+        count = [0]
+        def callback():
+            count[0] += 1
+            if count[0] % 1000 or time.time() - t0 < 0.5:
+                hub.run_callback(callback)
+        t0 = time.time()
+        for i in range(100):
+            hub.run_callback(callback)
+        hub.switch()
+        speed = count[0] / (time.time() - t0)
+        print('Speed: {0:.0f} callbacks/sec'.format(speed))
+
+    def test_switch_back_stale(self):
+        hub = gruvi.get_hub()
+        result = []
+        def waiter():
+            switch_back = hub.switch_back()
+            hub.run_callback(switch_back, 1)
+            hub.run_callback(switch_back, 2)
+            result.append(hub.switch())
+            hub.call_later(0.01, hub.switch_back(), 3)
+            result.append(hub.switch())
+        fiber = gruvi.Fiber(waiter)
+        fiber.start()
+        hub.switch()
+        assert result == [(1,), (3,)]
+
+    def test_switch_back_stale_wait(self):
+        hub = gruvi.get_hub()
+        result = []
+        def waiter():
+            switch_back = hub.switch_back()
+            hub.call_later(0.01, switch_back, 1)
+            result.append(hub.switch())
+            # The callback fires again, before the next wait starts. It
+            # belongs to the first wait and must not end the second one.
+            switch_back(2)
+            result.append(hub.switch(0.02))
+        fiber = gruvi.Fiber(waiter)
+        fiber.start()
+        hub.switch()
+        assert result == [(1,), ()]
+
+    def test_switch_back_stale_root(self):
+        hub = gruvi.get_hub()
+        switch_back = hub.switch_back()
+        # The loop has no work, so the Hub switches back to the root directly.
+        hub.switch()
+        # A switch back that was created for the wait above is now stale.
+        switch_back('stale')
+        assert hub.switch(0.01) == ()
+
+    def test_switch_back_speed(self):
+        hub = gruvi.get_hub()
+        count = [0]
+        def waiter():
+            t0 = time.time()
+            while count[0] % 1000 or time.time() - t0 < 0.5:
+                hub.switch_back()()
+                hub.switch()
+                count[0] += 1
+            speed = count[0] / (time.time() - t0)
+            print('Speed: {0:.0f} wait/wake round-trips/sec'.format(speed))
+        fiber = gruvi.Fiber(waiter)
+        fiber.start()
+        hub.switch()
+
+    def test_switchpoint_checks(self):
+        def func():
+            return 'foo'
+        wrapper = gruvi.switchpoint(func)
+        with gruvi.assert_no_switchpoints():
+            assert_raises(RuntimeError, wrapper)
+        gruvi.set_checks(False)
+        try:
+            with gruvi.assert_no_switchpoints():
+                assert wrapper() == 'foo'
+            unwrapped = gruvi.switchpoint(func)
+            assert unwrapped is func
+            assert func.__doc__.endswith('switchpoint.*\n')
+        finally:
+            gruvi.set_checks(True)
+
+    def test_switchpoint_speed(self):
+        def func():
+            pass
+        wrapper = gruvi.switchpoint(func)
+        for checks in (True, False):
+            gruvi.set_checks(checks)
+            try:
+                count = 0
+                t0 = time.time()
+                while count % 1000 or time.time() - t0 < 0.2:
+                    wrapper()
+                    count += 1
+            finally:
+                gruvi.set_checks(True)
+            speed = count / (time.time() - t0)
+            print('Speed (checks={0}): {1:.0f} calls/sec'.format(checks, speed))
+
+    def test_run_callback_threadsafe(self):
+        hub = gruvi.get_hub()
+        result = []
+        def waiter():
+            switch_back = hub.switch_back()
+            thread = threading.Thread(target=hub.run_callback_threadsafe,
+                                      args=(switch_back, 'foo'))
+            thread.start()
+            result.append(hub.switch(10))
+            thread.join()
+        fiber = gruvi.Fiber(waiter)
+        fiber.start()
+        hub.switch()
+        assert result == [('foo',)]
+
+    def test_hub_per_thread(self):
+        hubs = []
+        def get_hub():
+            hubs.append(gruvi.get_hub())
+        thread = threading.Thread(target=get_hub)
+        thread.start()
+        thread.join()
+        hub = gruvi.get_hub()
+        assert hubs[0] is not hub
+        assert hubs[0].loop is not hub.loop
@@ -8,6 +8,9 @@
 
 from __future__ import absolute_import, print_function
 
+import os
+import time
+import threading
 import gruvi
 from gruvi.test import UnitTest
 from gruvi.stream import StreamClient, StreamServer
@@ -35,6 +38,52 @@ class TestHandles(UnitTest):
         assert result == buf
         client.close()
 
+    def test_readinto(self):
+        server = StreamServer(echo_handler)
+        server.listen(('localhost', 0))
+        addr = server.transport.getsockname()
+        client = StreamClient()
+        client.connect(addr)
+        data = b'x' * 1024
+        client.write(data)
+        buf = bytearray(2048)
+        nbytes = 0
+        while nbytes < len(data):
+            nbytes += client.readinto(memoryview(buf)[nbytes:])
+        assert buf[:nbytes] == data
+        client.close()
+
+    def test_sendfile(self):
+        server = StreamServer(echo_handler)
+        server.listen(('localhost', 0))
+        addr = server.transport.getsockname()
+        client = StreamClient()
+        client.connect(addr)
+        data = os.urandom(1024*1024)
+        fname = self.tempname('sendfile')
+        with open(fname, 'wb') as fout:
+            fout.write(data)
+        with open(fname, 'rb') as fin:
+            nbytes = client.sendfile(fin, 100, 500000)
+        assert nbytes == 500000
+        result = bytearray()
+        while len(result) < nbytes:
+            result += client.read(nbytes - len(result))
+        assert result == data[100:500100]
+        client.close()
+
+    def test_writelines(self):
+        server = StreamServer(echo_handler)
+        server.listen(('localhost', 0))
+        addr = server.transport.getsockname()
+        client = StreamClient()
+        client.connect(addr)
+        lines = [b'foo\n', b'', b'bar\n', b'x' * 1000]
+        client.writelines(lines)
+        result = client.read(1008)
+        assert result == b''.join(lines)
+        client.close()
+
     def test_pipe(self):
         server = StreamServer(echo_handler)
         path = self.pipename('temp.sock')
@@ -46,3 +95,54 @@ class TestHandles(UnitTest):
         result = client.read(1024)
         assert result == buf
         client.close()
+
+    def test_handoff(self):
+        acceptor = StreamServer(echo_handler)
+        acceptor.listen(('localhost', 0))
+        addr = acceptor.transport.getsockname()
+        clients = []
+        def worker_handler(stream, protocol, client):
+            clients.append(client)
+            echo_handler(stream, protocol, client)
+        def worker():
+            server = StreamServer(worker_handler)
+            acceptor.add_worker(server)
+            gruvi.get_hub().switch()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        while not acceptor._workers:
+            gruvi.util.sleep(0.01)
+        client = StreamClient()
+        client.connect(addr)
+        buf = b'x' * 1024
+        client.write(buf)
+        result = client.read(1024)
+        assert result == buf
+        assert len(clients) == 1
+        assert len(acceptor.clients) == 0
+        client.close()
+        acceptor.close()
+        thread.join()
+
+    def test_read_speed(self):
+        server = StreamServer(echo_handler)
+        server.listen(('localhost', 0))
+        addr = server.transport.getsockname()
+        client = StreamClient()
+        client.connect(addr)
+        buf = b'x' * 65536
+        for checks in (True, False):
+            gruvi.set_checks(checks)
+            try:
+                client.write(buf)
+                nbytes = ncalls = 0
+                t0 = time.time()
+                while nbytes < len(buf):
+                    nbytes += len(client.read(16))
+                    ncalls += 1
+                t1 = time.time()
+            finally:
+                gruvi.set_checks(True)
+            speed = ncalls / (t1 - t0)
+            print('Speed (checks={0}): {1:.0f} reads/sec'.format(checks, speed))
+        client.close()
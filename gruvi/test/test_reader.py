@@ -0,0 +1,218 @@
+#
+# This file is part of Gruvi. Gruvi is free software available under the
+# terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2012-2013 the Gruvi authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import time
+import gruvi
+from gruvi.reader import Reader, SpooledReader
+from gruvi.test import UnitTest
+
+
+def tobytes(view):
+    # On Python 2.6 the views are plain strings.
+    return view.tobytes() if hasattr(view, 'tobytes') else view
+
+
+class TestReader(UnitTest):
+
+    def test_read(self):
+        reader = Reader()
+        reader._feed(b'foo')
+        reader._feed(b'bar')
+        assert reader.read(2) == b'fo'
+        assert reader.read(10) == b'o'
+        assert reader.read(10) == b'bar'
+        reader._feed(b'baz')
+        reader._feed(b'')
+        assert reader.read() == b'baz'
+        assert reader.read() == b''
+
+    def test_read_view(self):
+        reader = Reader()
+        reader._feed(b'foobar')
+        view = reader.read_view(3)
+        assert tobytes(view) == b'foo'
+        assert tobytes(reader.read_view()) == b'bar'
+        reader._feed(b'')
+        assert len(reader.read_view()) == 0
+
+    def test_peek(self):
+        reader = Reader()
+        reader._feed(b'foo')
+        reader._feed(b'bar')
+        assert tobytes(reader.peek()) == b'foo'
+        assert tobytes(reader.peek(2)) == b'fo'
+        assert reader.read(1) == b'f'
+        assert tobytes(reader.peek()) == b'oo'
+        assert reader._buffer_size == 5
+
+    def test_readinto(self):
+        reader = Reader()
+        reader._feed(b'foo')
+        reader._feed(b'bar')
+        buf = bytearray(4)
+        assert reader.readinto(buf) == 4
+        assert buf == bytearray(b'foob')
+        assert reader.readinto(buf) == 2
+        assert buf[:2] == bytearray(b'ar')
+        reader._feed(b'')
+        assert reader.readinto(buf) == 0
+        assert reader._buffer_size == 0
+
+    def test_readinto1(self):
+        reader = Reader()
+        reader._feed(b'foo')
+        reader._feed(b'bar')
+        buf = bytearray(4)
+        assert reader.readinto1(buf) == 3
+        assert buf[:3] == bytearray(b'foo')
+        assert reader.readinto1(buf) == 3
+        assert buf[:3] == bytearray(b'bar')
+        reader._feed(b'')
+        assert reader.readinto1(buf) == 0
+
+    def test_read_zero(self):
+        reader = Reader()
+        reader._feed(b'foo')
+        reader._feed(b'bar')
+        assert reader.readinto1(bytearray(0)) == 0
+        assert reader.readinto(bytearray(0)) == 0
+        assert len(reader.read_view(0)) == 0
+        assert reader._buffer_size == 6
+        reader._feed(b'')
+        assert reader.read() == b'foobar'
+        assert reader._buffer_size == 0
+
+    def test_readline(self):
+        reader = Reader()
+        reader._feed(b'foo\nba')
+        reader._feed(b'r\nbaz')
+        assert reader.readline() == b'foo\n'
+        assert reader.readline() == b'bar\n'
+        reader._feed(b'')
+        assert reader.readline() == b'baz'
+        assert reader.readline() == b''
+
+    def test_readline_limit(self):
+        reader = Reader()
+        reader._feed(b'foobar\n')
+        assert reader.readline(4) == b'foob'
+        assert reader.readline(4) == b'ar\n'
+        reader._feed(b'foo')
+        reader._feed(b'bar')
+        assert reader.readline(5) == b'fooba'
+
+    def test_readline_wait(self):
+        hub = gruvi.get_hub()
+        reader = Reader()
+        result = []
+        def consumer():
+            result.append(reader.readline())
+        fiber = gruvi.Fiber(consumer)
+        fiber.start()
+        for chunk in (b'fo', b'o', b'\nbar'):
+            hub.run_callback(reader._feed, chunk)
+        hub.switch()
+        assert result == [b'foo\n']
+        reader._feed(b'')
+        assert reader.read() == b'bar'
+
+    def test_readuntil(self):
+        reader = Reader()
+        message = b'GET / HTTP/1.1\r\nHost: foo\r\n\r\nbody'
+        for i in range(len(message)):
+            reader._feed(message[i:i+1])
+        assert reader.readuntil(b'\r\n\r\n') == message[:-4]
+        assert reader.readuntil(b'\r\n\r\n', 2) == b'bo'
+        reader._feed(b'')
+        assert reader.readuntil(b'\r\n\r\n') == b'dy'
+
+    def test_readuntil_straddle(self):
+        reader = Reader()
+        reader._feed(b'xx\r')
+        reader._feed(b'\n')
+        reader._feed(b'\r')
+        reader._feed(b'\nyy')
+        assert reader.readuntil(b'\r\n\r\n') == b'xx\r\n\r\n'
+        reader._feed(b'')
+        assert reader.read() == b'yy'
+
+    def test_readline_speed(self):
+        # A long line that arrives in many small packets.
+        hub = gruvi.get_hub()
+        reader = Reader()
+        packet = b'x' * 100
+        npackets = 10000
+        result = []
+        def consumer():
+            result.append(reader.readline())
+        fiber = gruvi.Fiber(consumer)
+        fiber.start()
+        def producer(i):
+            if i == npackets:
+                reader._feed(b'\n')
+                return
+            reader._feed(packet)
+            hub.run_callback(producer, i+1)
+        hub.run_callback(producer, 0)
+        t0 = time.time()
+        hub.switch()
+        t1 = time.time()
+        assert len(result[0]) == len(packet) * npackets + 1
+        speed = npackets / (t1 - t0)
+        print('Speed: {0:.0f} packets/sec'.format(speed))
+
+    def test_spooled_reader(self):
+        hub = gruvi.get_hub()
+        reader = SpooledReader()
+        result = []
+        def consumer():
+            result.append(reader.read(3))
+        fiber = gruvi.Fiber(consumer)
+        fiber.start()
+        for chunk in (b'foo', b'bar', b''):
+            hub.run_callback(reader._feed, chunk)
+        hub.switch()
+        # The read does not return before all data is received.
+        assert result == [b'foo']
+        assert reader._buffer_size == 0
+        assert reader.tell() == 3
+        buf = bytearray(10)
+        assert reader.readinto(buf) == 3
+        assert buf[:3] == bytearray(b'bar')
+        reader.seek(-4, 2)
+        assert reader.read() == b'obar'
+        reader.close()
+
+    def test_read_speed(self):
+        chunk = b'x' * 65536
+        nchunks = 256
+        for size in (1024, 1024*1024):
+            buf = bytearray(size)
+            for name in ('read', 'read_view', 'readinto'):
+                reader = Reader()
+                for i in range(nchunks):
+                    reader._feed(chunk)
+                reader._feed(b'')
+                if name == 'readinto':
+                    read = lambda: reader.readinto(buf)
+                else:
+                    read = lambda: len(getattr(reader, name)(size))
+                nbytes = 0
+                t0 = time.time()
+                while True:
+                    n = read()
+                    if not n:
+                        break
+                    nbytes += n
+                t1 = time.time()
+                assert nbytes == len(chunk) * nchunks
+                speed = nbytes / (t1 - t0) / (1024*1024)
+                print('Speed ({0}, {1} bytes): {2:.0f} MiB/sec'
+                            .format(name, size, speed))